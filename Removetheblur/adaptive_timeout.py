@@ -0,0 +1,136 @@
+"""
+自适应超时
+- connect: 固定的短超时，主机不可达时几秒内发现，而不是等5分钟
+- write: 按上传字节数 / 实测上传带宽 × 系数计算，上传卡住时尽快放弃
+- read: 最近成功请求的服务端耗时（请求体发送完到收到响应头）p99 × 系数；样本不足时用默认值
+学习到的带宽和服务端耗时样本保存在 CACHE_DIR/timeouts.json，重启后继续使用
+"""
+import json
+import os
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+from config import (
+    CACHE_DIR,
+    TIMEOUT_CONNECT,
+    TIMEOUT_WRITE_MIN,
+    TIMEOUT_WRITE_MAX,
+    TIMEOUT_WRITE_FACTOR,
+    TIMEOUT_READ_DEFAULT,
+    TIMEOUT_READ_MIN,
+    TIMEOUT_READ_MAX,
+    TIMEOUT_READ_FACTOR,
+    TIMEOUT_MIN_SAMPLES,
+    TIMEOUT_HISTORY,
+)
+from phase_timing import percentile
+from upload_encoder import BandwidthEstimator
+
+
+def _clamp(value: float, low: float, high: float) -> float:
+    return max(low, min(high, value))
+
+
+class AdaptiveTimeouts:
+    """按历史数据计算请求超时（线程安全）"""
+
+    def __init__(self, path: str = None):
+        self.path = Path(path or os.path.join(CACHE_DIR, 'timeouts.json'))
+        self._lock = threading.Lock()
+        # 成功请求的服务端耗时（秒），只保留最近 TIMEOUT_HISTORY 个
+        self._server_waits = deque(maxlen=max(1, TIMEOUT_HISTORY))
+        # 上传带宽估计，与上传编码器共用
+        self.bandwidth = BandwidthEstimator()
+        self._load()
+
+    def _load(self):
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return
+        try:
+            self._server_waits.extend(float(x) for x in data.get('server_wait_samples', []))
+            self.bandwidth.restore(float(data.get('bandwidth', 0)), int(data.get('bandwidth_samples', 0)))
+        except (TypeError, ValueError):
+            self._server_waits.clear()
+
+    def save(self):
+        """保存学习到的数据（先写临时文件再原子替换）"""
+        with self._lock:
+            data = {
+                'server_wait_samples': [round(x, 3) for x in self._server_waits],
+                'bandwidth': round(self.bandwidth.bandwidth, 1),
+                'bandwidth_samples': self.bandwidth.samples,
+            }
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(f"{self.path.name}.{threading.get_ident()}.tmp")
+            tmp_path.write_text(json.dumps(data), encoding='utf-8')
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ 保存超时学习数据失败: {e}")
+
+    def record_server_wait(self, seconds: float):
+        """记录一次成功请求的服务端耗时，并保存"""
+        if seconds <= 0:
+            return
+        with self._lock:
+            self._server_waits.append(seconds)
+        self.save()
+
+    def read_timeout(self) -> float:
+        """读超时：服务端耗时 p99 × 系数（样本不足时用默认值）"""
+        with self._lock:
+            samples = sorted(self._server_waits)
+        if len(samples) < TIMEOUT_MIN_SAMPLES:
+            return TIMEOUT_READ_DEFAULT
+        return _clamp(percentile(samples, 99) * TIMEOUT_READ_FACTOR, TIMEOUT_READ_MIN, TIMEOUT_READ_MAX)
+
+    def write_timeout(self, payload_bytes: int) -> float:
+        """写超时：上传字节数 / 实测带宽 × 系数"""
+        expected = payload_bytes / max(1.0, self.bandwidth.bandwidth)
+        return _clamp(expected * TIMEOUT_WRITE_FACTOR, TIMEOUT_WRITE_MIN, TIMEOUT_WRITE_MAX)
+
+    def timeout_for(self, payload_bytes: int, attempt: int = 1) -> httpx.Timeout:
+        """
+        本次请求的超时设置
+
+        Args:
+            payload_bytes: 请求体字节数
+            attempt: 第几次请求；重试时读/写超时翻倍，避免因超时偏紧反复失败
+        """
+        scale = 2 ** max(0, attempt - 1)
+        read = min(self.read_timeout() * scale, TIMEOUT_READ_MAX)
+        write = min(self.write_timeout(payload_bytes) * scale, TIMEOUT_WRITE_MAX)
+        return httpx.Timeout(connect=TIMEOUT_CONNECT, read=read, write=write, pool=read)
+
+    def stats(self) -> dict:
+        with self._lock:
+            samples = sorted(self._server_waits)
+        return {
+            'connect': TIMEOUT_CONNECT,
+            'read': round(self.read_timeout(), 1),
+            'server_wait_samples': len(samples),
+            'server_wait_p50': round(percentile(samples, 50), 2),
+            'server_wait_p99': round(percentile(samples, 99), 2),
+            'bandwidth_bytes_per_sec': round(self.bandwidth.bandwidth, 1),
+            'bandwidth_samples': self.bandwidth.samples,
+        }
+
+
+_shared_timeouts: Optional[AdaptiveTimeouts] = None
+_shared_timeouts_lock = threading.Lock()
+
+
+def get_adaptive_timeouts() -> AdaptiveTimeouts:
+    """获取进程级共享的自适应超时"""
+    global _shared_timeouts
+    if _shared_timeouts is None:
+        with _shared_timeouts_lock:
+            if _shared_timeouts is None:
+                _shared_timeouts = AdaptiveTimeouts()
+    return _shared_timeouts
@@ -0,0 +1,278 @@
+"""
+多端点/多密钥负载均衡
+配置多个 (base_url, api_key, weight, max_concurrency) 后端，按最少在途请求或延迟加权路由；
+每个后端单独限速、单独统计健康状况，连续失败时自动摘除，冷却后放一个探测请求恢复
+"""
+import json
+import threading
+import time
+from typing import List, Optional
+
+from config import (
+    API_BACKENDS,
+    API_BASE_URL,
+    API_ROUTING,
+    BACKEND_EJECT_THRESHOLD,
+    BACKEND_EJECT_SECONDS,
+    BACKEND_EJECT_ON,
+    OPENAI_API_KEY,
+)
+from request_control import RateLimiter
+
+ROUTING_MODES = ('least_outstanding', 'latency')
+# 摘除时间翻倍的上限（秒）
+MAX_EJECT_SECONDS = 600.0
+
+
+class Backend:
+    """单个API后端（base_url + api_key）及其健康状况"""
+
+    # 延迟指数滑动平均的权重
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, base_url: str, api_key: str, weight: float = 1.0,
+                 max_concurrency: int = 0, requests_per_minute: float = None, name: str = ''):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.weight = max(0.01, float(weight))
+        self.max_concurrency = int(max_concurrency or 0)
+        self.name = name or self.base_url
+        # 每个后端（密钥）单独限速：一个密钥被限流不会拖慢其他密钥
+        self.rate_limiter = RateLimiter(requests_per_minute=requests_per_minute)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.latency_ewma: Optional[float] = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.eject_seconds = BACKEND_EJECT_SECONDS
+        self.ejections = 0
+        # 摘除到期后处于观察期：下一个请求作为探测，成功才算恢复
+        self.on_probation = False
+        self.probing = False
+        self.last_error = ''
+
+    def masked_key(self) -> str:
+        if len(self.api_key) <= 8:
+            return '***'
+        return f"{self.api_key[:4]}...{self.api_key[-4:]}"
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def is_healthy(self, now: float) -> bool:
+        return not self.is_ejected(now) and not self.on_probation
+
+    def has_capacity(self) -> bool:
+        return self.max_concurrency <= 0 or self.outstanding < self.max_concurrency
+
+    def stats(self, now: float) -> dict:
+        return {
+            'name': self.name,
+            'base_url': self.base_url,
+            'api_key': self.masked_key(),
+            'weight': self.weight,
+            'max_concurrency': self.max_concurrency,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'latency_ewma': round(self.latency_ewma, 2) if self.latency_ewma is not None else None,
+            'healthy': self.is_healthy(now),
+            'ejected_seconds_left': round(max(0.0, self.ejected_until - now), 1),
+            'ejections': self.ejections,
+            'last_error': self.last_error,
+            'rate_limit': self.rate_limiter.stats(),
+        }
+
+
+def parse_backends(raw: str) -> List[Backend]:
+    """
+    解析 API_BACKENDS 配置（JSON 数组），例如：
+    [{"base_url": "https://a.example.com", "api_key": "sk-1", "weight": 2, "max_concurrency": 4},
+     {"base_url": "https://b.example.com", "api_key": "sk-2", "rpm": 30}]
+    未配置时使用 API_BASE_URL + OPENAI_API_KEY 作为唯一后端
+    """
+    raw = (raw or '').strip()
+    if not raw:
+        if not OPENAI_API_KEY:
+            return []
+        return [Backend(API_BASE_URL, OPENAI_API_KEY, name='default')]
+    try:
+        items = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"API_BACKENDS 不是有效的JSON: {e}")
+    if not isinstance(items, list):
+        raise ValueError("API_BACKENDS 必须是JSON数组")
+    backends = []
+    for idx, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            raise ValueError(f"API_BACKENDS 第{idx}项必须是对象")
+        api_key = item.get('api_key') or OPENAI_API_KEY
+        if not api_key:
+            raise ValueError(f"API_BACKENDS 第{idx}项缺少 api_key")
+        backends.append(Backend(
+            base_url=item.get('base_url') or API_BASE_URL,
+            api_key=api_key,
+            weight=item.get('weight', 1.0),
+            max_concurrency=item.get('max_concurrency', 0),
+            requests_per_minute=item.get('rpm'),
+            name=item.get('name') or f"backend-{idx}",
+        ))
+    return backends
+
+
+class BackendPool:
+    """
+    后端池（线程安全）
+
+    - least_outstanding: 选 (在途请求数+1)/权重 最小的后端
+    - latency: 在此基础上再乘以该后端的平均延迟，慢的后端分到更少请求
+    - 连续 BACKEND_EJECT_THRESHOLD 次系统性错误的后端摘除 BACKEND_EJECT_SECONDS 秒，
+      到期后放行一个探测请求，失败则摘除时间翻倍
+    """
+
+    def __init__(self, backends: List[Backend] = None, routing: str = None):
+        self.backends = parse_backends(API_BACKENDS) if backends is None else backends
+        self.routing = (routing or API_ROUTING).strip().lower()
+        if self.routing not in ROUTING_MODES:
+            raise ValueError(f"API_ROUTING 无效: {self.routing}（可选: {', '.join(ROUTING_MODES)}）")
+        self.eject_on = set(BACKEND_EJECT_ON)
+        self._cond = threading.Condition()
+
+    @property
+    def size(self) -> int:
+        return len(self.backends)
+
+    def healthy_count(self) -> int:
+        now = time.monotonic()
+        with self._cond:
+            return sum(1 for b in self.backends if b.is_healthy(now))
+
+    def _score(self, backend: Backend) -> float:
+        load = (backend.outstanding + 1) / backend.weight
+        if self.routing == 'latency':
+            # 尚无延迟数据的后端优先（得分为0），以便尽快获得样本
+            return load * (backend.latency_ewma or 0.0)
+        return load
+
+    def _selectable(self, backend: Backend, now: float) -> bool:
+        if not backend.has_capacity() or backend.is_ejected(now):
+            return False
+        # 摘除到期后只放行一个探测请求，结果出来前不再分配
+        return not (backend.on_probation and backend.probing)
+
+    def _pick_locked(self, avoid: Optional[Backend]) -> Optional[Backend]:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if self._selectable(b, now)]
+        if avoid is not None and len(candidates) > 1:
+            # 重试时优先换一个后端
+            candidates = [b for b in candidates if b is not avoid]
+        if not candidates:
+            return None
+        # 优先未处于限流暂停中的后端
+        active = [b for b in candidates if b.rate_limiter.pause_remaining() <= 0] or candidates
+        backend = min(active, key=lambda b: (self._score(b), b.latency_ewma or 0.0))
+        if backend.on_probation:
+            backend.probing = True
+        return backend
+
+    def acquire(self, avoid: Optional[Backend] = None) -> Backend:
+        """
+        选一个后端并占用一个在途名额；所有后端都满载或被摘除时等待
+
+        Args:
+            avoid: 可选，尽量不选该后端（上一次失败的后端）
+        """
+        with self._cond:
+            while True:
+                backend = self._pick_locked(avoid)
+                if backend is not None:
+                    backend.outstanding += 1
+                    backend.requests += 1
+                    return backend
+                now = time.monotonic()
+                ejected = [b.ejected_until - now for b in self.backends if b.is_ejected(now)]
+                self._cond.wait(timeout=max(0.05, min(ejected, default=1.0)))
+
+    def release(self, backend: Backend, latency: Optional[float] = None,
+                error_kind: Optional[str] = None, error_message: str = ''):
+        """
+        归还在途名额并更新健康状况/延迟统计
+
+        Args:
+            backend: acquire() 返回的后端
+            latency: 成功请求的耗时（秒）
+            error_kind: 失败时的错误类别（None 表示成功）
+            error_message: 失败原因
+        """
+        with self._cond:
+            backend.outstanding = max(0, backend.outstanding - 1)
+            was_probing = backend.probing
+            backend.probing = False
+            if error_kind is None:
+                if backend.on_probation:
+                    print(f"✓ 后端 {backend.name} 探测成功，恢复使用")
+                backend.consecutive_failures = 0
+                backend.on_probation = False
+                backend.eject_seconds = BACKEND_EJECT_SECONDS
+                if latency is not None:
+                    if backend.latency_ewma is None:
+                        backend.latency_ewma = latency
+                    else:
+                        backend.latency_ewma += Backend.EWMA_ALPHA * (latency - backend.latency_ewma)
+            elif error_kind in self.eject_on:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                backend.last_error = f"{error_kind}: {error_message}" if error_message else error_kind
+                # 只有一个后端时不摘除，交给全局熔断器处理
+                if self.size > 1 and (was_probing or backend.consecutive_failures >= BACKEND_EJECT_THRESHOLD):
+                    if was_probing:
+                        backend.eject_seconds = min(MAX_EJECT_SECONDS, backend.eject_seconds * 2)
+                    backend.ejected_until = time.monotonic() + backend.eject_seconds
+                    backend.on_probation = True
+                    backend.ejections += 1
+                    print(f"⚠️ 后端 {backend.name} 已摘除 {backend.eject_seconds:g} 秒"
+                          f"（{backend.last_error}）")
+            else:
+                # 其他错误说明后端可达
+                backend.failures += 1
+                backend.consecutive_failures = 0
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._cond:
+            return {
+                'routing': self.routing,
+                'healthy': sum(1 for b in self.backends if b.is_healthy(now)),
+                'backends': [b.stats(now) for b in self.backends],
+            }
+
+    def rate_limit_stats(self) -> dict:
+        """汇总所有后端的限流统计"""
+        per_backend = [b.rate_limiter.stats() for b in self.backends]
+        events = []
+        for backend, st in zip(self.backends, per_backend):
+            events += [dict(e, backend=backend.name) for e in st['recent_events']]
+        events.sort(key=lambda e: e['time'])
+        return {
+            'in_flight': sum(st['in_flight'] for st in per_backend),
+            'paused_seconds_left': max((st['paused_seconds_left'] for st in per_backend), default=0.0),
+            'throttle_count': sum(st['throttle_count'] for st in per_backend),
+            'total_wait_seconds': round(sum(st['total_wait_seconds'] for st in per_backend), 1),
+            'recent_events': events[-10:],
+        }
+
+
+_shared_pool: Optional[BackendPool] = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_backend_pool() -> BackendPool:
+    """获取进程级共享后端池"""
+    global _shared_pool
+    if _shared_pool is None:
+        with _shared_pool_lock:
+            if _shared_pool is None:
+                _shared_pool = BackendPool()
+    return _shared_pool
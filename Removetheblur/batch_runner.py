@@ -0,0 +1,439 @@
+"""
+批处理驱动（Web和命令行共用）
+process_images_batch 用三段流水线处理一个文件夹：预筛、预算、熔断中止、会话日志都在这里；
+处理状态保存在 processing_status（受 processing_lock 保护），Web接口据此展示进度和任务报告。
+本模块不依赖 Flask，命令行批处理导入它时不会启动Web相关的初始化
+"""
+import os
+import threading
+import time
+from pathlib import Path
+
+from deblur_agent import DeblurAgent, ImageJob
+from pipeline import DeblurPipeline
+from http_pool import get_pool_stats
+from result_cache import get_result_cache
+from request_control import get_circuit_breaker
+from backend_pool import get_backend_pool
+from phase_timing import summarize_phases
+from usage_budget import BatchBudget, get_usage_ledger
+from image_utils import output_extension
+from prescreen import parse_prescreen_mode, prescreen_images
+from session_journal import SessionJournal
+from edit_backend import create_edit_backend
+from config import AI_MAX_WORKERS, PRESCREEN_THRESHOLD
+
+# 处理状态
+processing_status = {
+    'is_processing': False,
+    'current_file': '',
+    'total_files': 0,
+    'processed_files': 0,
+    'errors': [],
+    'session_id': '',
+    'input_folder': '',
+    'temp_folder': '',
+    'prompt': '',
+    'latest_processed': [],  # 最新处理的图片列表，用于实时更新
+    'max_workers': AI_MAX_WORKERS,  # 最大并发数
+    'in_flight': 0,  # 当前在途的图片数
+    'file_states': {},  # 每张图片的状态：queued/preparing/ready/uploading/waiting/throttled/retrying/paused/budget_paused/decoding/saving/saved/failed/skipped/sharp
+    'file_reports': {},  # 每张图片的处理报告（请求次数、重试次数、是否命中缓存、预筛得分、各阶段耗时等）
+    'prescreen': {},  # 预筛汇总（模式、阈值、已清晰的图片数、耗时）
+    'resumed': False,  # 是否为续跑（按会话日志跳过已完成的图片）
+    'resumed_files': 0,  # 续跑时跳过的已完成图片数
+    'aborted': False,  # 是否因API熔断/预算用完中止
+    'abort_reason': '',
+    'abort_kind': ''  # 中止原因类别：circuit_open / budget
+}
+# 并发处理时保护 processing_status 的锁
+processing_lock = threading.Lock()
+# latest_processed 最多保留的条数（前端按文件名去重）
+LATEST_PROCESSED_LIMIT = 20
+# 当前（最近一次）批次的预算调度，用于展示用量/费用/吞吐
+batch_budget = None
+# 正在运行的批处理流水线，用于展示各阶段的负载
+batch_pipeline = None
+
+
+def usage_stats() -> dict:
+    """当前批次的用量、费用、吞吐和预算状态；未运行过批次时只有今天的累计用量"""
+    if batch_budget is not None:
+        return batch_budget.stats()
+    return {'daily': get_usage_ledger().day()}
+
+
+def pipeline_stats() -> dict:
+    """批处理流水线各阶段的线程数、正在处理和排队的图片数（未运行时为空）"""
+    pipeline = batch_pipeline
+    return pipeline.stats() if pipeline is not None else {}
+
+
+def process_images_batch(input_folder, output_folder, session_id=None, prompt: str = None,
+                         max_workers: int = None, use_cache: bool = True, prescreen: str = None,
+                         resume: bool = False, target_size: tuple = None, backend: str = None):
+    """
+    批量处理图片（三段流水线，同时最多 max_workers 个编辑请求在途）
+    派发前先并行预筛清晰度：已清晰的图片按 prescreen（off / skip / copy，默认 PRESCREEN_MODE）跳过或直接输出
+    每张图片的结果记录在输出文件夹的会话日志中（见 session_journal）；resume=True 时跳过日志中已完成的图片，
+    只处理未完成或失败的图片，未指定的提示词和目标尺寸沿用日志中的会话参数
+    target_size 默认1024×1536；backend 为编辑后端（http / local），默认使用 EDIT_BACKEND 配置
+    """
+    global processing_status, batch_budget, batch_pipeline
+    
+    max_workers = max(1, int(max_workers or AI_MAX_WORKERS))
+    
+    try:
+        prescreen = parse_prescreen_mode(prescreen)
+        output_ext = output_extension()
+        print(f"\n{'='*60}")
+        print(f"[线程启动] 开始批量处理图片")
+        print(f"输入文件夹: {input_folder}")
+        print(f"输出文件夹: {output_folder}")
+        print(f"会话ID: {session_id}")
+        print(f"并发数: {max_workers}")
+        print(f"结果缓存: {'使用' if use_cache else '跳过'}")
+        print(f"清晰度预筛: {prescreen}")
+        if prompt:
+            print(f"提示词: {prompt}")
+        print(f"{'='*60}\n")
+        
+        processing_status['is_processing'] = True
+        processing_status['errors'] = []
+        processing_status['processed_files'] = 0
+        processing_status['latest_processed'] = []
+        processing_status['max_workers'] = max_workers
+        processing_status['in_flight'] = 0
+        processing_status['file_states'] = {}
+        processing_status['file_reports'] = {}
+        processing_status['prescreen'] = {}
+        processing_status['resumed'] = bool(resume)
+        processing_status['resumed_files'] = 0
+        processing_status['aborted'] = False
+        processing_status['abort_reason'] = ''
+        processing_status['abort_kind'] = ''
+        if session_id:
+            processing_status['session_id'] = session_id
+            processing_status['input_folder'] = input_folder
+            processing_status['temp_folder'] = output_folder
+            processing_status['prompt'] = prompt or ''
+        
+        # 支持的图片格式
+        image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
+        
+        # 获取所有图片文件
+        input_path = Path(input_folder)
+        image_files = [
+            f for f in input_path.iterdir()
+            if f.suffix.lower() in image_extensions and f.is_file()
+        ]
+        
+        if not image_files:
+            error_msg = f'在文件夹 {input_folder} 中未找到图片文件（支持格式: .jpg, .jpeg, .png, .bmp, .tiff, .webp）'
+            print(f"✗ 错误: {error_msg}")
+            print(f"请检查文件夹路径是否正确，以及文件夹中是否包含支持的图片格式")
+            processing_status['errors'].append(error_msg)
+            processing_status['is_processing'] = False
+            processing_status['total_files'] = 0
+            return
+        
+        print(f"✓ 找到 {len(image_files)} 张图片文件")
+        processing_status['total_files'] = len(image_files)
+        processing_status['current_file'] = ''
+        processing_status['file_states'] = {f.name: 'queued' for f in image_files}
+        
+        # 创建输出文件夹
+        output_path = Path(output_folder)
+        output_path.mkdir(parents=True, exist_ok=True)
+        
+        # 初始化agent，捕获初始化错误
+        try:
+            print("=" * 60)
+            print("正在初始化AI处理器...")
+            print("=" * 60)
+            agent = DeblurAgent(create_edit_backend(backend))
+            print("✓ AI处理器初始化成功")
+            print("=" * 60)
+        except Exception as e:
+            error_msg = f"初始化AI处理器失败: {str(e)}"
+            print(f"✗ 错误: {error_msg}")
+            import traceback
+            traceback.print_exc()
+            processing_status['errors'].append(error_msg)
+            processing_status['is_processing'] = False
+            processing_status['total_files'] = len(image_files) if image_files else 0
+            return
+        
+        # 预算调度：派发每张图片前预留预估用量，预计超出预算时降级质量/暂停/停止
+        batch_budget = BatchBudget(get_usage_ledger(), base_quality=getattr(agent.backend, 'QUALITY', 'high'))
+        if batch_budget.limited:
+            limits = batch_budget.stats()['limits']
+            print(f"预算: 每批次 {limits['batch_tokens'] or '不限'} tokens / ${limits['batch_cost'] or '不限'}, "
+                  f"每天 {limits['daily_tokens'] or '不限'} tokens / ${limits['daily_cost'] or '不限'}, "
+                  f"超出时: {batch_budget.action}")
+        
+        # 会话日志：续跑时跳过已完成的图片（输出仍在、输入未被替换），否则开始新一轮记录
+        journal = SessionJournal(output_folder)
+        completed = {}
+        if resume and journal.exists:
+            meta, _ = journal.read()
+            prompt = prompt or meta.get('prompt') or None
+            target_size = target_size or tuple(meta.get('target_size') or ()) or None
+            completed = journal.completed(image_files)
+            processing_status['prompt'] = prompt or ''
+        target_size = tuple(target_size or (1024, 1536))
+        pending_files = [f for f in image_files if f.name not in completed]
+        session_meta = dict(session_id=session_id or '', input_folder=os.path.abspath(input_folder),
+                            prompt=prompt or '', target_size=list(target_size), total_files=len(image_files))
+        if resume:
+            journal.resume(len(pending_files), **session_meta)
+            print(f"续跑会话: {len(completed)} 张已完成，{len(pending_files)} 张待处理"
+                  + (f"，提示词: {prompt}" if prompt else ""))
+        else:
+            journal.start(**session_meta)
+        with processing_lock:
+            processing_status['resumed_files'] = len(completed)
+            processing_status['processed_files'] += len(completed)
+            for name, record in completed.items():
+                processing_status['file_states'][name] = record['state']
+                processing_status['file_reports'][name] = {
+                    'success': True, 'resumed': True, 'skipped': record['state'] != 'saved',
+                    'error_kind': None, 'output': record.get('output')
+                }
+        
+        # 清晰度预筛：派发前并行为待处理的图片评分，已清晰的图片不调用API
+        screens = {}
+        if prescreen != 'off' and pending_files:
+            processing_status['current_file'] = '正在预筛清晰度...'
+            started = time.perf_counter()
+            screens = prescreen_images(pending_files)
+            elapsed = time.perf_counter() - started
+            sharp_count = sum(1 for screen in screens.values() if screen['sharp'])
+            processing_status['prescreen'] = {
+                'mode': prescreen,
+                'threshold': PRESCREEN_THRESHOLD,
+                'screened': len(screens),
+                'sharp': sharp_count,
+                'seconds': round(elapsed, 3)
+            }
+            print(f"清晰度预筛: {len(screens)} 张图片用时 {elapsed:.2f} 秒，"
+                  f"{sharp_count} 张已清晰（得分 ≥ {PRESCREEN_THRESHOLD}），"
+                  f"{'直接输出原图' if prescreen == 'copy' else '跳过'}")
+            processing_status['current_file'] = ''
+        
+        # 三段流水线：准备（加载/缩放/编码）→ 编辑（最多 max_workers 个请求在途）→ 保存，
+        # 下一张图片的本地处理与当前图片的API等待重叠
+        pipeline = DeblurPipeline(agent, edit_workers=max_workers, name=f"AIWorker-{session_id}")
+        print(f"流水线: 准备 {pipeline.prepare_workers} 线程 → 编辑 {pipeline.edit_workers} 线程 → "
+              f"保存 {pipeline.save_workers} 线程（段间队列容量 {pipeline.queue_size}）")
+        
+        # API熔断持续过久或预算用完时中止：剩余图片直接跳过，原因只报告一次
+        abort_event = threading.Event()
+        
+        def set_state(name: str, state: str):
+            with processing_lock:
+                processing_status['file_states'][name] = state
+        
+        def abort_batch(reason: str, kind: str = 'circuit_open'):
+            with processing_lock:
+                if abort_event.is_set():
+                    return
+                abort_event.set()
+                processing_status['aborted'] = True
+                processing_status['abort_reason'] = reason
+                processing_status['abort_kind'] = kind
+                processing_status['errors'].append(f"批处理已中止: {reason}")
+            pipeline.cancel()
+            print(f"✗ 批处理已中止: {reason}")
+        
+        def skip_sharp_image(image_file: Path, screen: dict):
+            """预筛判定已清晰且模式为 skip：不处理、不输出"""
+            with processing_lock:
+                processing_status['processed_files'] += 1
+                processing_status['file_states'][image_file.name] = 'sharp'
+                processing_status['file_reports'][image_file.name] = {
+                    'success': True, 'skipped': True, 'error_kind': None, 'prescreen': screen
+                }
+            journal.record(image_file, 'sharp')
+            print(f"已清晰，跳过: {image_file.name}（得分 {screen['score']}）")
+        
+        def skip_image(image_file: Path):
+            with processing_lock:
+                processing_status['processed_files'] += 1
+                processing_status['file_states'][image_file.name] = 'skipped'
+                processing_status['file_reports'][image_file.name] = {
+                    'success': False, 'skipped': True,
+                    'error_kind': processing_status['abort_kind'] or 'circuit_open'
+                }
+            journal.record(image_file, 'skipped')
+        
+        def before_edit(job: ImageJob) -> bool:
+            """编辑前：检查是否已中止，并按预算预留用量（预算不足时降级/暂停/停止）"""
+            image_file = job.context['file']
+            if abort_event.is_set():
+                return False
+            # 按每次接口调用的尺寸预留（分块处理时每块按各自的接口尺寸；没有模糊区域时不调用API，不占预算）
+            request_sizes = job.request_sizes()
+            if request_sizes:
+                reservation = batch_budget.admit(
+                    request_sizes, on_pause=lambda: set_state(image_file.name, 'budget_paused')
+                )
+                if reservation is None:
+                    abort_batch(batch_budget.reason, kind='budget')
+                    return False
+                job.context['reservation'] = reservation
+                job.quality = reservation['quality']
+            with processing_lock:
+                processing_status['in_flight'] += 1
+                processing_status['current_file'] = image_file.name
+            print(f"\n{'='*60}")
+            print(f"开始处理第 {job.context['index']}/{len(image_files)} 张图片: {image_file.name}")
+            print(f"{'='*60}")
+            return True
+        
+        def after_edit(job: ImageJob):
+            with processing_lock:
+                processing_status['in_flight'] -= 1
+        
+        def on_done(job: ImageJob):
+            """图片处理结束（在保存线程中运行），结果直接写入临时文件夹"""
+            image_file = job.context['file']
+            result = job.result
+            reservation = job.context.get('reservation')
+            if reservation is not None:
+                batch_budget.settle(reservation, result.get('usage'))
+            
+            if result.get('skipped'):
+                skip_image(image_file)
+                return
+            if result.get('error_kind') == 'circuit_open':
+                cause = get_circuit_breaker().stats().get('cause', '')
+                abort_batch(f"API持续不可用（{cause}）")
+                skip_image(image_file)
+                return
+            
+            with processing_lock:
+                processing_status['processed_files'] += 1
+                processing_status['file_reports'][image_file.name] = {
+                    'success': result['success'],
+                    'attempts': result.get('attempts', 0),
+                    'retries': result.get('retries', 0),
+                    'cached': result.get('cached', False),
+                    'error_kind': result.get('error_kind'),
+                    'backend': result.get('backend'),
+                    'coalesced': result.get('coalesced', False),
+                    'quality': result.get('quality'),
+                    'usage': result.get('usage'),
+                    'tiles': result.get('tiles'),
+                    'tiles_sent': result.get('tiles_sent'),
+                    'api_size': result.get('api_size'),
+                    'upload_size': result.get('upload_size'),
+                    'output_encoding': result.get('output_encoding'),
+                    'prescreen': job.context.get('prescreen'),
+                    'timings': result.get('timings', {}),
+                    'bytes': result.get('bytes', {})
+                }
+                if result['success']:
+                    processing_status['file_states'][image_file.name] = 'saved'
+                    # 追加到最新处理列表（前端按文件名去重）
+                    processing_status['latest_processed'].append({
+                        'original': str(image_file),
+                        'fixed': job.output_path,
+                        'name': Path(job.output_path).name,
+                        'original_name': image_file.name
+                    })
+                    processing_status['latest_processed'] = \
+                        processing_status['latest_processed'][-LATEST_PROCESSED_LIMIT:]
+                else:
+                    processing_status['file_states'][image_file.name] = 'failed'
+                    error_msg = f"{image_file.name}: {result.get('error', '处理失败')}"
+                    processing_status['errors'].append(error_msg)
+            if result['success']:
+                journal.record(image_file, 'saved', output=job.output_path)
+            else:
+                journal.record(image_file, 'failed', error=result.get('error', '处理失败'))
+            
+            if result['success']:
+                print(f"✓ 成功处理: {image_file.name}")
+            else:
+                print(f"✗ 处理失败: {image_file.name}: {result.get('error', '处理失败')}")
+        
+        def make_jobs():
+            for idx, image_file in enumerate(image_files, 1):
+                if image_file.name in completed:
+                    continue
+                screen = screens.get(str(image_file))
+                if screen is not None and screen['sharp'] and prescreen == 'skip':
+                    skip_sharp_image(image_file, screen)
+                    continue
+                yield make_job(idx, image_file, screen)
+        
+        def make_job(idx: int, image_file: Path, screen: dict = None) -> ImageJob:
+            # 输出文件路径
+            output_file = output_path / f"{image_file.stem}_clear{output_ext}"
+            return ImageJob(
+                input_path=str(image_file),
+                output_path=str(output_file),
+                target_size=target_size,
+                prompt=prompt,
+                on_phase=lambda phase: set_state(image_file.name, phase),
+                use_cache=use_cache,
+                context={'index': idx, 'file': image_file, 'prescreen': screen},
+                passthrough=bool(screen and screen['sharp'])
+            )
+        
+        batch_pipeline = pipeline
+        try:
+            pipeline.run(
+                make_jobs(),
+                before_edit=before_edit, after_edit=after_edit, on_done=on_done
+            )
+        finally:
+            batch_pipeline = None
+        
+        # 最终更新处理文件数
+        with processing_lock:
+            if processing_status['processed_files'] < len(image_files):
+                processing_status['processed_files'] = len(image_files)
+        
+        pool_stats = get_pool_stats()
+        print(f"连接池统计: 请求 {pool_stats['requests']} 次, "
+              f"新建连接 {pool_stats['connections_opened']} 个, "
+              f"复用连接 {pool_stats['connections_reused']} 次")
+        cache_stats = get_result_cache().stats()
+        print(f"结果缓存: 命中 {cache_stats['hits']} 次, 未命中 {cache_stats['misses']} 次")
+        with processing_lock:
+            coalesced = sum(1 for r in processing_status['file_reports'].values() if r.get('coalesced'))
+        if coalesced:
+            print(f"单飞合并: {coalesced} 张图片复用了相同请求的结果")
+        rate_stats = get_backend_pool().rate_limit_stats()
+        if rate_stats['throttle_count']:
+            print(f"限流: 共 {rate_stats['throttle_count']} 次, 累计等待 {rate_stats['total_wait_seconds']} 秒")
+        with processing_lock:
+            phase_stats = summarize_phases(processing_status['file_reports'].values())
+        usage_stats = batch_budget.stats()
+        if usage_stats['batch']['images']:
+            print(f"用量: {usage_stats['batch']['total_tokens']} tokens, 预估费用 ${usage_stats['batch']['cost']:.4f}"
+                  f"（每张 ${usage_stats['cost_per_image']:.4f}），今天累计 ${usage_stats['daily']['cost']:.4f}")
+        if usage_stats['quality_counts'].keys() - {batch_budget.base_quality}:
+            print(f"预算降级: 各质量图片数 {usage_stats['quality_counts']}")
+        if phase_stats['timings']:
+            print("阶段耗时（秒，p50 / p95 / p99）:")
+            for phase, dist in phase_stats['timings'].items():
+                print(f"  {phase:<12} {dist['p50']:>8.3f} / {dist['p95']:>8.3f} / {dist['p99']:>8.3f}")
+        
+    except Exception as e:
+        import traceback
+        error_msg = f"批量处理错误: {str(e)}"
+        print(f"严重错误: {error_msg}")
+        traceback.print_exc()
+        with processing_lock:
+            processing_status['errors'].append(error_msg)
+    finally:
+        with processing_lock:
+            processing_status['is_processing'] = False
+            processing_status['current_file'] = ''
+            processing_status['in_flight'] = 0
+            # 确保total_files被设置
+            if processing_status.get('total_files', 0) == 0 and processing_status.get('errors'):
+                processing_status['total_files'] = 1  # 至少显示有错误
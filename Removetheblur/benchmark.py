@@ -0,0 +1,345 @@
+"""
+本地性能基准测试（不调用API，不产生费用）
+
+用法:
+  python benchmark.py upload          # 上传请求体构建：临时文件 vs 内存流
+  python benchmark.py decode          # 图片加载：全分辨率解码 vs 降采样解码（耗时、峰值内存）
+  python benchmark.py blend           # 分块拼接融合：逐行循环 vs 向量化羽化 vs 多频段（2/6/12 块）
+  python benchmark.py sizes           # 上传数据：缩放到目标尺寸 vs 按宽高比规划尺寸（不放大）的字节数和编码耗时
+  python benchmark.py output          # 输出编码：fast / balanced / size / 渐进式 / WebP 的耗时和字节数，去透明通道新旧写法
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+try:
+    import resource
+except ImportError:  # Windows 无 resource 模块，不统计峰值内存
+    resource = None
+
+import httpx
+import numpy as np
+from PIL import Image
+
+
+def make_test_image(size=(1024, 1536), seed: int = 0) -> Image.Image:
+    """生成接近照片内容的测试图（平滑渐变 + 噪声，PNG 压缩率接近真实照片）"""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    base = np.stack([
+        128 + 100 * np.sin(xx / 97.0) * np.cos(yy / 131.0),
+        128 + 100 * np.sin((xx + yy) / 173.0),
+        128 + 100 * np.cos(xx / 61.0 - yy / 89.0),
+    ], axis=-1)
+    noise = rng.normal(0, 12, size=base.shape)
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8), 'RGB')
+
+
+def _drain(request: httpx.Request) -> int:
+    """读完请求体（模拟发送），返回发送的字节数"""
+    return sum(len(chunk) for chunk in request.stream)
+
+
+def _build_request(file_obj) -> httpx.Request:
+    files = {
+        'image[]': ('image.png', file_obj, 'image/png'),
+        'model': (None, 'gpt-image-1'),
+        'prompt': (None, 'benchmark'),
+        'size': (None, '1024x1536'),
+    }
+    return httpx.Request('POST', 'https://example.invalid/v1/images/edits', files=files)
+
+
+def bench_upload(rounds: int):
+    """对比旧路径（BytesIO -> 临时文件 -> 重新打开）与新路径（直接从 BytesIO 流式上传）"""
+    image = make_test_image()
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format='PNG')
+    payload_size = image_bytes.getbuffer().nbytes
+    print(f"测试图片: 1024×1536 PNG, {payload_size} 字节, 每种方式 {rounds} 轮")
+
+    # 旧路径：getvalue() 复制一次 + 写盘一次 + 从磁盘读回一次
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        image_bytes.seek(0)
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.png', delete=False) as tmp_file:
+            tmp_file.write(image_bytes.getvalue())
+            tmp_file_path = tmp_file.name
+        try:
+            with open(tmp_file_path, 'rb') as image_file:
+                _drain(_build_request(image_file))
+        finally:
+            os.unlink(tmp_file_path)
+    old_time = (time.perf_counter() - t0) / rounds
+    old_copied = payload_size * 3
+
+    # 新路径：httpx 直接分块读取内存中的 BytesIO
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        image_bytes.seek(0)
+        _drain(_build_request(image_bytes))
+    new_time = (time.perf_counter() - t0) / rounds
+    new_copied = payload_size
+
+    print(f"{'方式':<16}{'每张耗时(ms)':>14}{'复制字节':>14}{'临时文件':>10}")
+    print(f"{'临时文件':<16}{old_time * 1000:>14.2f}{old_copied:>14}{'1':>10}")
+    print(f"{'内存流':<16}{new_time * 1000:>14.2f}{new_copied:>14}{'0':>10}")
+    print(f"每张节省: {(old_time - new_time) * 1000:.2f} ms, 少复制 {old_copied - new_copied} 字节")
+
+
+def _decode_once(path: str, target_size, reducing_gap: float):
+    """加载并缩放到目标尺寸（reducing_gap=0 即全分辨率解码），返回解码尺寸"""
+    from image_utils import load_image, resize_image_smart
+    image = load_image(path, target_size, reducing_gap=reducing_gap)
+    decoded_size = image.size
+    resize_image_smart(image, target_size, method='lanczos')
+    return decoded_size
+
+
+def _peak_rss_mb():
+    """本进程峰值内存（RSS），单位 MB；不支持的平台返回 None"""
+    try:
+        # Linux: VmHWM 随 exec 重置（ru_maxrss 会继承父进程的峰值）
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 单位为字节，其余为 KB
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def _decode_peak_rss(path: str, target_size, reducing_gap: float, result_queue):
+    """子进程中执行一次，返回峰值内存（RSS）增量，单位 MB"""
+    warnings.simplefilter('ignore')
+    from image_utils import load_image, resize_image_smart  # noqa: F401  导入开销不计入
+    before = _peak_rss_mb()
+    _decode_once(path, target_size, reducing_gap)
+    after = _peak_rss_mb()
+    result_queue.put(None if before is None else after - before)
+
+
+def _measure_peak_rss(path: str, target_size, reducing_gap: float):
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.Queue()
+    process = ctx.Process(target=_decode_peak_rss, args=(path, target_size, reducing_gap, result_queue))
+    process.start()
+    peak = result_queue.get()
+    process.join()
+    return peak
+
+
+def bench_decode(rounds: int, size, reducing_gap: float):
+    """对比全分辨率解码后缩放与降采样解码（JPEG draft + reduce）后缩放：AI处理、快速缩放和页面预览的典型目标尺寸"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'source.jpg')
+        make_test_image(size).save(path, format='JPEG', quality=92)
+        print(f"测试图片: {size[0]}×{size[1]} JPEG, {os.path.getsize(path)} 字节, "
+              f"reducing_gap={reducing_gap}, 每种方式 {rounds} 轮")
+        if _peak_rss_mb() is None:
+            print("当前平台不支持统计峰值内存")
+
+        targets = [
+            ('AI处理/快速缩放', (1024, 1536)),
+            ('页面预览', (1067, 1600)),
+            ('缩略图', (160, 240)),
+        ]
+        print(f"{'场景':<14}{'方式':<10}{'解码尺寸':>14}{'每张耗时(ms)':>14}{'峰值内存(MB)':>14}")
+        for label, target_size in targets:
+            rows = []
+            for name, gap in (('全分辨率', 0), ('降采样', reducing_gap)):
+                decoded_size = _decode_once(path, target_size, gap)
+                t0 = time.perf_counter()
+                for _ in range(rounds):
+                    _decode_once(path, target_size, gap)
+                elapsed = (time.perf_counter() - t0) / rounds
+                peak = _measure_peak_rss(path, target_size, gap)
+                rows.append((elapsed, peak))
+                peak_text = f"{peak:.1f}" if peak is not None else '-'
+                print(f"{label:<14}{name:<10}{f'{decoded_size[0]}x{decoded_size[1]}':>14}"
+                      f"{elapsed * 1000:>14.1f}{peak_text:>14}")
+            (full_time, full_peak), (reduced_time, reduced_peak) = rows
+            summary = f"  → 耗时 {full_time / max(reduced_time, 1e-9):.1f}x"
+            if full_peak is not None and reduced_peak is not None:
+                summary += f"，峰值内存少 {full_peak - reduced_peak:.1f} MB"
+            print(summary)
+
+
+def _blend_rows_reference(tiles, canvas_size, boxes):
+    """对照：旧写法的逐行 Python 循环羽化（每行单独计算权重并累加）"""
+    from blending import box_overlaps, _ramp
+    width, height = canvas_size
+    accum = np.zeros((height, width, 3), dtype=np.float32)
+    weight_sum = np.zeros((height, width, 1), dtype=np.float32)
+    for tile, (left, top, right, bottom), (left_ov, right_ov, top_ov, bottom_ov) in zip(
+            tiles, boxes, box_overlaps(boxes)):
+        array = np.asarray(tile, dtype=np.float32)
+        ramp_x = _ramp(right - left, left_ov, right_ov)
+        ramp_y = _ramp(bottom - top, top_ov, bottom_ov)
+        for row in range(bottom - top):
+            weight = (ramp_y[row] * ramp_x)[:, None]
+            accum[top + row, left:right] += array[row] * weight
+            weight_sum[top + row, left:right] += weight
+    merged = accum / np.maximum(weight_sum, 1e-6)
+    return Image.fromarray(np.clip(merged + 0.5, 0, 255).astype(np.uint8), 'RGB')
+
+
+def bench_blend(rounds: int, size, overlap: int):
+    """2/6/12 块布局下对比逐行循环羽化、向量化羽化和多频段融合（掩码预计算耗时单独统计）"""
+    from blending import TileBlender
+    from tiling import plan_tiles, split_tiles
+    canvas = make_test_image(size)
+    print(f"画布: {size[0]}×{size[1]}, 重叠 {overlap}px, 每种方式 {rounds} 轮")
+    print(f"{'布局':<10}{'方式':<12}{'掩码预计算(ms)':>16}{'每张融合(ms)':>14}{'最大误差':>10}")
+    reference = np.asarray(canvas, dtype=np.int16)
+    for grid in ((1, 2), (2, 3), (3, 4)):
+        plan = plan_tiles(size, grid=grid, overlap=overlap)
+        tiles = split_tiles(canvas, plan)
+        label = f"{len(plan)}块({grid[0]}x{grid[1]})"
+
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            merged = _blend_rows_reference(tiles, size, plan.boxes)
+        elapsed = (time.perf_counter() - t0) / rounds
+        error = int(np.abs(np.asarray(merged, dtype=np.int16) - reference).max())
+        print(f"{label:<10}{'逐行循环':<12}{'-':>16}{elapsed * 1000:>14.1f}{error:>10}")
+
+        for method in ('feather', 'multiband'):
+            t0 = time.perf_counter()
+            blender = TileBlender(size, plan.boxes, method)
+            prepare = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                merged = blender.blend(tiles)
+            elapsed = (time.perf_counter() - t0) / rounds
+            error = int(np.abs(np.asarray(merged, dtype=np.int16) - reference).max())
+            name = method if not blender.levels else f"{method}({blender.levels}层)"
+            print(f"{label:<10}{name:<12}{prepare * 1000:>16.1f}{elapsed * 1000:>14.1f}{error:>10}")
+    print("最大误差: 分块未经编辑时融合结果与原图的最大像素差（0 表示无损重建）")
+
+
+def bench_sizes(rounds: int, target_size):
+    """不同尺寸/宽高比的输入：直接缩放到目标尺寸上传 vs 按宽高比选择接口尺寸且不放大（size_plan）"""
+    from image_utils import resize_image_smart
+    from size_plan import plan_request
+    from upload_encoder import UploadEncoder
+    encoder = UploadEncoder()
+    print(f"目标尺寸: {target_size[0]}×{target_size[1]}, 上传编码: {encoder.mode}, 每种方式 {rounds} 轮")
+    print(f"{'输入':<12}{'方式':<10}{'上传尺寸':<12}{'接口尺寸':<12}{'缩放+编码(ms)':>14}{'上传字节':>12}")
+
+    def measure(image, size):
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            resized = image if image.size == size else resize_image_smart(image, size)
+            nbytes = encoder.encode(resized)[0].getbuffer().nbytes
+        return (time.perf_counter() - t0) / rounds, nbytes
+
+    for size in ((600, 900), (800, 800), (1200, 900), (2000, 3000), (3000, 2000)):
+        image = make_test_image(size, seed=size[0])
+        label = f"{size[0]}×{size[1]}"
+        plan = plan_request(size, target_size)
+        for name, upload, api in (('缩放', target_size, target_size), ('规划', plan.upload_size, plan.api_size)):
+            elapsed, nbytes = measure(image, tuple(upload))
+            print(f"{label:<12}{name:<10}{f'{upload[0]}×{upload[1]}':<12}{f'{api[0]}×{api[1]}':<12}"
+                  f"{elapsed * 1000:>14.1f}{nbytes:>12}")
+
+
+def _flatten_reference(image: Image.Image) -> Image.Image:
+    """对照：旧写法的去透明通道（新建白色画布 + split() 复制透明通道作掩码）"""
+    rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+    rgb_image.paste(image, mask=image.split()[3])
+    return rgb_image
+
+
+def bench_output(rounds: int, size):
+    """输出编码方案的耗时和字节数，以及 RGBA 结果去透明通道的耗时"""
+    from config import OUTPUT_QUALITY, OUTPUT_TARGET_KB
+    from image_utils import encode_output, flatten_alpha
+    image = make_test_image(size)
+    print(f"图片: {size[0]}×{size[1]}, 质量 {OUTPUT_QUALITY}, size 方案预算 {OUTPUT_TARGET_KB} KB, 每种方式 {rounds} 轮")
+    print(f"{'方式':<22}{'质量':>6}{'编码次数':>10}{'耗时(ms)':>10}{'字节':>10}")
+    cases = (
+        ('JPEG balanced(原行为)', 'JPEG', 'balanced', False),
+        ('JPEG fast', 'JPEG', 'fast', False),
+        ('JPEG size', 'JPEG', 'size', False),
+        ('JPEG balanced 渐进式', 'JPEG', 'balanced', True),
+        ('WebP fast', 'WEBP', 'fast', False),
+        ('WebP balanced', 'WEBP', 'balanced', False),
+    )
+    for label, pil_format, profile, progressive in cases:
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            data, info = encode_output(image, pil_format, profile=profile, progressive=progressive)
+        elapsed = (time.perf_counter() - t0) / rounds
+        print(f"{label:<22}{info['quality']:>6}{info['attempts']:>10}{elapsed * 1000:>10.1f}{len(data):>10}")
+
+    alpha = np.asarray(image.convert('RGBA')).copy()
+    opaque = Image.fromarray(alpha, 'RGBA')
+    alpha[..., 3] = np.linspace(0, 255, size[0], dtype=np.uint8)[None, :]
+    translucent = Image.fromarray(alpha, 'RGBA')
+    print(f"{'去透明通道':<22}{'旧写法(ms)':>12}{'新写法(ms)':>12}{'最大误差':>10}")
+    for label, rgba in (('全不透明 RGBA', opaque), ('半透明 RGBA', translucent)):
+        timings = []
+        for flatten in (_flatten_reference, flatten_alpha):
+            t0 = time.perf_counter()
+            for _ in range(rounds * 5):
+                flat = flatten(rgba)
+            timings.append((time.perf_counter() - t0) / (rounds * 5))
+        error = int(np.abs(np.asarray(flat, dtype=np.int16) - np.asarray(_flatten_reference(rgba), dtype=np.int16)).max())
+        print(f"{label:<22}{timings[0] * 1000:>12.1f}{timings[1] * 1000:>12.1f}{error:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地性能基准测试（不调用API）")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_upload = sub.add_parser('upload', help='上传请求体构建：临时文件 vs 内存流')
+    p_upload.add_argument('-n', '--rounds', type=int, default=20)
+
+    p_decode = sub.add_parser('decode', help='图片加载：全分辨率解码 vs 降采样解码')
+    p_decode.add_argument('-n', '--rounds', type=int, default=5)
+    p_decode.add_argument('--size', type=int, nargs=2, default=(4000, 6000), metavar=('W', 'H'),
+                          help='测试图片尺寸，默认4000 6000（2400万像素）')
+    p_decode.add_argument('--gap', type=float, default=None,
+                          help='reducing_gap，默认使用 DECODE_REDUCING_GAP')
+
+    p_blend = sub.add_parser('blend', help='分块拼接融合：逐行循环 vs 向量化羽化 vs 多频段')
+    p_blend.add_argument('-n', '--rounds', type=int, default=3)
+    p_blend.add_argument('--size', type=int, nargs=2, default=(2160, 3240), metavar=('W', 'H'))
+    p_blend.add_argument('--overlap', type=int, default=None, help='重叠像素，默认使用 TILE_OVERLAP')
+
+    p_sizes = sub.add_parser('sizes', help='上传数据：缩放到目标尺寸 vs 按宽高比规划尺寸')
+    p_sizes.add_argument('-n', '--rounds', type=int, default=3)
+    p_sizes.add_argument('--target', type=int, nargs=2, default=(1024, 1536), metavar=('W', 'H'))
+
+    p_output = sub.add_parser('output', help='输出编码：各编码方案的耗时和字节数，去透明通道新旧写法')
+    p_output.add_argument('-n', '--rounds', type=int, default=3)
+    p_output.add_argument('--size', type=int, nargs=2, default=(1024, 1536), metavar=('W', 'H'))
+
+    args = parser.parse_args()
+    if args.command == 'upload':
+        bench_upload(args.rounds)
+    elif args.command == 'decode':
+        from config import DECODE_REDUCING_GAP
+        bench_decode(args.rounds, tuple(args.size), args.gap if args.gap is not None else DECODE_REDUCING_GAP)
+    elif args.command == 'blend':
+        from config import TILE_OVERLAP
+        bench_blend(args.rounds, tuple(args.size), TILE_OVERLAP if args.overlap is None else args.overlap)
+    elif args.command == 'sizes':
+        bench_sizes(args.rounds, tuple(args.target))
+    elif args.command == 'output':
+        bench_output(args.rounds, tuple(args.size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+"""
+分块拼接融合（纯 NumPy 向量化）
+给定画布尺寸和互相重叠的分块区域，预先计算每块的归一化权重掩码（同一分块布局只计算一次，按布局缓存），
+拼接时每块只做整块的乘加，没有逐行/逐像素的 Python 循环：
+- feather: 重叠区线性羽化
+- multiband: 拉普拉斯金字塔多频段融合（Burt & Adelson）：低频在较宽范围内过渡、高频在接缝附近窄范围过渡，
+             各分块亮度/色调略有差异时看不出接缝，细节也不会因为大范围混合而出现重影；
+             网格布局只在接缝两侧的窄条带上建金字塔（先逐行融合竖向接缝，再融合横向接缝），其余区域直接复制
+"""
+import math
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from config import BLEND_METHOD, BLEND_LEVELS
+
+BLEND_METHODS = ('feather', 'multiband')
+# 多频段融合的最大层数
+MAX_LEVELS = 6
+
+# (left, top, right, bottom)，与 PIL 的 crop box 一致
+Box = Tuple[int, int, int, int]
+
+
+def box_overlaps(boxes: Sequence[Box]) -> List[Tuple[int, int, int, int]]:
+    """每块 (左, 右, 上, 下) 与相邻块的重叠宽度，画布边缘为 0"""
+    result = []
+    for left, top, right, bottom in boxes:
+        left_ov = right_ov = top_ov = bottom_ov = 0
+        for o_left, o_top, o_right, o_bottom in boxes:
+            if o_top < bottom and top < o_bottom:
+                if o_left < left < o_right:
+                    left_ov = max(left_ov, min(o_right, right) - left)
+                if o_left < right < o_right:
+                    right_ov = max(right_ov, right - max(o_left, left))
+            if o_left < right and left < o_right:
+                if o_top < top < o_bottom:
+                    top_ov = max(top_ov, min(o_bottom, bottom) - top)
+                if o_top < bottom < o_bottom:
+                    bottom_ov = max(bottom_ov, bottom - max(o_top, top))
+        result.append((left_ov, right_ov, top_ov, bottom_ov))
+    return result
+
+
+def _ramp(length: int, start_overlap: int, end_overlap: int) -> np.ndarray:
+    """一维羽化权重：两端在重叠区内线性过渡，中间为 1"""
+    weights = np.ones(length, dtype=np.float32)
+    if start_overlap > 0:
+        weights[:start_overlap] = (np.arange(start_overlap, dtype=np.float32) + 0.5) / start_overlap
+    if end_overlap > 0:
+        weights[length - end_overlap:] = np.minimum(
+            weights[length - end_overlap:],
+            (np.arange(end_overlap, 0, -1, dtype=np.float32) - 0.5) / end_overlap
+        )
+    return weights
+
+
+def _normalized_weights(canvas_size: Tuple[int, int], boxes: Sequence[Box],
+                        hard: bool) -> List[np.ndarray]:
+    """
+    每块的权重掩码（分块大小，float32），所有分块在画布上的权重之和为 1
+    hard=True 时为硬切换（接缝在重叠区中线），供多频段融合使用
+    """
+    width, height = canvas_size
+    weights = []
+    for (left, top, right, bottom), (left_ov, right_ov, top_ov, bottom_ov) in zip(boxes, box_overlaps(boxes)):
+        ramp_x = _ramp(right - left, left_ov, right_ov)
+        ramp_y = _ramp(bottom - top, top_ov, bottom_ov)
+        if hard:
+            ramp_x = (ramp_x >= 0.5).astype(np.float32)
+            ramp_y = (ramp_y >= 0.5).astype(np.float32)
+        weights.append(ramp_y[:, None] * ramp_x[None, :])
+    total = np.zeros((height, width), dtype=np.float32)
+    for weight, (left, top, right, bottom) in zip(weights, boxes):
+        total[top:bottom, left:right] += weight
+    for weight, (left, top, right, bottom) in zip(weights, boxes):
+        np.divide(weight, total[top:bottom, left:right], out=weight, where=total[top:bottom, left:right] > 0)
+    return weights
+
+
+def _down(a: np.ndarray) -> np.ndarray:
+    """5 抽头高斯模糊（边缘复制）后隔行隔列采样"""
+    rows = a.shape[0]
+    p = np.pad(a, ((2, 2), (0, 0), (0, 0)), mode='edge')
+    a = (p[0:rows:2] + p[4:rows + 4:2] + 4 * (p[1:rows + 1:2] + p[3:rows + 3:2]) + 6 * p[2:rows + 2:2]) / 16
+    cols = a.shape[1]
+    p = np.pad(a, ((0, 0), (2, 2), (0, 0)), mode='edge')
+    return (p[:, 0:cols:2] + p[:, 4:cols + 4:2] + 4 * (p[:, 1:cols + 1:2] + p[:, 3:cols + 3:2])
+            + 6 * p[:, 2:cols + 2:2]) / 16
+
+
+def _up(a: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    """
+    放大一倍到 shape（复制后做 5 抽头高斯模糊）；按奇偶输出位置分别计算等价的 3 抽头滤波，
+    不在放大后的数组上做模糊
+    """
+    rows, cols = shape
+    p = np.pad(a, ((1, 1), (0, 0), (0, 0)), mode='edge')
+    out = np.empty((2 * a.shape[0],) + a.shape[1:], dtype=np.float32)
+    out[0::2] = (5 * p[:-2] + 10 * p[1:-1] + p[2:]) / 16
+    out[1::2] = (p[:-2] + 10 * p[1:-1] + 5 * p[2:]) / 16
+    p = np.pad(out[:rows], ((0, 0), (1, 1), (0, 0)), mode='edge')
+    out = np.empty((rows, 2 * a.shape[1]) + a.shape[2:], dtype=np.float32)
+    out[:, 0::2] = (5 * p[:, :-2] + 10 * p[:, 1:-1] + p[:, 2:]) / 16
+    out[:, 1::2] = (p[:, :-2] + 10 * p[:, 1:-1] + 5 * p[:, 2:]) / 16
+    return out[:, :cols]
+
+
+def _to_uint8(a: np.ndarray) -> np.ndarray:
+    """四舍五入并截断到 0-255（uint8 数组原样返回）"""
+    if a.dtype == np.uint8:
+        return a
+    return np.clip(a + 0.5, 0, 255).astype(np.uint8)
+
+
+def _blend_pair(a: np.ndarray, b: np.ndarray, offset: int, masks: List[np.ndarray], axis: int) -> np.ndarray:
+    """
+    两块沿 axis 重叠的多频段融合（b 从 offset 开始；各自在条带外的部分复制边缘像素）：
+    两块的掩码之和为 1，结果 = b + Σ 放大(掩码_k × (a - b) 的拉普拉斯第 k 层)，只需一个金字塔
+    """
+    length = offset + b.shape[axis]
+    pad_a = [(0, 0)] * 3
+    pad_b = [(0, 0)] * 3
+    pad_a[axis] = (0, length - a.shape[axis])
+    pad_b[axis] = (offset, 0)
+    b = np.pad(b.astype(np.float32), pad_b, mode='edge')
+    gaussian = np.pad(a.astype(np.float32), pad_a, mode='edge') - b
+    bands = []
+    for mask in masks[:-1]:
+        smaller = _down(gaussian)
+        bands.append((gaussian - _up(smaller, gaussian.shape[:2])) * mask)
+        gaussian = smaller
+    merged = gaussian * masks[-1]
+    for band in reversed(bands):
+        merged = _up(merged, band.shape[:2]) + band
+    return b + merged
+
+
+def _grid_spans(canvas_size: Tuple[int, int],
+                boxes: Sequence[Box]) -> Optional[Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]]:
+    """分块是覆盖画布的规则网格时返回 (各列的 (left, right), 各行的 (top, bottom))，否则返回 None"""
+    cols = sorted({(left, right) for left, _, right, _ in boxes})
+    rows = sorted({(top, bottom) for _, top, _, bottom in boxes})
+    if set(boxes) != {(left, top, right, bottom) for top, bottom in rows for left, right in cols} \
+            or len(boxes) != len(cols) * len(rows):
+        return None
+    for spans, length in ((cols, canvas_size[0]), (rows, canvas_size[1])):
+        if spans[0][0] != 0 or spans[-1][1] != length:
+            return None
+        for (a_start, a_end), (b_start, b_end) in zip(spans, spans[1:]):
+            if not a_start < b_start <= a_end < b_end:
+                return None
+    return cols, rows
+
+
+def _auto_levels(boxes: Sequence[Box]) -> int:
+    """最低频段的过渡宽度（约 2^(层数+1) 像素）不超过重叠宽度"""
+    overlaps = [ov for item in box_overlaps(boxes) for ov in item if ov > 0]
+    if not overlaps:
+        return 1
+    return max(1, min(MAX_LEVELS, int(math.log2(min(overlaps))) - 2))
+
+
+class TileBlender:
+    """
+    某个分块布局的融合器（掩码在构造时预先计算，同一布局的每张图片复用）
+
+    用法:
+        blender = get_blender(canvas_size, boxes, 'multiband')
+        merged = blender.blend(tiles)   # tiles: 与 boxes 对应、大小等于各区域的 RGB 图片或数组
+    """
+
+    def __init__(self, canvas_size: Tuple[int, int], boxes: Sequence[Box],
+                 method: str = 'feather', levels: int = 0):
+        if method not in BLEND_METHODS:
+            raise ValueError(f"未知的融合方式: {method}（可选 {', '.join(BLEND_METHODS)}）")
+        self.canvas_size = tuple(canvas_size)
+        self.boxes = [tuple(box) for box in boxes]
+        self.method = method
+        self.levels = 0
+        self._seams = None
+        if method == 'multiband' and len(self.boxes) > 1:
+            self.levels = levels or _auto_levels(self.boxes)
+            self._prepare_seams()
+            if self._seams is None:
+                self._prepare_multiband()
+        else:
+            self._prepare_feather()
+
+    def _prepare_feather(self):
+        """
+        按所有分块的边界和重叠区边界把画布切成矩形单元：只被一个分块覆盖（权重为 1）的单元直接复制，
+        重叠单元预先取好各分块的权重切片，融合时只在重叠单元做浮点乘加
+        """
+        masks = [weight[:, :, None] for weight in
+                 _normalized_weights(self.canvas_size, self.boxes, hard=False)]
+        xs, ys = {0, self.canvas_size[0]}, {0, self.canvas_size[1]}
+        for (left, top, right, bottom), (left_ov, right_ov, top_ov, bottom_ov) in zip(
+                self.boxes, box_overlaps(self.boxes)):
+            xs.update((left, right, left + left_ov, right - right_ov))
+            ys.update((top, bottom, top + top_ov, bottom - bottom_ov))
+        xs, ys = sorted(xs), sorted(ys)
+        # 单元: (y0, y1, x0, x1, [(分块序号, 分块内行切片, 分块内列切片, 权重切片 或 None 表示直接复制)])
+        self._cells = []
+        for y0, y1 in zip(ys, ys[1:]):
+            for x0, x1 in zip(xs, xs[1:]):
+                parts = []
+                for index, ((left, top, right, bottom), mask) in enumerate(zip(self.boxes, masks)):
+                    if left <= x0 and x1 <= right and top <= y0 and y1 <= bottom:
+                        rows, cols = slice(y0 - top, y1 - top), slice(x0 - left, x1 - left)
+                        weight = mask[rows, cols]
+                        if weight.max() > 0:
+                            parts.append((index, rows, cols, weight))
+                if len(parts) == 1 and parts[0][3].min() == 1.0:
+                    parts = [parts[0][:3] + (None,)]
+                if parts:
+                    self._cells.append((y0, y1, x0, x1, parts))
+
+    def _axis_seams(self, spans: List[Tuple[int, int]], axis: int) -> Optional[List[tuple]]:
+        """
+        沿 axis（1: 左右排列，0: 上下排列）依次重叠的一排分块之间每条接缝的融合条带
+        (起点, 终点, 后一块在条带内的起点, 前一块的掩码金字塔)：
+        重叠区两侧各扩展 2^(层数+1) 像素（同整画布融合时的窗口扩展量），条带外的像素只来自一块，直接复制；
+        相邻接缝的条带互相重叠（分块太窄）时返回 None
+        """
+        margin = 2 ** (self.levels + 1)
+        seams = []
+        for (a_start, a_end), (b_start, b_end) in zip(spans, spans[1:]):
+            start, end = max(a_start, b_start - margin), min(b_end, a_end + margin)
+            if seams and start < seams[-1][1]:
+                return None
+            overlap = a_end - b_start
+            # 硬切换掩码（接缝在重叠区中线），两块在条带上的权重和为 1
+            hard_a = np.zeros(end - start, dtype=np.float32)
+            hard_b = np.zeros(end - start, dtype=np.float32)
+            hard_a[:a_end - start] = _ramp(a_end - start, 0, overlap) >= 0.5
+            hard_b[b_start - start:] = _ramp(end - b_start, overlap, 0) >= 0.5
+            mask = hard_a / (hard_a + hard_b)
+            pyramid = [mask.reshape((1, -1, 1) if axis == 1 else (-1, 1, 1))]
+            for _ in range(self.levels):
+                pyramid.append(_down(pyramid[-1]))
+            seams.append((start, end, b_start - start, pyramid))
+        return seams
+
+    def _prepare_seams(self):
+        """网格布局：预先计算各列之间（竖向）和各行之间（横向）接缝条带的掩码金字塔"""
+        grid = _grid_spans(self.canvas_size, self.boxes)
+        if grid is None:
+            return
+        cols, rows = grid
+        col_seams = self._axis_seams(cols, axis=1)
+        row_seams = self._axis_seams(rows, axis=0)
+        if col_seams is None or row_seams is None:
+            return
+        # 按行、列排列的分块序号
+        order = [[self.boxes.index((left, top, right, bottom)) for left, right in cols] for top, bottom in rows]
+        self._seams = (cols, rows, order, col_seams, row_seams)
+
+    def _row_pieces(self, arrays: List[np.ndarray], seams: List[tuple]) -> List[Tuple[int, int, np.ndarray]]:
+        """
+        一行分块从左到右的片段 (x0, x1, 行高 × 宽度的数组)：只属于一块的部分是该分块的视图（uint8），
+        竖向接缝条带是多频段融合结果（float32）
+        """
+        cols = self._seams[0]
+        pieces = []
+        for index, (array, (left, right)) in enumerate(zip(arrays, cols)):
+            x0 = seams[index - 1][1] if index > 0 else left
+            x1 = seams[index][0] if index < len(seams) else right
+            pieces.append((x0, x1, array[:, x0 - left:x1 - left]))
+            if index < len(seams):
+                start, end, offset, masks = seams[index]
+                b_left = cols[index + 1][0]
+                pieces.append((start, end, _blend_pair(
+                    array[:, start - left:], arrays[index + 1][:, :end - b_left], offset, masks, axis=1)))
+        return pieces
+
+    def _blend_seams(self, arrays: List[np.ndarray]) -> np.ndarray:
+        """网格布局的多频段融合：先逐行融合竖向接缝，再在横向接缝条带上融合相邻两行，返回 uint8 数组"""
+        cols, rows, order, col_seams, row_seams = self._seams
+        width, height = self.canvas_size
+        merged = np.empty((height, width, 3), dtype=np.uint8)
+        row_pieces = [self._row_pieces([arrays[index] for index in indices], col_seams) for indices in order]
+
+        def row_slice(row: int, y0: int, y1: int) -> np.ndarray:
+            top = rows[row][0]
+            return np.concatenate([piece[y0 - top:y1 - top] for _, _, piece in row_pieces[row]],
+                                  axis=1).astype(np.float32)
+
+        for row, ((top, bottom), pieces) in enumerate(zip(rows, row_pieces)):
+            y0 = row_seams[row - 1][1] if row > 0 else top
+            y1 = row_seams[row][0] if row < len(row_seams) else bottom
+            for x0, x1, piece in pieces:
+                merged[y0:y1, x0:x1] = _to_uint8(piece[y0 - top:y1 - top])
+        for row, (start, end, offset, masks) in enumerate(row_seams):
+            merged[start:end] = _to_uint8(_blend_pair(
+                row_slice(row, start, rows[row][1]), row_slice(row + 1, rows[row + 1][0], end), offset, masks, axis=0))
+        return merged
+
+    def _prepare_multiband(self):
+        """每块的融合窗口（分块区域向外扩展并按 2^层数 对齐）和各层的掩码（已按各层权重和归一化）"""
+        width, height = self.canvas_size
+        levels = self.levels
+        align = 2 ** levels
+        pad = 2 ** (levels + 1)
+        self._shapes = [(math.ceil(height / 2 ** k), math.ceil(width / 2 ** k)) for k in range(levels + 1)]
+        self._windows = []
+        self._mask_pyramids = []
+        weight_sums = [np.zeros(shape + (1,), dtype=np.float32) for shape in self._shapes]
+        for weight, (left, top, right, bottom) in zip(
+                _normalized_weights(self.canvas_size, self.boxes, hard=True), self.boxes):
+            x0 = max(0, (left - pad) // align * align)
+            y0 = max(0, (top - pad) // align * align)
+            x1 = min(width, math.ceil((right + pad) / align) * align)
+            y1 = min(height, math.ceil((bottom + pad) / align) * align)
+            mask = np.zeros((y1 - y0, x1 - x0, 1), dtype=np.float32)
+            mask[top - y0:bottom - y0, left - x0:right - x0, 0] = weight
+            pyramid = [mask]
+            for _ in range(levels):
+                pyramid.append(_down(pyramid[-1]))
+            for k, level_mask in enumerate(pyramid):
+                ys, xs = y0 >> k, x0 >> k
+                weight_sums[k][ys:ys + level_mask.shape[0], xs:xs + level_mask.shape[1]] += level_mask
+            self._windows.append((x0, y0, x1, y1))
+            self._mask_pyramids.append(pyramid)
+        # 归一化合并进掩码：融合时不再逐层除以权重和
+        for (x0, y0, _, _), pyramid in zip(self._windows, self._mask_pyramids):
+            for k, level_mask in enumerate(pyramid):
+                ys, xs = y0 >> k, x0 >> k
+                total = weight_sums[k][ys:ys + level_mask.shape[0], xs:xs + level_mask.shape[1]]
+                np.divide(level_mask, total, out=level_mask, where=total > 1e-6)
+
+    @staticmethod
+    def _as_array(tile, box: Box) -> np.ndarray:
+        size = (box[2] - box[0], box[3] - box[1])
+        if isinstance(tile, Image.Image):
+            if tile.mode != 'RGB':
+                tile = tile.convert('RGB')
+            if tile.size != size:
+                tile = tile.resize(size, Image.Resampling.LANCZOS)
+            tile = np.asarray(tile)
+        if tile.shape[:2] != (size[1], size[0]):
+            raise ValueError(f"分块尺寸 {tile.shape[1]}x{tile.shape[0]} 与区域 {size[0]}x{size[1]} 不一致")
+        return tile
+
+    def blend(self, tiles) -> Image.Image:
+        """融合各分块，返回画布尺寸的 RGB 图片"""
+        arrays = [self._as_array(tile, box) for tile, box in zip(tiles, self.boxes)]
+        if len(arrays) != len(self.boxes):
+            raise ValueError(f"需要 {len(self.boxes)} 个分块，但提供了 {len(arrays)} 个")
+        if self._seams is not None:
+            return Image.fromarray(self._blend_seams(arrays), 'RGB')
+        if self.levels:
+            return Image.fromarray(_to_uint8(self._blend_multiband(arrays)), 'RGB')
+        return Image.fromarray(self._blend_feather(arrays), 'RGB')
+
+    def _blend_feather(self, arrays: List[np.ndarray]) -> np.ndarray:
+        width, height = self.canvas_size
+        merged = np.zeros((height, width, 3), dtype=np.uint8)
+        for y0, y1, x0, x1, parts in self._cells:
+            index, rows, cols, weight = parts[0]
+            if weight is None:
+                merged[y0:y1, x0:x1] = arrays[index][rows, cols]
+                continue
+            cell = arrays[index][rows, cols] * weight
+            for index, rows, cols, weight in parts[1:]:
+                cell += arrays[index][rows, cols] * weight
+            # 权重和为 1：结果在 0-255 之间，+0.5 后截断即四舍五入
+            merged[y0:y1, x0:x1] = cell + 0.5
+        return merged
+
+    def _blend_multiband(self, arrays: List[np.ndarray]) -> np.ndarray:
+        levels = self.levels
+        accum = [np.zeros(shape + (3,), dtype=np.float32) for shape in self._shapes]
+        for array, (x0, y0, x1, y1), masks, (left, top, right, bottom) in zip(
+                arrays, self._windows, self._mask_pyramids, self.boxes):
+            # 窗口中分块以外的部分复制边缘像素（掩码在那里接近 0，只影响最低频段的少量权重）
+            window = np.pad(array.astype(np.float32),
+                            ((top - y0, y1 - bottom), (left - x0, x1 - right), (0, 0)), mode='edge')
+            gaussian = window
+            for k in range(levels + 1):
+                if k < levels:
+                    smaller = _down(gaussian)
+                    band = gaussian - _up(smaller, gaussian.shape[:2])
+                else:
+                    smaller, band = None, gaussian
+                ys, xs = y0 >> k, x0 >> k
+                accum[k][ys:ys + band.shape[0], xs:xs + band.shape[1]] += band * masks[k]
+                gaussian = smaller
+        merged = accum[levels]
+        for k in range(levels - 1, -1, -1):
+            merged = _up(merged, self._shapes[k]) + accum[k]
+        return merged
+
+
+@lru_cache(maxsize=4)
+def _cached_blender(canvas_size: Tuple[int, int], boxes: Tuple[Box, ...], method: str, levels: int) -> TileBlender:
+    return TileBlender(canvas_size, boxes, method, levels)
+
+
+def get_blender(canvas_size: Tuple[int, int], boxes: Sequence[Box],
+                method: str = None, levels: int = None) -> TileBlender:
+    """获取分块布局的融合器（按布局缓存，批处理中同一目标尺寸的图片共用预先计算的掩码）"""
+    return _cached_blender(tuple(canvas_size), tuple(tuple(box) for box in boxes),
+                           method or BLEND_METHOD, BLEND_LEVELS if levels is None else levels)
+
+
+def blend_tiles(tiles, canvas_size: Tuple[int, int], boxes: Sequence[Box],
+                method: str = None, levels: int = None) -> Image.Image:
+    """
+    融合互相重叠的分块
+
+    Args:
+        tiles: 分块（PIL 图片或 HxWx3 uint8 数组，大小与区域不一致的 PIL 图片会先缩放到区域大小）
+        canvas_size: 画布尺寸 (width, height)，各区域应覆盖整个画布
+        boxes: 各分块在画布上的区域 (left, top, right, bottom)
+        method: feather / multiband，默认 BLEND_METHOD
+        levels: 多频段融合层数，0 表示按重叠宽度自动选择，默认 BLEND_LEVELS
+    """
+    return get_blender(canvas_size, boxes, method, levels).blend(tiles)
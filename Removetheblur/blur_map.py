@@ -0,0 +1,153 @@
+"""
+局部模糊检测（纯 NumPy 向量化）
+把图片缩小到分析尺寸后按块计算清晰度（拉普拉斯方差或梯度能量）和粗尺度边缘强度（纹理），
+有纹理、但细节能量相对其边缘强度偏低的块为模糊块；平坦区域（天空、墙面、纯色背景）没有可恢复的细节，
+不算模糊。分块处理时据此判断哪些分块需要AI处理：已经清晰的分块（如主体）不发送，直接使用原图，
+只为模糊的区域（如虚化的背景）付出API调用的延迟和费用
+"""
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from config import (
+    BLUR_METRIC, BLUR_BLOCK, BLUR_ANALYSIS_SIDE, BLUR_THRESHOLD_RATIO, BLUR_TEXTURE_MIN,
+    BLUR_TILE_FRACTION
+)
+
+BLUR_METRICS = ('laplacian', 'gradient')
+# 纹理（粗尺度边缘强度）在分析尺寸再缩小该倍数后计算：失焦只抹掉细尺度的细节，边缘在粗尺度上仍然存在
+TEXTURE_SCALE = 4
+
+
+def _block_reduce(values: np.ndarray, block: int) -> np.ndarray:
+    """按 block×block 求均值（边缘不足一块的部分复制边缘补齐）"""
+    height, width = values.shape
+    rows, cols = -(-height // block), -(-width // block)
+    values = np.pad(values, ((0, rows * block - height), (0, cols * block - width)), mode='edge')
+    return values.reshape(rows, block, cols, block).mean(axis=(1, 3))
+
+
+def _analysis_gray(image: Image.Image, analysis_side: int = None) -> Image.Image:
+    """灰度图，最长边大于 analysis_side（默认 BLUR_ANALYSIS_SIDE）时缩小"""
+    analysis_side = analysis_side or BLUR_ANALYSIS_SIDE
+    gray = image.convert('L')
+    scale = analysis_side / max(gray.size)
+    if scale < 1:
+        gray = gray.resize((max(1, round(gray.size[0] * scale)), max(1, round(gray.size[1] * scale))),
+                           Image.Resampling.BOX)
+    return gray
+
+
+def sharpness_map(image: Image.Image, metric: str = None, block: int = None,
+                  analysis_side: int = None) -> np.ndarray:
+    """
+    每块的清晰度
+
+    Args:
+        image: 图片
+        metric: laplacian（拉普拉斯方差）/ gradient（梯度能量），默认 BLUR_METRIC
+        block: 块大小（分析尺寸下的像素），默认 BLUR_BLOCK
+        analysis_side: 分析尺寸的最长边（更大的图片先缩小），默认 BLUR_ANALYSIS_SIDE
+
+    Returns:
+        float32 数组 [行, 列]，数值越大越清晰
+    """
+    metric = (metric or BLUR_METRIC).strip().lower()
+    if metric not in BLUR_METRICS:
+        raise ValueError(f"BLUR_METRIC 无效: {metric}（可选: {', '.join(BLUR_METRICS)}）")
+    block = block or BLUR_BLOCK
+    g = np.asarray(_analysis_gray(image, analysis_side), dtype=np.float32)
+    if min(g.shape) < 3:
+        return np.zeros((1, 1), dtype=np.float32)
+    if metric == 'laplacian':
+        lap = g[1:-1, :-2] + g[1:-1, 2:] + g[:-2, 1:-1] + g[2:, 1:-1] - 4 * g[1:-1, 1:-1]
+        lap = np.pad(lap, 1, mode='edge')
+        # 块内方差 = E[x²] - E[x]²
+        mean = _block_reduce(lap, block)
+        return np.maximum(_block_reduce(lap * lap, block) - mean * mean, 0).astype(np.float32)
+    gx = np.pad(np.diff(g, axis=1), ((0, 0), (0, 1)), mode='edge')
+    gy = np.pad(np.diff(g, axis=0), ((0, 1), (0, 0)), mode='edge')
+    return _block_reduce(gx * gx + gy * gy, block).astype(np.float32)
+
+
+def texture_map(image: Image.Image, block: int = None, analysis_side: int = None) -> np.ndarray:
+    """
+    每块的纹理：粗尺度（分析尺寸再缩小 TEXTURE_SCALE 倍）的平均梯度幅值，单位为灰度级/粗尺度像素；
+    与 sharpness_map 的分块一一对应。模糊不会明显降低它，平坦区域接近 0
+
+    Returns:
+        float32 数组 [行, 列]
+    """
+    block = block or BLUR_BLOCK
+    gray = _analysis_gray(image, analysis_side)
+    width, height = gray.size
+    if min(width, height) < 3:
+        return np.zeros((1, 1), dtype=np.float32)
+    if min(width, height) < 2 * TEXTURE_SCALE:
+        return np.zeros((-(-height // block), -(-width // block)), dtype=np.float32)
+    coarse = np.asarray(gray.reduce(TEXTURE_SCALE), dtype=np.float32)
+    gx = np.abs(np.pad(np.diff(coarse, axis=1), ((0, 0), (0, 1)), mode='edge'))
+    gy = np.abs(np.pad(np.diff(coarse, axis=0), ((0, 1), (0, 0)), mode='edge'))
+    edges = np.maximum(gx, gy)
+    # 放回分析尺寸，按与清晰度相同的分块求均值
+    scale = -(-height // coarse.shape[0])
+    edges = np.repeat(np.repeat(edges, scale, axis=0), scale, axis=1)[:height, :width]
+    edges = np.pad(edges, ((0, height - edges.shape[0]), (0, width - edges.shape[1])), mode='edge')
+    return _block_reduce(edges, block).astype(np.float32)
+
+
+def textured_blocks(texture: np.ndarray, texture_min: float = None) -> np.ndarray:
+    """有纹理的块（粗尺度边缘强度不低于 texture_min，默认 BLUR_TEXTURE_MIN）；其余为平坦块"""
+    return texture >= (BLUR_TEXTURE_MIN if texture_min is None else texture_min)
+
+
+def blurry_blocks(sharpness: np.ndarray, texture: np.ndarray, threshold_ratio: float = None,
+                  texture_min: float = None) -> np.ndarray:
+    """
+    模糊块掩码：有纹理、且细节强度（清晰度开方）低于该块粗尺度边缘强度 threshold_ratio 倍的块
+    （默认 BLUR_THRESHOLD_RATIO；按块自身的边缘强度归一，不与图中其他区域比较，
+    细节较少但清晰的区域不会被判为模糊）；平坦块不算模糊
+    """
+    threshold_ratio = BLUR_THRESHOLD_RATIO if threshold_ratio is None else threshold_ratio
+    return textured_blocks(texture, texture_min) & (np.sqrt(sharpness) < texture * threshold_ratio)
+
+
+class BlurMap:
+    """一张图片的模糊块掩码，可查询画布上任意矩形区域中模糊块的占比（积分图，每次查询 O(1)）"""
+
+    def __init__(self, image: Image.Image, canvas_size: Optional[Tuple[int, int]] = None):
+        """
+        Args:
+            image: 图片
+            canvas_size: 查询时使用的坐标系尺寸，默认为图片尺寸
+        """
+        self.canvas_size = tuple(canvas_size or image.size)
+        self.sharpness = sharpness_map(image)
+        self.texture = texture_map(image)
+        self.blurry = blurry_blocks(self.sharpness, self.texture)
+        rows, cols = self.blurry.shape
+        self._integral = np.zeros((rows + 1, cols + 1), dtype=np.int64)
+        self._integral[1:, 1:] = self.blurry.cumsum(axis=0).cumsum(axis=1)
+
+    @property
+    def blurry_fraction(self) -> float:
+        return float(self.blurry.mean())
+
+    def fraction(self, box: Tuple[int, int, int, int]) -> float:
+        """区域 (left, top, right, bottom)（画布坐标）内模糊块的占比"""
+        rows, cols = self.blurry.shape
+        width, height = self.canvas_size
+        left, top, right, bottom = box
+        c0 = min(cols - 1, int(left * cols / width))
+        c1 = max(c0 + 1, min(cols, -(-right * cols // width)))
+        r0 = min(rows - 1, int(top * rows / height))
+        r1 = max(r0 + 1, min(rows, -(-bottom * rows // height)))
+        count = (self._integral[r1, c1] - self._integral[r0, c1]
+                 - self._integral[r1, c0] + self._integral[r0, c0])
+        return float(count) / ((r1 - r0) * (c1 - c0))
+
+    def select(self, boxes: Sequence[Tuple[int, int, int, int]], min_fraction: float = None) -> List[bool]:
+        """各区域是否需要AI处理（模糊块占比超过 min_fraction，默认 BLUR_TILE_FRACTION）"""
+        min_fraction = BLUR_TILE_FRACTION if min_fraction is None else min_fraction
+        return [self.fraction(box) > min_fraction for box in boxes]
@@ -9,13 +9,178 @@ load_dotenv()
 
 # OpenAI API配置
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+API_BASE_URL = os.getenv("API_BASE_URL", "https://api.qidianai.xyz").strip()
+
+# 多后端负载均衡（JSON数组，每项 base_url/api_key/weight/max_concurrency/rpm/name，
+# 未配置时使用 API_BASE_URL + OPENAI_API_KEY 作为唯一后端）
+API_BACKENDS = os.getenv("API_BACKENDS", "").strip()
+# 路由方式: least_outstanding（最少在途请求）/ latency（按延迟加权）
+API_ROUTING = os.getenv("API_ROUTING", "least_outstanding").strip().lower()
+# 后端摘除：连续N次计入的错误后摘除的秒数（探测失败时翻倍），计入摘除的错误类别
+BACKEND_EJECT_THRESHOLD = int(os.getenv("BACKEND_EJECT_THRESHOLD", "3"))
+BACKEND_EJECT_SECONDS = float(os.getenv("BACKEND_EJECT_SECONDS", "60"))
+BACKEND_EJECT_ON = [
+    kind.strip() for kind in
+    os.getenv("BACKEND_EJECT_ON", "auth,connect,timeout,network,server").split(",")
+    if kind.strip()
+]
+
+# 编辑后端: http（调用远程编辑接口）/ local（本地确定性处理，不需要API密钥，用于离线压测）
+EDIT_BACKEND = os.getenv("EDIT_BACKEND", "http").strip().lower()
+# 本地后端：模拟服务端推理的延迟秒数、处理方式（sharpen / passthrough）
+LOCAL_EDIT_LATENCY = float(os.getenv("LOCAL_EDIT_LATENCY", "0"))
+LOCAL_EDIT_FILTER = os.getenv("LOCAL_EDIT_FILTER", "sharpen").strip().lower()
 
 # 图片处理配置
 MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", "2048"))
 OUTPUT_QUALITY = int(os.getenv("OUTPUT_QUALITY", "95"))
+# 输出编码：fast（不做哈夫曼表优化，最快）/ balanced（optimize，像素相同、体积约小 5%）/
+# size（二分查找质量，使文件不超过 OUTPUT_TARGET_KB，质量不低于 OUTPUT_MIN_QUALITY）
+OUTPUT_PROFILE = os.getenv("OUTPUT_PROFILE", "balanced").strip().lower()
+OUTPUT_TARGET_KB = int(os.getenv("OUTPUT_TARGET_KB", "600"))
+OUTPUT_MIN_QUALITY = int(os.getenv("OUTPUT_MIN_QUALITY", "70"))
+# 输出格式（批处理/命令行默认输出文件的扩展名）：jpeg / webp；JPEG 是否渐进式编码
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "jpeg").strip().lower()
+OUTPUT_PROGRESSIVE = os.getenv("OUTPUT_PROGRESSIVE", "0").strip().lower() in {"1", "true", "yes", "on"}
+
+# HTTP连接池配置（所有API请求共用一个长连接池）
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1").strip().lower() in {"1", "true", "yes", "on"}
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "20"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "120"))
+
+# 批量AI处理并发数（同时在途的API请求上限）
+AI_MAX_WORKERS = max(1, int(os.getenv("AI_MAX_WORKERS", "4")))
+# 批处理流水线：准备（加载/缩放/编码）和保存阶段的线程数、段间队列容量（0 表示与并发数相同）
+PIPELINE_PREPARE_WORKERS = max(1, int(os.getenv("PIPELINE_PREPARE_WORKERS", "2")))
+PIPELINE_SAVE_WORKERS = max(1, int(os.getenv("PIPELINE_SAVE_WORKERS", "2")))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "0"))
+
+# 请求尺寸规划：auto 按每张图片自身的宽高比选择最接近的接口尺寸，上传时只缩小不放大，
+# 接口返回后在本地缩放回目标尺寸；off 则上传前直接缩放到目标尺寸
+SIZE_PLAN = os.getenv("SIZE_PLAN", "auto").strip().lower()
+
+# 分块处理：目标尺寸不是接口支持的尺寸（1024x1024 / 1024x1536 / 1536x1024）时，
+# 切成互相重叠的分块分别编辑再拼接（auto），off 则整张发送（请求尺寸见 SIZE_PLAN）
+TILE_MODE = os.getenv("TILE_MODE", "auto").strip().lower()
+# 分块网格（列x行，如 2x2），空则自动选择：接口结果放大不超过 TILE_MAX_UPSCALE 倍的方案中块数最少的
+TILE_GRID = os.getenv("TILE_GRID", "")
+TILE_MAX_UPSCALE = float(os.getenv("TILE_MAX_UPSCALE", "1.15"))
+TILE_MAX_GRID = max(1, int(os.getenv("TILE_MAX_GRID", "4")))
+# 相邻分块的重叠像素（输出画布坐标），重叠区羽化拼接
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", "128"))
+# 同时在途的分块请求数（所有图片共享）
+TILE_MAX_WORKERS = max(1, int(os.getenv("TILE_MAX_WORKERS", "8")))
+# 分块拼接的融合方式：feather（线性羽化，默认）/ multiband（拉普拉斯金字塔多频段融合）；多频段层数，0 表示自动
+BLEND_METHOD = os.getenv("BLEND_METHOD", "feather").strip().lower()
+BLEND_LEVELS = int(os.getenv("BLEND_LEVELS", "0"))
+
+# 局部模糊检测（默认关闭）：分块处理时只发送含模糊区域的分块，清晰的分块直接使用原图；不分块时不生效
+BLUR_SELECT = os.getenv("BLUR_SELECT", "0").strip().lower() in {"1", "true", "yes", "on"}
+# 清晰度指标（laplacian: 拉普拉斯方差 / gradient: 梯度能量）、分析尺寸最长边、块大小（分析尺寸下的像素）
+BLUR_METRIC = os.getenv("BLUR_METRIC", "laplacian").strip().lower()
+BLUR_ANALYSIS_SIDE = int(os.getenv("BLUR_ANALYSIS_SIDE", "1024"))
+BLUR_BLOCK = max(4, int(os.getenv("BLUR_BLOCK", "32")))
+# 平坦块：粗尺度边缘强度（灰度级/像素，分析尺寸缩小4倍后计算）低于该值，不参与模糊判断
+BLUR_TEXTURE_MIN = float(os.getenv("BLUR_TEXTURE_MIN", "6"))
+# 模糊块：有纹理、且细节强度（清晰度开方）低于该块粗尺度边缘强度的该倍数
+BLUR_THRESHOLD_RATIO = float(os.getenv("BLUR_THRESHOLD_RATIO", "0.4" if BLUR_METRIC == "gradient" else "0.25"))
+# 分块中模糊块占比超过该值才发送
+BLUR_TILE_FRACTION = float(os.getenv("BLUR_TILE_FRACTION", "0.1"))
+# 批处理预筛：派发前并行计算每张图片的清晰度得分（有纹理的块的清晰度中位数），达到阈值的图片不调用API
+# off（关闭，默认；阈值按自己的图片校准后再开启）/ skip（跳过，不输出）/ copy（缩放到目标尺寸后直接输出原图）
+PRESCREEN_MODE = os.getenv("PRESCREEN_MODE", "off").strip().lower()
+PRESCREEN_THRESHOLD = float(os.getenv("PRESCREEN_THRESHOLD", "100"))
+# 预筛线程数，0 表示 CPU 核数
+PRESCREEN_WORKERS = int(os.getenv("PRESCREEN_WORKERS", "0"))
+
+# 上传编码配置（编辑接口请求体）
+# UPLOAD_FORMAT: png / webp_lossless / jpeg / webp / auto
+UPLOAD_FORMAT = os.getenv("UPLOAD_FORMAT", "png").strip().lower()
+UPLOAD_PNG_COMPRESS_LEVEL = int(os.getenv("UPLOAD_PNG_COMPRESS_LEVEL", "6"))
+UPLOAD_QUALITY = int(os.getenv("UPLOAD_QUALITY", "95"))
+# auto 模式是否允许选择有损编码（需确认接口接受 JPEG/WebP）
+UPLOAD_ALLOW_LOSSY = os.getenv("UPLOAD_ALLOW_LOSSY", "0").strip().lower() in {"1", "true", "yes", "on"}
+# 尚无实测数据时假设的上传带宽（字节/秒）
+UPLOAD_BANDWIDTH_DEFAULT = float(os.getenv("UPLOAD_BANDWIDTH_DEFAULT", str(1024 * 1024)))
+
+# 请求超时（秒）：连接超时固定且较短；写超时按上传字节数/实测带宽×系数；
+# 读超时 = 最近成功请求服务端耗时的 p99 × 系数（样本不足时用默认值），学习到的数据保存在 CACHE_DIR/timeouts.json
+TIMEOUT_CONNECT = float(os.getenv("TIMEOUT_CONNECT", "10"))
+TIMEOUT_WRITE_MIN = float(os.getenv("TIMEOUT_WRITE_MIN", "15"))
+TIMEOUT_WRITE_MAX = float(os.getenv("TIMEOUT_WRITE_MAX", "300"))
+TIMEOUT_WRITE_FACTOR = float(os.getenv("TIMEOUT_WRITE_FACTOR", "4"))
+TIMEOUT_READ_DEFAULT = float(os.getenv("TIMEOUT_READ_DEFAULT", "300"))
+TIMEOUT_READ_MIN = float(os.getenv("TIMEOUT_READ_MIN", "60"))
+TIMEOUT_READ_MAX = float(os.getenv("TIMEOUT_READ_MAX", "600"))
+TIMEOUT_READ_FACTOR = float(os.getenv("TIMEOUT_READ_FACTOR", "2"))
+# 至少多少个成功样本后才使用学习到的读超时，最多保留多少个样本
+TIMEOUT_MIN_SAMPLES = int(os.getenv("TIMEOUT_MIN_SAMPLES", "10"))
+TIMEOUT_HISTORY = int(os.getenv("TIMEOUT_HISTORY", "200"))
+
+# url 类型结果的下载：内存缓冲上限（MB，超出转存临时文件）、中断后最多续传次数、读超时秒数
+DOWNLOAD_SPOOL_MAX_MB = int(os.getenv("DOWNLOAD_SPOOL_MAX_MB", "16"))
+DOWNLOAD_MAX_RESUMES = int(os.getenv("DOWNLOAD_MAX_RESUMES", "3"))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", "30"))
+# 结果图片的编码格式与输出文件一致时直接写入原始字节（不解码再编码）
+OUTPUT_DIRECT_SAVE = os.getenv("OUTPUT_DIRECT_SAVE", "1").strip().lower() in {"1", "true", "yes", "on"}
+
+# 降采样解码：只需要缩小后的图片时，JPEG 直接按 1/2、1/4、1/8 解码再整数倍缩小，
+# 解码尺寸至少保留目标尺寸的该倍数（再用 Lanczos 缩放到目标尺寸）；0 表示关闭（始终全分辨率解码）
+DECODE_REDUCING_GAP = float(os.getenv("DECODE_REDUCING_GAP", "1.5"))
+# 页面缩略图/预览的默认最长边（/api/image?max=）
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "1600"))
+
+# 本地缓存/状态目录
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+
+# AI编辑结果缓存（相同输入不重复调用API）
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1").strip().lower() in {"1", "true", "yes", "on"}
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "2048"))
+
+# 请求限速（每个后端/密钥单独计算，0 表示不限）
+RATE_LIMIT_RPM = float(os.getenv("RATE_LIMIT_RPM", "0"))
+RATE_LIMIT_MAX_CONCURRENCY = int(os.getenv("RATE_LIMIT_MAX_CONCURRENCY", "0"))
+# 429/503 限流：无 Retry-After 时的初始等待秒数、单次最长等待、最多重试次数
+THROTTLE_DEFAULT_WAIT = float(os.getenv("THROTTLE_DEFAULT_WAIT", "10"))
+THROTTLE_MAX_WAIT = float(os.getenv("THROTTLE_MAX_WAIT", "300"))
+THROTTLE_MAX_RETRIES = int(os.getenv("THROTTLE_MAX_RETRIES", "8"))
+
+# 失败重试：最多请求次数（含第一次）、指数退避的基础/最大等待秒数、可重试的错误类别
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "60"))
+RETRY_ON = [
+    kind.strip() for kind in
+    os.getenv("RETRY_ON", "connect,network,timeout,server,throttle,decode").split(",")
+    if kind.strip()
+]
+
+# 熔断：连续N次系统性错误后熔断，冷却秒数，熔断持续超过该秒数则中止批处理，计入熔断的错误类别
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+CIRCUIT_MAX_PAUSE = float(os.getenv("CIRCUIT_MAX_PAUSE", "600"))
+CIRCUIT_TRIP_ON = [
+    kind.strip() for kind in
+    os.getenv("CIRCUIT_TRIP_ON", "auth,connect").split(",")
+    if kind.strip()
+]
+
+# 费用估算单价（美元 / 百万token），默认按 gpt-image-1 的图片输入/输出价格
+COST_INPUT_PER_1M = float(os.getenv("COST_INPUT_PER_1M", "10"))
+COST_OUTPUT_PER_1M = float(os.getenv("COST_OUTPUT_PER_1M", "40"))
+# 预算（0 表示不限）：每批次/每天的 token 数和预估费用（美元）
+BUDGET_BATCH_TOKENS = int(os.getenv("BUDGET_BATCH_TOKENS", "0"))
+BUDGET_BATCH_COST = float(os.getenv("BUDGET_BATCH_COST", "0"))
+BUDGET_DAILY_TOKENS = int(os.getenv("BUDGET_DAILY_TOKENS", "0"))
+BUDGET_DAILY_COST = float(os.getenv("BUDGET_DAILY_COST", "0"))
+# 预计超出预算时: degrade（逐级降低质量，最低质量也超出则停止）/ pause（每日预算用完时暂停到次日）/ stop（停止派发）
+BUDGET_ACTION = os.getenv("BUDGET_ACTION", "degrade").strip().lower()
+# pause 时最长暂停秒数，超过则停止
+BUDGET_MAX_PAUSE = float(os.getenv("BUDGET_MAX_PAUSE", "86400"))
 
 # 验证配置（只警告，不阻止启动）
-if not OPENAI_API_KEY:
+if EDIT_BACKEND == "http" and not OPENAI_API_KEY and not API_BACKENDS:
     warnings.warn(
         "未配置OPENAI_API_KEY，Web服务可以启动，但无法处理图片。"
         "请在.env文件中设置OPENAI_API_KEY。",
@@ -1,86 +1,373 @@
 """
 背景去模糊Agent主模块 - 使用AI处理
-直接使用目标尺寸处理，不再切分
+按目标尺寸选择处理路径：接口支持的尺寸整张编辑（请求尺寸见 size_plan），其余尺寸分块编辑后拼接（见 tiling）
+单张图片分三个阶段：prepare（加载、缩放、编码）→ edit（调用编辑后端）→ save（编码保存），
+process_image 依次执行；批处理由 pipeline.DeblurPipeline 让不同图片的各阶段重叠执行
+目标尺寸不是接口支持的尺寸（如 2160×3240）时分块处理：切成重叠的接口尺寸分块并发编辑，保存前拼接（见 tiling）；
+开启 BLUR_SELECT 时按局部模糊检测只发送含模糊区域的分块，清晰的分块直接使用原图（见 blur_map）；
+批处理预筛判定已清晰的图片（见 prescreen）可直接输出：缩放到目标尺寸后保存，不调用编辑后端；
+不分块时按图片自身的宽高比选择接口尺寸、上传时不放大，保存前缩放回目标尺寸（见 size_plan）
 """
+import os
+import time
 from PIL import Image
-from typing import Optional, Tuple
+from typing import Callable, List, Optional, Tuple
 from image_utils import (
-    load_image, save_image, resize_image_smart
+    load_image, save_image, resize_image_smart, parse_output_profile
 )
-from gpt_handler import GPTHandler
-from config import OUTPUT_QUALITY
+from edit_backend import EditBackend, create_edit_backend
+from config import (
+    OUTPUT_QUALITY, OUTPUT_PROFILE, OUTPUT_TARGET_KB, OUTPUT_DIRECT_SAVE, TILE_GRID, BLUR_SELECT
+)
+from phase_timing import PhaseTimer
+from tiling import (
+    TilePlan, should_tile, plan_tiles, plan_selected_tiles, parse_grid, split_tiles, merge_tiles,
+    get_tile_executor
+)
+from blending import get_blender
+from blur_map import BlurMap
+from size_plan import SizePlan, plan_request
+from usage_budget import sum_usage
+
+
+class ImageJob:
+    """一张图片的处理任务（在各阶段之间传递）"""
+    
+    def __init__(self, input_path: str, output_path: str,
+                 target_size: Tuple[int, int] = (1024, 1536),
+                 prompt: Optional[str] = None,
+                 on_phase: Optional[Callable[[str], None]] = None,
+                 use_cache: bool = True,
+                 quality: Optional[str] = None,
+                 context: Optional[dict] = None,
+                 passthrough: bool = False):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.target_size = target_size
+        self.prompt = prompt
+        self.on_phase = on_phase
+        self.use_cache = use_cache
+        self.quality = quality
+        # 直接输出（已清晰）：只缩放到目标尺寸，不调用编辑后端
+        self.passthrough = passthrough
+        # 调用方附带的数据（如批处理中的序号、预算预留）
+        self.context = context if context is not None else {}
+        self.timer = PhaseTimer()
+        self.started = time.perf_counter()
+        self.original_size = None
+        # 请求尺寸规划（接口尺寸/上传尺寸，不分块时使用）
+        self.size_plan: Optional[SizePlan] = None
+        # 分块方案（不分块时为 None）、每块是否发送、不发送的分块（直接使用原图）
+        self.tile_plan: Optional[TilePlan] = None
+        self.tile_selected: Optional[List[bool]] = None
+        self.tile_originals: Optional[List[Optional[Image.Image]]] = None
+        # prepare 阶段的产物（后端的上传数据，分块时为每块一份的列表），edit 完成后释放
+        self.prepared = None
+        # edit 阶段的产物（分块时为各分块的结果），save 完成后释放
+        self.clear_image: Optional[Image.Image] = None
+        self.clear_tiles: Optional[List[Image.Image]] = None
+        self.edit_info = {}
+        # 处理结束（成功、失败或跳过）后的结果字典
+        self.result: Optional[dict] = None
+    
+    def report_phase(self, phase: str):
+        if self.on_phase is not None:
+            try:
+                self.on_phase(phase)
+            except Exception:
+                pass
+    
+    def finish(self, result: dict) -> dict:
+        """结束任务：补上总耗时和各阶段计时，释放中间数据"""
+        self.timer.add('total', time.perf_counter() - self.started)
+        result.update(self.timer.as_dict())
+        self.result = result
+        self.prepared = None
+        self.clear_image = None
+        self.clear_tiles = None
+        self.tile_originals = None
+        return result
+    
+    def request_sizes(self) -> List[Tuple[int, int]]:
+        """编辑阶段要调用接口的尺寸（分块时每个要发送的分块一个，可能为空）"""
+        if self.passthrough:
+            return []
+        if self.tile_plan is not None:
+            return [size for size, selected in zip(self.tile_plan.api_sizes, self.tile_selected) if selected]
+        if self.size_plan is not None:
+            return [self.size_plan.api_size]
+        return [self.target_size]
+    
+    def edit_fields(self) -> dict:
+        """结果中来自编辑后端的字段"""
+        return {
+            "attempts": self.edit_info.get('attempts', 0),
+            "retries": self.edit_info.get('retries', 0),
+            "backend": self.edit_info.get('backend'),
+            "coalesced": self.edit_info.get('coalesced', False),
+            "quality": self.edit_info.get('quality'),
+            "usage": self.edit_info.get('usage'),
+            "tiles": self.edit_info.get('tiles'),
+            "tiles_sent": self.edit_info.get('tiles_sent')
+        }
 
 
 class DeblurAgent:
     """背景去模糊Agent - 使用AI将图片变清晰"""
     
-    def __init__(self):
-        self.gpt_handler = GPTHandler()
+    def __init__(self, backend: Optional[EditBackend] = None):
+        """
+        Args:
+            backend: 编辑后端（可选），None 则按 EDIT_BACKEND 配置创建
+        """
+        self.backend = backend if backend is not None else create_edit_backend()
+        # 输出编码配置错误时在调用API前报错
+        parse_output_profile()
+    
+    @staticmethod
+    def _can_save_directly(image: Image.Image, output_path: str) -> bool:
+        """结果图片的编码格式与输出文件扩展名一致，且无需 save_image 的透明通道处理"""
+        if not OUTPUT_DIRECT_SAVE or not image.format or image.mode not in ('RGB', 'L'):
+            return False
+        ext = os.path.splitext(output_path)[1].lower()
+        return Image.registered_extensions().get(ext) == image.format
     
     def process_image(self, input_path: str, output_path: str,
                      target_size: Tuple[int, int] = (1024, 1536),
-                     prompt: Optional[str] = None) -> dict:
+                     prompt: Optional[str] = None,
+                     on_phase: Optional[Callable[[str], None]] = None,
+                     use_cache: bool = True,
+                     quality: Optional[str] = None) -> dict:
         """
         使用AI处理图片，将模糊背景变清晰
-        直接使用目标尺寸处理，不再切分
+        目标尺寸是接口尺寸时整张编辑（按图片宽高比选择请求尺寸），否则切成重叠分块分别编辑后拼接
         
         Args:
             input_path: 输入图片路径（必需）
             output_path: 输出图片路径
             target_size: 目标尺寸 (width, height)，默认1024×1536
             prompt: 提示词（可选），为空则使用默认提示词
+            on_phase: 阶段回调（可选），用于批量处理时跟踪单张图片状态：
+                      preparing / uploading / waiting / decoding / saving / saved
+            use_cache: 是否使用结果缓存（False 时强制重新调用API）
+            quality: 编辑质量（high / medium / low），None 则使用后端默认质量
         
         Returns:
-            处理结果字典
+            处理结果字典（含 timings: 各阶段耗时秒数，bytes: 上传/响应/结果/输出字节数，
+            usage: 本次计费的 token 数和预估费用，未调用API时为 None，
+            tiles / tiles_sent: 分块数和其中发送给编辑后端的块数，不分块时为 None，
+            api_size / upload_size: 请求的接口尺寸和上传尺寸，分块时为 None，
+            output_encoding: 输出编码的格式、方案、质量、字节数和编码耗时）
         """
+        job = ImageJob(input_path, output_path, target_size, prompt, on_phase, use_cache, quality)
+        for stage in (self.prepare, self.edit, self.save):
+            self.run_stage(stage, job)
+        return job.result
+    
+    def run_stage(self, stage: Callable[[ImageJob], None], job: ImageJob):
+        """执行一个阶段（任务已结束时跳过），异常记为处理失败"""
+        if job.result is not None:
+            return
         try:
-            if not input_path:
-                return {
-                    "success": False,
-                    "error": "图像编辑需要提供输入图片路径"
-                }
-            
-            # 1. 加载图片
-            print(f"正在加载图片: {input_path}")
-            image = load_image(input_path)
-            original_size = image.size
-            print(f"原始尺寸: {original_size[0]}x{original_size[1]}")
-            print(f"目标尺寸: {target_size[0]}x{target_size[1]}")
-            
-            # 2. 直接使用目标尺寸处理（不再切分）
-            print("\n" + "=" * 60)
-            print("使用OpenAI Images API直接编辑图片")
-            print(f"目标尺寸: {target_size[0]}×{target_size[1]}")
-            if prompt and prompt.strip():
-                print(f"使用提示词: {prompt.strip()}")
-            else:
-                print(f"使用默认提示词: {self.gpt_handler.FIXED_PROMPT}")
-            print("=" * 60)
-            
-            clear_image = self.gpt_handler.edit_image(image, target_size=target_size, prompt=prompt)
-            
-            if clear_image is None:
-                return {
-                    "success": False,
-                    "error": "AI处理失败，未能生成清晰图片"
-                }
-            
-            # 4. 保存结果
-            print(f"\n正在保存结果到: {output_path}")
-            save_image(clear_image, output_path, quality=OUTPUT_QUALITY)
-            
-            return {
-                "success": True,
-                "original_size": original_size,
-                "final_size": clear_image.size,
-                "output_path": output_path
-            }
-            
+            stage(job)
         except Exception as e:
             import traceback
             traceback.print_exc()
-            return {
+            job.finish({
                 "success": False,
-                "error": str(e)
-            }
-
+                "error": str(e),
+                "usage": job.edit_info.get('usage')
+            })
+    
+    def prepare(self, job: ImageJob):
+        """准备阶段（CPU）：加载图片，并由编辑后端完成缩放和上传数据编码"""
+        if not job.input_path:
+            job.finish({
+                "success": False,
+                "error": "图像编辑需要提供输入图片路径"
+            })
+            return
+        
+        job.report_phase('preparing')
+        # 1. 加载图片
+        print(f"正在加载图片: {job.input_path}")
+        with job.timer.phase('load'):
+            # 按目标尺寸降采样解码（大图不必全分辨率解码）
+            image = load_image(job.input_path, job.target_size)
+        job.original_size = image.info.get('original_size', image.size)
+        print(f"原始尺寸: {job.original_size[0]}x{job.original_size[1]}")
+        if image.size != job.original_size:
+            print(f"降采样解码: {image.size[0]}x{image.size[1]}")
+        print(f"目标尺寸: {job.target_size[0]}x{job.target_size[1]}")
+        
+        # 2. 缩放并编码上传数据（目标尺寸不是接口尺寸时分块）
+        if job.passthrough:
+            with job.timer.phase('resize'):
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                job.clear_image = resize_image_smart(image, job.target_size, method='lanczos')
+        elif should_tile(job.target_size):
+            self._prepare_tiles(job, image)
+        else:
+            job.size_plan = plan_request(image.size, job.target_size)
+            print(f"请求尺寸: {job.size_plan.describe()}")
+            job.prepared = self.backend.prepare(image, job.size_plan.api_size, job.timer)
+    
+    def _prepare_tiles(self, job: ImageJob, image: Image.Image):
+        """
+        缩放到目标尺寸的画布，切成重叠分块；开启 BLUR_SELECT 时按局部模糊检测选择网格和要发送的分块，
+        要发送的分块按其接口尺寸编码，其余分块保留原图
+        """
+        with job.timer.phase('resize'):
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            canvas = resize_image_smart(image, job.target_size, method='lanczos')
+        grid = parse_grid(TILE_GRID)
+        if BLUR_SELECT:
+            with job.timer.phase('blur_map'):
+                blur_map = BlurMap(canvas)
+                job.tile_plan, job.tile_selected = plan_selected_tiles(job.target_size, blur_map, grid)
+            print(f"模糊区域占比: {blur_map.blurry_fraction:.0%}")
+        else:
+            job.tile_plan = plan_tiles(job.target_size, grid)
+            job.tile_selected = [True] * len(job.tile_plan)
+        plan = job.tile_plan
+        print(f"分块处理: {plan.describe()}，发送 {sum(job.tile_selected)}/{len(plan)} 个分块")
+        # 预先构建融合掩码（同一布局缓存复用；融合方式配置错误时在调用API前报错）
+        get_blender(plan.canvas_size, plan.boxes)
+        tiles = split_tiles(canvas, plan)
+        job.prepared = [
+            self.backend.prepare(tile, api_size, job.timer) if selected else None
+            for tile, api_size, selected in zip(tiles, plan.api_sizes, job.tile_selected)
+        ]
+        job.tile_originals = [None if selected else tile for tile, selected in zip(tiles, job.tile_selected)]
+    
+    def edit(self, job: ImageJob):
+        """编辑阶段（I/O）：调用编辑后端"""
+        if job.passthrough:
+            print("图片已清晰，不调用编辑后端，直接输出")
+            return
+        print("\n" + "=" * 60)
+        print(f"使用编辑后端直接编辑图片: {self.backend.name}")
+        print(f"目标尺寸: {job.target_size[0]}×{job.target_size[1]}")
+        if job.prompt and job.prompt.strip():
+            print(f"使用提示词: {job.prompt.strip()}")
+        else:
+            print(f"使用默认提示词: {self.backend.FIXED_PROMPT}")
+        print("=" * 60)
+        
+        if job.tile_plan is not None:
+            self._edit_tiles(job)
+        else:
+            job.clear_image = self.backend.edit_prepared(
+                job.prepared, job.size_plan.api_size, prompt=job.prompt, on_phase=job.on_phase,
+                use_cache=job.use_cache, info=job.edit_info, timer=job.timer, quality=job.quality
+            )
+        job.prepared = None
+        
+        if job.clear_image is None and job.clear_tiles is None:
+            job.finish(dict({
+                "success": False,
+                "error": "AI处理失败，未能生成清晰图片",
+                "error_kind": job.edit_info.get('error_kind')
+            }, **job.edit_fields()))
+    
+    def _edit_tiles(self, job: ImageJob):
+        """要发送的分块并发调用编辑后端（共享分块线程池），任一分块失败则整张失败；其余分块使用原图"""
+        plan = job.tile_plan
+        indices = [index for index, selected in enumerate(job.tile_selected) if selected]
+        infos = [{} for _ in indices]
+        timers = [PhaseTimer() for _ in indices]
+        
+        def edit_tile(slot: int) -> Optional[Image.Image]:
+            index = indices[slot]
+            return self.backend.edit_prepared(
+                job.prepared[index], plan.api_sizes[index], prompt=job.prompt, on_phase=job.on_phase,
+                use_cache=job.use_cache, info=infos[slot], timer=timers[slot], quality=job.quality
+            )
+        
+        if indices:
+            print(f"并发发送 {len(indices)} 个分块")
+        else:
+            print("没有需要AI处理的模糊区域，直接使用原图")
+        futures = [get_tile_executor().submit(edit_tile, slot) for slot in range(len(indices))]
+        tiles = []
+        try:
+            for future in futures:
+                tile = future.result()
+                if tile is None:
+                    break
+                tiles.append(tile)
+        finally:
+            if len(tiles) < len(futures):
+                # 整张已失败：还没开始的分块不再发送
+                for future in futures:
+                    future.cancel()
+            # 等在途的分块结束，计入它们的用量和计时
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()
+            job.timer.merge_parallel(timers)
+            started = [info for info in infos if info]
+            job.edit_info.update({
+                'attempts': sum(info.get('attempts', 0) for info in started),
+                'retries': sum(info.get('retries', 0) for info in started),
+                'cached': bool(started) and all(info.get('cached') for info in started),
+                'error_kind': next((info['error_kind'] for info in started if info.get('error_kind')), None),
+                'backend': next((info['backend'] for info in reversed(started) if info.get('backend')), None),
+                'coalesced': any(info.get('coalesced') for info in started),
+                'quality': next((info['quality'] for info in started if info.get('quality')), job.quality),
+                'usage': sum_usage(info.get('usage') for info in started),
+                'tiles': len(plan),
+                'tiles_sent': len(indices),
+            })
+        if len(tiles) == len(indices):
+            clear_tiles = list(job.tile_originals)
+            for index, tile in zip(indices, tiles):
+                clear_tiles[index] = tile
+            job.clear_tiles = clear_tiles
+            job.tile_originals = None
+    
+    def save(self, job: ImageJob):
+        """保存阶段（CPU）：编码并写入输出文件"""
+        if job.clear_tiles is not None:
+            with job.timer.phase('merge'):
+                job.clear_image = merge_tiles(job.clear_tiles, job.tile_plan)
+            job.clear_tiles = None
+        clear_image = job.clear_image
+        restored = job.size_plan is not None and clear_image.size != tuple(job.target_size)
+        if restored:
+            # 接口结果缩放回目标尺寸（接口尺寸按图片宽高比选择，可能与目标尺寸不同）
+            with job.timer.phase('restore'):
+                clear_image = resize_image_smart(clear_image, job.target_size, method='lanczos')
+        # 4. 保存结果
+        print(f"\n正在保存结果到: {job.output_path}")
+        job.report_phase('saving')
+        with job.timer.phase('save'):
+            raw_bytes = job.edit_info.pop('result_bytes', None)
+            if (raw_bytes is not None and not restored and self._can_save_directly(clear_image, job.output_path)
+                    and (OUTPUT_PROFILE != 'size' or len(raw_bytes) <= OUTPUT_TARGET_KB * 1024)):
+                # 结果已是输出格式：直接写入原始字节，不解码再编码
+                with open(job.output_path, 'wb') as f:
+                    f.write(raw_bytes)
+                output_encoding = {'format': clear_image.format, 'profile': 'direct', 'bytes': len(raw_bytes),
+                                   'encode_seconds': 0.0}
+                print(f"结果格式与输出一致（{clear_image.format}），直接写入")
+            else:
+                output_encoding = save_image(clear_image, job.output_path, quality=OUTPUT_QUALITY)
+                print(f"输出编码: {output_encoding['format']} {output_encoding['profile']}，"
+                      f"质量 {output_encoding['quality']}，{output_encoding['bytes'] / 1024:.0f} KB，"
+                      f"耗时 {output_encoding['encode_seconds'] * 1000:.0f}ms")
+        job.timer.add_bytes('output', output_encoding['bytes'])
+        job.report_phase('saved')
+        
+        job.finish(dict({
+            "success": True,
+            "original_size": job.original_size,
+            "final_size": clear_image.size,
+            "output_path": job.output_path,
+            "cached": job.edit_info.get('cached', False),
+            "api_size": job.size_plan.api_size if job.size_plan is not None else None,
+            "upload_size": job.size_plan.upload_size if job.size_plan is not None else None,
+            "output_encoding": output_encoding
+        }, **job.edit_fields()))
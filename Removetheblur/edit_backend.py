@@ -0,0 +1,165 @@
+"""
+图片编辑后端
+- EditBackend: DeblurAgent 依赖的后端协议
+- GPTHandler（gpt_handler.py）: 调用远程编辑接口（EDIT_BACKEND=http）
+- LocalEditBackend: 本地确定性后端（EDIT_BACKEND=local），不需要API密钥、不联网、不产生费用，
+  用可配置的延迟模拟服务端推理，用于离线压测/剖析批处理、Web和命令行流程
+"""
+import io
+import time
+from typing import Any, Callable, Optional, Protocol, Tuple
+
+from PIL import Image, ImageFilter
+
+from config import EDIT_BACKEND, LOCAL_EDIT_LATENCY, LOCAL_EDIT_FILTER
+from gpt_handler import GPTHandler
+from phase_timing import PhaseTimer
+from size_plan import upload_size
+
+# 本地后端可用的处理方式
+LOCAL_FILTERS = ('sharpen', 'passthrough')
+
+
+class EditBackend(Protocol):
+    """图片编辑后端协议"""
+
+    # 后端名称（写入处理结果，用于日志/报告）
+    name: str
+    # 默认提示词
+    FIXED_PROMPT: str
+
+    def edit(self, image_bytes: bytes, prompt: Optional[str] = None,
+             size: Tuple[int, int] = (1024, 1024)) -> bytes:
+        """输入图片字节，返回编辑后的图片字节；失败时抛出 EditError"""
+        ...
+
+    def edit_image(self, image: Image.Image, target_size: Tuple[int, int] = (1024, 1024),
+                   prompt: Optional[str] = None,
+                   on_phase: Optional[Callable[[str], None]] = None,
+                   use_cache: bool = True,
+                   info: Optional[dict] = None,
+                   timer: Optional[PhaseTimer] = None,
+                   quality: Optional[str] = None) -> Optional[Image.Image]:
+        """
+        编辑PIL图片，失败返回 None
+        （info 写入 attempts/retries/cached/error_kind/backend/coalesced/quality/usage，
+        以及可选的 result_bytes（编码后的结果，格式与输出一致时直接写入）；timer 记录各阶段耗时和字节数；
+        quality 为 None 时使用后端默认质量）
+        """
+        ...
+
+    def prepare(self, image: Image.Image, target_size: Tuple[int, int],
+                timer: Optional[PhaseTimer] = None) -> Any:
+        """编辑前的本地CPU工作（缩放、编码等）；返回值只传给同一后端的 edit_prepared()"""
+        ...
+
+    def edit_prepared(self, prepared: Any, target_size: Tuple[int, int],
+                      prompt: Optional[str] = None,
+                      on_phase: Optional[Callable[[str], None]] = None,
+                      use_cache: bool = True,
+                      info: Optional[dict] = None,
+                      timer: Optional[PhaseTimer] = None,
+                      quality: Optional[str] = None) -> Optional[Image.Image]:
+        """用 prepare() 的结果完成编辑（参数同 edit_image），edit_image = prepare + edit_prepared"""
+        ...
+
+
+class LocalEditBackend:
+    """
+    本地编辑后端
+
+    按上传尺寸缩放（同远程后端，只缩小不放大），结果缩放到请求尺寸后做 USM 锐化（sharpen）或原样返回（passthrough），
+    并在“上传”之后等待 latency 秒模拟服务端推理；相同输入总是得到相同输出，不产生用量（usage 为 None）
+    """
+
+    name = "local"
+    FIXED_PROMPT = GPTHandler.FIXED_PROMPT
+
+    def __init__(self, latency: float = None, filter_name: str = None):
+        self.latency = max(0.0, LOCAL_EDIT_LATENCY if latency is None else latency)
+        self.filter = (filter_name or LOCAL_EDIT_FILTER).strip().lower()
+        if self.filter not in LOCAL_FILTERS:
+            raise ValueError(f"LOCAL_EDIT_FILTER 无效: {self.filter}（可选: {', '.join(LOCAL_FILTERS)}）")
+        print(f"使用本地编辑后端: 处理方式 {self.filter}, 模拟延迟 {self.latency:g} 秒（不调用API）")
+
+    def prepare(self, image: Image.Image, target_size: Tuple[int, int],
+                timer: Optional[PhaseTimer] = None) -> Image.Image:
+        """转RGB并缩放到上传尺寸"""
+        from image_utils import resize_image_smart
+        if timer is None:
+            timer = PhaseTimer()
+        with timer.phase('resize'):
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            size = upload_size(image.size, target_size)
+            return image if image.size == size else resize_image_smart(image, size, method='lanczos')
+
+    def edit(self, image_bytes: bytes, prompt: Optional[str] = None,
+             size: Tuple[int, int] = (1024, 1024)) -> bytes:
+        result = self.edit_image(Image.open(io.BytesIO(image_bytes)), size, prompt=prompt)
+        buffer = io.BytesIO()
+        result.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def edit_image(self, image: Image.Image, target_size: Tuple[int, int] = (1024, 1024),
+                   prompt: Optional[str] = None,
+                   on_phase: Optional[Callable[[str], None]] = None,
+                   use_cache: bool = True,
+                   info: Optional[dict] = None,
+                   timer: Optional[PhaseTimer] = None,
+                   quality: Optional[str] = None) -> Optional[Image.Image]:
+        if timer is None:
+            timer = PhaseTimer()
+        return self.edit_prepared(self.prepare(image, target_size, timer), target_size, prompt,
+                                  on_phase, use_cache, info, timer, quality)
+
+    def edit_prepared(self, prepared: Image.Image, target_size: Tuple[int, int],
+                      prompt: Optional[str] = None,
+                      on_phase: Optional[Callable[[str], None]] = None,
+                      use_cache: bool = True,
+                      info: Optional[dict] = None,
+                      timer: Optional[PhaseTimer] = None,
+                      quality: Optional[str] = None) -> Optional[Image.Image]:
+        if timer is None:
+            timer = PhaseTimer()
+        if info is not None:
+            info.update({'attempts': 1, 'retries': 0, 'cached': False, 'error_kind': None,
+                         'backend': self.name, 'coalesced': False, 'quality': quality, 'usage': None})
+
+        def report_phase(phase: str):
+            if on_phase is not None:
+                try:
+                    on_phase(phase)
+                except Exception:
+                    pass
+
+        report_phase('uploading')
+        report_phase('waiting')
+        if self.latency:
+            with timer.phase('server_wait'):
+                time.sleep(self.latency)
+        report_phase('decoding')
+        result = prepared
+        with timer.phase('process'):
+            if result.size != tuple(target_size):
+                # 同远程接口：结果为请求尺寸
+                result = result.resize(tuple(target_size), Image.Resampling.LANCZOS)
+            if self.filter == 'sharpen':
+                result = result.filter(ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3))
+        print(f"✓ 本地编辑完成，尺寸: {result.size}")
+        return result
+
+
+def create_edit_backend(kind: str = None) -> EditBackend:
+    """
+    按配置创建编辑后端
+
+    Args:
+        kind: http / local，None 则使用 EDIT_BACKEND 配置
+    """
+    kind = (kind or EDIT_BACKEND).strip().lower()
+    if kind == 'http':
+        return GPTHandler()
+    if kind == 'local':
+        return LocalEditBackend()
+    raise ValueError(f"EDIT_BACKEND 无效: {kind}（可选: http, local）")
@@ -4,77 +4,194 @@ API处理模块 - 使用AI将图片变清晰
 参考文档: https://doc.newapi.pro/api/openai-image/
 """
 from PIL import Image
-from typing import Optional, Tuple
-from config import OPENAI_API_KEY
+from typing import Callable, Optional, Tuple
+from http_pool import get_http_pool
+from upload_encoder import UploadEncoder
+from result_cache import get_result_cache, make_cache_key
+from request_control import (
+    THROTTLE_STATUS_CODES, EditError, Flight, RetryPolicy, classify_status,
+    get_circuit_breaker, get_single_flight, parse_retry_after
+)
+from backend_pool import Backend, get_backend_pool
+from config import THROTTLE_MAX_RETRIES, TIMEOUT_CONNECT, DOWNLOAD_READ_TIMEOUT
+from stream_decode import B64JsonStreamDecoder
+from stream_download import ResultDownload
+from phase_timing import PhaseTimer
+from size_plan import upload_size
+from adaptive_timeout import get_adaptive_timeouts
+from usage_budget import get_usage_ledger, normalize_usage
 import io
-import base64
 import httpx
 import json
 import time
-import tempfile
-import os
 
 
 class GPTHandler:
-    """API处理器 - 使用AI编辑图片"""
+    """API处理器 - 使用AI编辑图片（HTTP编辑后端，EDIT_BACKEND=http）"""
+    
+    # 后端名称（见 edit_backend.EditBackend）
+    name = "http"
     
     # 固定的系统提示词（中文）
     FIXED_PROMPT = "请把这个图变成全景深，整个画面中模糊虚化的地方变清晰，边缘锐利。"
     
+    # 编辑接口的模型和质量参数
+    MODEL = "gpt-image-1"
+    QUALITY = "high"
+    
+    # 编辑接口端点（各后端相同）
+    EDIT_ENDPOINT = "/v1/images/edits"
+    
     def __init__(self):
-        if not OPENAI_API_KEY:
+        # API 后端池 - New API OpenAI 格式（API_BACKENDS 配置多个端点/密钥，否则为 API_BASE_URL + OPENAI_API_KEY）
+        self.backend_pool = get_backend_pool()
+        if not self.backend_pool.size:
             raise ValueError("未配置OPENAI_API_KEY，请在.env文件中设置OPENAI_API_KEY=你的密钥")
-        if OPENAI_API_KEY == "your_openai_api_key_here":
+        if any(b.api_key == "your_openai_api_key_here" for b in self.backend_pool.backends):
             raise ValueError("请在.env文件中将OPENAI_API_KEY设置为你的实际API密钥，而不是默认值")
+        self.api_base_url = self.backend_pool.backends[0].base_url
+        
+        # 自适应超时：短连接超时；写超时按上传大小/实测带宽；读超时按历史服务端耗时 p99（持久化）
+        self.timeouts = get_adaptive_timeouts()
+        
+        # 共享连接池：跨图片、跨批次复用连接（keep-alive / HTTP/2）
+        self.http_pool = get_http_pool()
+        
+        # 上传编码器（UPLOAD_FORMAT 配置；auto 模式按实测带宽选择编码）
+        self.upload_encoder = UploadEncoder(bandwidth=self.timeouts.bandwidth)
+        
+        # 结果缓存：相同输入（像素+提示词+尺寸+模型+质量）直接复用上次结果
+        self.result_cache = get_result_cache()
+        
+        # 重试策略：可重试的错误按指数退避+抖动重试
+        self.retry_policy = RetryPolicy()
         
-        # API 配置 - New API OpenAI 格式
-        self.api_base_url = "https://api.qidianai.xyz"
-        self.api_key = OPENAI_API_KEY
+        # 熔断器：密钥无效/连接被拒/DNS失败等系统性错误连续出现时暂停请求，避免每张图都耗尽超时
+        self.circuit_breaker = get_circuit_breaker()
         
-        # 设置超时：所有超时都设置为5分钟
-        self.timeout = httpx.Timeout(
-            timeout=300.0,        # 总超时5分钟
-            connect=300.0,        # 连接超时5分钟
-            read=300.0,           # 读取超时5分钟
-            write=300.0           # 写入超时5分钟
-        )
+        # 单飞合并：相同请求正在进行时不重复调用API
+        self.single_flight = get_single_flight()
         
-        print(f"使用API接口: {self.api_base_url}")
+        # 用量账本：按天累计接口返回的 token 用量和预估费用（每日预算依据）
+        self.usage_ledger = get_usage_ledger()
+        
+        if self.backend_pool.size > 1:
+            print(f"使用API接口: {self.backend_pool.size} 个后端（路由: {self.backend_pool.routing}）")
+            for backend in self.backend_pool.backends:
+                print(f"  - {backend.name}: {backend.base_url} (密钥 {backend.masked_key()}, "
+                      f"权重 {backend.weight:g}, 并发上限 {backend.max_concurrency or '不限'})")
+        else:
+            print(f"使用API接口: {self.api_base_url}")
         print(f"API格式: New API OpenAI 格式")
-        print(f"超时设置: 所有超时均为5分钟")
+        timeout_stats = self.timeouts.stats()
+        print(f"超时设置: 连接 {timeout_stats['connect']:g} 秒, 读取 {timeout_stats['read']:g} 秒"
+              f"（{timeout_stats['server_wait_samples']} 个历史样本）, 写入按上传大小和带宽计算")
         print(f"SSL验证: 已禁用（避免证书问题）")
+        print(f"连接池: keep-alive 已启用, HTTP/2: {'已启用' if self.http_pool.http2 else '未启用'}")
+        print(f"上传编码: {self.upload_encoder.mode}")
+        print(f"结果缓存: {'已启用' if self.result_cache.enabled else '未启用'}")
     
-    def _prepare_image_for_edit(self, image: Image.Image, target_size: Tuple[int, int]) -> io.BytesIO:
+    def _prepare_image_for_edit(self, image: Image.Image,
+                                target_size: Tuple[int, int],
+                                timer: Optional[PhaseTimer] = None) -> Tuple[io.BytesIO, str, str]:
         """
         准备图片用于编辑API（OpenAI 格式使用文件上传）
         
         Args:
             image: 原始图片
-            target_size: 目标尺寸
+            target_size: 接口尺寸（请求结果的尺寸）；上传时保持宽高比缩小到该尺寸以内，不放大（见 size_plan）
+            timer: 阶段计时器（可选），记录 resize / encode
         
         Returns:
-            image_bytes - 图片的BytesIO对象
+            (image_bytes, mime_type, filename) - 图片的BytesIO对象、MIME类型、上传文件名
         """
-        # 转换为RGB（如果不是）
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        if timer is None:
+            timer = PhaseTimer()
         
-        # 调整尺寸到目标尺寸
-        from image_utils import resize_image_smart
-        resized_image = resize_image_smart(image, target_size, method='lanczos')
+        with timer.phase('resize'):
+            # 转换为RGB（如果不是）
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            
+            # 调整到上传尺寸（小图不放大，接口按 size 参数返回目标尺寸）
+            from image_utils import resize_image_smart
+            size = upload_size(image.size, target_size)
+            resized_image = image if image.size == size else resize_image_smart(image, size, method='lanczos')
         
-        # 转换为PNG格式的BytesIO
-        image_bytes = io.BytesIO()
-        resized_image.save(image_bytes, format='PNG')
-        image_bytes.seek(0)
+        # 按上传编码配置（PNG/WebP/JPEG/auto）转换为BytesIO
+        with timer.phase('encode'):
+            return self.upload_encoder.encode(resized_image)
+    
+    def _post_edit(self, backend: Backend, files: dict,
+                   on_trace: Callable[[str, dict], None],
+                   report_phase: Callable[[str], None],
+                   timer: PhaseTimer,
+                   timeout: httpx.Timeout) -> httpx.Response:
+        """
+        经该后端的限速器发送编辑请求
+        收到 429/503 时按 Retry-After 暂停该后端后重发同一请求体，而不是直接放弃这张图片
         
-        return image_bytes
+        Returns:
+            最后一次请求的响应（仍为 429/503 表示已超过最大限流重试次数）；
+            状态码为 200 时响应体尚未读取（流式），调用方负责 close()
+        """
+        api_url = f"{backend.base_url}{self.EDIT_ENDPOINT}"
+        headers = {
+            'Authorization': f'Bearer {backend.api_key}',
+        }
+        rate_limiter = backend.rate_limiter
+        throttle_retries = 0
+        while True:
+            waited = rate_limiter.acquire()
+            timer.add('queue', waited)
+            if waited >= 1:
+                print(f"限速等待 {waited:.1f} 秒后发送请求")
+            throttled = False
+            try:
+                report_phase('uploading')
+                request = self.http_pool.client.build_request(
+                    'POST',
+                    api_url,
+                    files=files,
+                    headers=headers,
+                    timeout=timeout,
+                    extensions=self.http_pool.extensions(on_trace)
+                )
+                # 请求体字节数（multipart 整体，含表单字段）
+                timer.add_bytes('upload', int(request.headers.get('Content-Length', 0)))
+                # 流式响应：成功时由调用方边接收边解码，用完需 close()
+                response = self.http_pool.client.send(request, stream=True)
+                throttled = response.status_code in THROTTLE_STATUS_CODES
+            finally:
+                rate_limiter.release(throttled=throttled)
+            
+            if response.status_code != 200:
+                # 错误响应体很小，直接读完
+                try:
+                    response.read()
+                finally:
+                    response.close()
+            
+            if not throttled or throttle_retries >= THROTTLE_MAX_RETRIES:
+                return response
+            
+            throttle_retries += 1
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            wait = rate_limiter.on_throttle(response.status_code, retry_after)
+            print(f"⚠️ 服务端限流（{response.status_code}），后端 {backend.name} 暂停 {wait:.1f} 秒后重试 "
+                  f"（第 {throttle_retries}/{THROTTLE_MAX_RETRIES} 次）")
+            report_phase('throttled')
     
     def edit_image(
         self,
         image: Image.Image,
         target_size: Tuple[int, int] = (1024, 1024),
-        prompt: Optional[str] = None
+        prompt: Optional[str] = None,
+        on_phase: Optional[Callable[[str], None]] = None,
+        use_cache: bool = True,
+        info: Optional[dict] = None,
+        timer: Optional[PhaseTimer] = None,
+        quality: Optional[str] = None
     ) -> Optional[Image.Image]:
         """
         使用API编辑图片，使其变清晰
@@ -85,12 +202,103 @@ class GPTHandler:
             image: 原始图片
             target_size: 目标尺寸 (width, height)，例如 (1024, 1536)
             prompt: 提示词（可选），为空则使用默认提示词
+            on_phase: 阶段回调（可选），依次收到 'uploading' / 'waiting' / 'decoding'
+            use_cache: 是否使用结果缓存，False 则跳过缓存强制调用API
+            info: 可选，调用方传入的字典，写入本次调用的统计：
+                  attempts（请求次数）、retries（重试次数）、cached、error_kind、
+                  backend（最后一次请求使用的后端）、coalesced（是否复用了正在进行的相同请求）、
+                  quality（使用的质量）、usage（本次计费的 token 数和预估费用，未调用API时为 None）、
+                  result_bytes（成功时接口返回的原始图片字节，格式与输出一致时可直接写入）
+            timer: 阶段计时器（可选），记录 resize / encode / upload / server_wait / download 等阶段耗时和字节数
+            quality: 质量参数（high / medium / low），None 则使用 QUALITY；预算不足时由批处理降级
         
         Returns:
             编辑后的清晰图片或None
         """
-        # 准备图片（调整尺寸和格式）
-        image_bytes = self._prepare_image_for_edit(image, target_size)
+        if timer is None:
+            timer = PhaseTimer()
+        return self.edit_prepared(self.prepare(image, target_size, timer), target_size, prompt,
+                                  on_phase, use_cache, info, timer, quality)
+    
+    def prepare(self, image: Image.Image, target_size: Tuple[int, int],
+                timer: Optional[PhaseTimer] = None) -> Tuple[io.BytesIO, str, str]:
+        """
+        编辑前的本地CPU工作（转RGB、缩放、编码上传数据），批处理流水线在准备阶段提前完成
+        
+        Returns:
+            上传数据，原样传给 edit_prepared()
+        """
+        return self._prepare_image_for_edit(image, target_size, timer)
+    
+    def edit_prepared(
+        self,
+        prepared: Tuple[io.BytesIO, str, str],
+        target_size: Tuple[int, int],
+        prompt: Optional[str] = None,
+        on_phase: Optional[Callable[[str], None]] = None,
+        use_cache: bool = True,
+        info: Optional[dict] = None,
+        timer: Optional[PhaseTimer] = None,
+        quality: Optional[str] = None
+    ) -> Optional[Image.Image]:
+        """
+        用 prepare() 的结果调用编辑接口（参数同 edit_image）
+        """
+        edited_image, raw_bytes = self._edit(prepared, target_size, prompt, on_phase,
+                                             use_cache, info, timer, quality)
+        if info is not None and raw_bytes is not None:
+            info['result_bytes'] = raw_bytes
+        return edited_image
+    
+    def edit(self, image_bytes: bytes, prompt: Optional[str] = None,
+             size: Tuple[int, int] = (1024, 1024)) -> bytes:
+        """
+        编辑后端协议接口：输入图片字节，返回接口返回的原始图片字节
+        
+        Raises:
+            EditError: 编辑失败（kind 为错误类别）
+        """
+        info = {}
+        prepared = self.prepare(Image.open(io.BytesIO(image_bytes)), size)
+        _, raw_bytes = self._edit(prepared, size, prompt, None, True, info, None)
+        if raw_bytes is None:
+            raise EditError(info.get('error_kind') or 'unknown', "AI处理失败，未能生成清晰图片")
+        return raw_bytes
+    
+    def _edit(
+        self,
+        prepared: Tuple[io.BytesIO, str, str],
+        target_size: Tuple[int, int],
+        prompt: Optional[str],
+        on_phase: Optional[Callable[[str], None]],
+        use_cache: bool,
+        info: Optional[dict],
+        timer: Optional[PhaseTimer],
+        quality: Optional[str] = None
+    ) -> Tuple[Optional[Image.Image], Optional[bytes]]:
+        """
+        edit_prepared / edit 的实现（prepared 为 prepare() 准备好的上传数据）
+        
+        Returns:
+            (edited_image, raw_bytes) - 编辑后的图片及接口返回（或缓存中）的原始字节；失败时均为 None
+        """
+        if info is None:
+            info = {}
+        if timer is None:
+            timer = PhaseTimer()
+        quality = quality or self.QUALITY
+        info.update({'attempts': 0, 'retries': 0, 'cached': False, 'error_kind': None,
+                     'backend': None, 'coalesced': False, 'quality': quality, 'usage': None})
+        
+        def report_phase(phase: str):
+            if on_phase is not None:
+                try:
+                    on_phase(phase)
+                except Exception:
+                    pass
+        
+        # 已准备好的上传数据；重试时复用同一份，不重新编码
+        image_bytes, mime_type, upload_filename = prepared
         
         # 使用传入提示词（若为空则使用默认提示词）
         if isinstance(prompt, str):
@@ -104,274 +312,485 @@ class GPTHandler:
         # 将尺寸转换为API需要的格式（如 "1024x1536"）
         size_str = f"{target_size[0]}x{target_size[1]}"
         
+        # 请求键 = 上传字节 + 请求参数，用于结果缓存和单飞合并
+        use_result_cache = use_cache and self.result_cache.enabled
+        with timer.phase('cache_lookup'):
+            request_key = make_cache_key(
+                image_bytes.getbuffer(),
+                prompt=prompt_to_use, size=size_str, model=self.MODEL,
+                quality=quality, mime_type=mime_type
+            )
+            cached = self.result_cache.get(request_key) if use_result_cache else None
+        if cached is not None:
+            with timer.phase('decode'):
+                edited_image = Image.open(io.BytesIO(cached))
+                edited_image.load()
+            timer.add_bytes('result', len(cached))
+            print(f"✓ 命中结果缓存，跳过API调用，尺寸: {edited_image.size}")
+            info['cached'] = True
+            return edited_image, cached
+        
+        # 单飞合并：相同请求正在进行时，等待它的结果而不是重复调用（付费的）API
+        flight, is_leader = self.single_flight.join(request_key)
+        if not is_leader:
+            return self._wait_coalesced(flight, info, timer, report_phase)
+        
+        raw_bytes = None
         try:
-            image_size = len(image_bytes.getvalue())
-            
-            print(f"正在使用API编辑图片...")
-            print(f"API地址: {self.api_base_url}")
-            print(f"API格式: New API OpenAI 格式")
-            print(f"目标尺寸: {target_size[0]}×{target_size[1]}")
-            print(f"API尺寸参数: {size_str}")
-            print(f"使用提示词: {prompt_to_use}")
-            print(f"图片大小: {image_size} 字节")
-            print(f"图片格式: PNG (RGB模式)")
-            
-            # 调用图像编辑API
-            print("正在调用API...")
-            print("提示: 图片处理可能需要较长时间（1-5分钟），请耐心等待...")
-            
-            # 记录开始时间
-            start_time = time.time()
-            
-            # 根据正确的任务日志，使用 OpenAI 格式的图片编辑接口
-            # 端点: /v1/images/edits
-            # 参考: 正确的任务日志.txt
-            endpoint = "/v1/images/edits"
-            api_url = f"{self.api_base_url}{endpoint}"
-            
-            print(f"使用端点: {api_url}")
-            
-            # 根据正确的任务日志，需要将图片转换为 base64
-            # 关键参数：
-            # - image[]: base64 编码的图片（注意是 image[] 数组格式）
-            # - model: gpt-image-1
-            # - prompt: 提示词
-            # - quality: high
-            # - size: 例如 1024x1024
-            # - response_format: b64_json
+            edited_image, raw_bytes = self._edit_remote(
+                image_bytes, mime_type, upload_filename, prompt_to_use, target_size, quality,
+                request_key if use_result_cache else None, report_phase, info, timer
+            )
+            return edited_image, raw_bytes
+        finally:
+            self.single_flight.complete(request_key, flight, raw_bytes, info)
+    
+    def _wait_coalesced(self, flight: Flight, info: dict, timer: PhaseTimer,
+                        report_phase: Callable[[str], None]) -> Tuple[Optional[Image.Image], Optional[bytes]]:
+        """等待正在进行的相同请求，解码出自己的一份结果"""
+        print("相同请求正在处理中，等待其结果（不重复调用API）...")
+        report_phase('waiting')
+        with timer.phase('coalesced_wait'):
+            raw_bytes, leader_info = flight.wait()
+        info.update({
+            'coalesced': True,
+            'error_kind': leader_info.get('error_kind'),
+            'backend': leader_info.get('backend'),
+        })
+        if raw_bytes is None:
+            print(f"✗ 合并的请求失败（{info['error_kind']}）")
+            return None, None
+        report_phase('decoding')
+        with timer.phase('decode'):
+            edited_image = Image.open(io.BytesIO(raw_bytes))
+            edited_image.load()
+        timer.add_bytes('result', len(raw_bytes))
+        print(f"✓ 已复用相同请求的结果，尺寸: {edited_image.size}")
+        return edited_image, raw_bytes
+    
+    def _edit_remote(
+        self,
+        image_bytes: io.BytesIO,
+        mime_type: str,
+        upload_filename: str,
+        prompt_to_use: str,
+        target_size: Tuple[int, int],
+        quality: str,
+        cache_key: Optional[str],
+        report_phase: Callable[[str], None],
+        info: dict,
+        timer: PhaseTimer
+    ) -> Tuple[Optional[Image.Image], Optional[bytes]]:
+        """
+        调用编辑接口（含限流重试、失败重试、熔断），成功时写入结果缓存
+        
+        Returns:
+            (edited_image, raw_bytes)；失败时均为 None
+        """
+        size_str = f"{target_size[0]}x{target_size[1]}"
+        
+        connect_started = [0.0]
+        upload_started = [0.0]
+        wait_started = [0.0]
+        last_server_wait = [0.0]
+        
+        def on_trace(event_name: str, trace_info: dict):
+            # 新建连接：TCP 连接和 TLS 握手
+            if event_name.endswith(('connect_tcp.started', 'start_tls.started')):
+                connect_started[0] = time.perf_counter()
+            elif event_name.endswith(('connect_tcp.complete', 'start_tls.complete')):
+                if connect_started[0]:
+                    timer.add('connect', time.perf_counter() - connect_started[0])
+                    connect_started[0] = 0.0
+            elif event_name.endswith('send_request_headers.started'):
+                upload_started[0] = time.perf_counter()
+            # 请求体发送完毕 = 上传结束，开始等待服务端推理
+            elif event_name.endswith('send_request_body.complete'):
+                report_phase('waiting')
+                wait_started[0] = time.perf_counter()
+                if upload_started[0]:
+                    upload_seconds = wait_started[0] - upload_started[0]
+                    timer.add('upload', upload_seconds)
+                    # 用实测上传耗时更新带宽估计（供 auto 编码选择）
+                    self.upload_encoder.record_upload(image_size, upload_seconds)
+                    upload_started[0] = 0.0
+            # 收到响应头 = 服务端推理结束
+            elif event_name.endswith('receive_response_headers.complete'):
+                if wait_started[0]:
+                    last_server_wait[0] = time.perf_counter() - wait_started[0]
+                    timer.add('server_wait', last_server_wait[0])
+                    wait_started[0] = 0.0
+        
+        image_size = image_bytes.getbuffer().nbytes  # 不复制缓冲区
+        
+        print(f"正在使用API编辑图片...")
+        print(f"API格式: New API OpenAI 格式")
+        print(f"目标尺寸: {target_size[0]}×{target_size[1]}")
+        print(f"API尺寸参数: {size_str}")
+        print(f"使用提示词: {prompt_to_use}")
+        print(f"图片大小: {image_size} 字节")
+        print(f"图片格式: {mime_type} (RGB模式)")
+        
+        # 调用图像编辑API
+        print("正在调用API...")
+        print("提示: 图片处理可能需要较长时间（1-5分钟），请耐心等待...")
+        
+        # 根据正确的任务日志，使用 OpenAI 格式的图片编辑接口
+        # 端点: /v1/images/edits（EDIT_ENDPOINT，每次尝试由后端池选择 base_url 和密钥）
+        # 参考: 正确的任务日志.txt
+        
+        # 根据正确的任务日志，需要将图片转换为 base64
+        # 关键参数：
+        # - image[]: base64 编码的图片（注意是 image[] 数组格式）
+        # - model: gpt-image-1
+        # - prompt: 提示词
+        # - quality: high（预算不足时可降为 medium / low）
+        # - size: 例如 1024x1024
+        # - response_format: b64_json
+        
+        # 根据错误信息，API需要 multipart/form-data 格式
+        # 直接从内存中的 BytesIO 流式上传（httpx 分块读取），不再落盘临时文件
+        # 注意：图片需要作为文件上传，参数名是 image[]
+        files = {
+            'image[]': (upload_filename, image_bytes, mime_type),  # 文件上传（内存流）
+            'model': (None, self.MODEL),
+            'prompt': (None, prompt_to_use),
+            'quality': (None, quality),
+            'size': (None, size_str),
+            'response_format': (None, 'b64_json'),
+        }
+        
+        attempt = 0
+        backend = None
+        while True:
+            attempt += 1
+            info['attempts'] = attempt
+            info['retries'] = attempt - 1
             
-            # 根据错误信息，API需要 multipart/form-data 格式
-            # 将图片保存为临时文件，然后作为文件上传
-            image_bytes.seek(0)
-            with tempfile.NamedTemporaryFile(mode='wb', suffix='.png', delete=False) as tmp_file:
-                tmp_file.write(image_bytes.getvalue())
-                tmp_file_path = tmp_file.name
+            # 熔断中则等待冷却/探测结果；熔断持续过久则放弃
+            queue_started = time.perf_counter()
+            allowed = self.circuit_breaker.wait_until_allowed(on_pause=lambda: report_phase('paused'))
+            timer.add('queue', time.perf_counter() - queue_started)
+            if not allowed:
+                breaker_stats = self.circuit_breaker.stats()
+                print(f"✗ API熔断中（{breaker_stats['cause']}），放弃该图片")
+                info['error_kind'] = 'circuit_open'
+                info['attempts'] = attempt - 1
+                info['retries'] = max(0, attempt - 2)
+                return None, None
             
             try:
-                # 准备 multipart/form-data 请求
-                # 注意：图片需要作为文件上传，参数名是 image[]
-                with open(tmp_file_path, 'rb') as image_file:
-                    files = {
-                        'image[]': ('image.png', image_file, 'image/png'),  # 文件上传
-                        'model': (None, 'gpt-image-1'),
-                        'prompt': (None, prompt_to_use),
-                        'quality': (None, 'high'),
-                        'size': (None, size_str),
-                        'response_format': (None, 'b64_json'),
-                    }
-                    
-                    headers = {
-                        'Authorization': f'Bearer {self.api_key}',
-                    }
-                    
-                    # 发送请求
-                    print(f"开始发送API请求... (时间: {time.strftime('%H:%M:%S')})")
-                    print(f"请求格式: multipart/form-data (文件上传)")
-                    print(f"图片参数名: image[] (文件格式)")
-                    
-                    with httpx.Client(
-                        timeout=self.timeout,
-                        verify=False,
-                        follow_redirects=True
-                    ) as client:
-                        response = client.post(api_url, files=files, headers=headers)
+                # 选择后端（重试时尽量换一个）；所有后端满载或被摘除时等待
+                with timer.phase('queue'):
+                    backend = self.backend_pool.acquire(avoid=backend)
+                print(f"使用端点: {backend.base_url}{self.EDIT_ENDPOINT}"
+                      + (f"（{backend.name}）" if self.backend_pool.size > 1 else ""))
+                info['backend'] = backend.name
                 
-                elapsed = time.time() - start_time
-                print(f"API请求完成，耗时: {elapsed:.2f} 秒 ({elapsed/60:.1f} 分钟)")
-                print(f"响应状态码: {response.status_code}")
-                
-                # 检查响应
-                if response.status_code == 200:
-                    try:
-                        # 解析 JSON 响应
-                        data = response.json()
-                        print(f"响应数据: {json.dumps(data, indent=2)[:500]}...")
-                        
-                        # 根据正确的任务日志，响应格式应该是：
-                        # {
-                        #   "created": 1589478378,
-                        #   "data": [
-                        #     {
-                        #       "url": "https://...",
-                        #       "b64_json": "..."
-                        #     }
-                        #   ],
-                        #   "usage": {...}  // 可选
-                        # }
-                        
-                        if 'data' in data and len(data['data']) > 0:
-                            result = data['data'][0]
-                            
-                            # 检查是否有 base64 编码的图片
-                            if 'b64_json' in result:
-                                image_base64 = result['b64_json']
-                                
-                                # 处理可能的 data URI 前缀（如 data:image/png;base64,）
-                                if ',' in image_base64:
-                                    image_base64 = image_base64.split(',', 1)[1]
-                                
-                                # 移除所有空白字符
-                                image_base64 = image_base64.strip().replace('\n', '').replace('\r', '').replace(' ', '')
-                                
-                                # 确保 base64 字符串长度是 4 的倍数（添加填充）
-                                missing_padding = len(image_base64) % 4
-                                if missing_padding:
-                                    image_base64 += '=' * (4 - missing_padding)
-                                
-                                try:
-                                    image_bytes_decoded = base64.b64decode(image_base64)
-                                    edited_image = Image.open(io.BytesIO(image_bytes_decoded))
-                                    print(f"✓ 图片编辑完成，尺寸: {edited_image.size}")
-                                except Exception as decode_error:
-                                    print(f"✗ Base64 解码失败: {decode_error}")
-                                    print(f"Base64 字符串长度: {len(image_base64)}")
-                                    print(f"Base64 字符串前100字符: {image_base64[:100]}...")
-                                    return None
-                                
-                                # 显示 token 使用情况（如果有）
-                                if 'usage' in data:
-                                    usage = data['usage']
-                                    print(f"Token使用: 总计={usage.get('total_tokens', 'N/A')}, "
-                                          f"输入={usage.get('input_tokens', 'N/A')}, "
-                                          f"输出={usage.get('output_tokens', 'N/A')}")
-                                
-                                return edited_image
-                            
-                            # 检查是否有 URL
-                            elif 'url' in result:
-                                print(f"尝试从URL下载图片: {result['url']}")
-                                with httpx.Client(timeout=30.0, verify=False) as download_client:
-                                    img_response = download_client.get(result['url'])
-                                    edited_image = Image.open(io.BytesIO(img_response.content))
-                                    print(f"✓ 图片编辑完成（从URL下载），尺寸: {edited_image.size}")
-                                    return edited_image
-                            
-                            else:
-                                print(f"错误: 响应中未找到图片数据")
-                                print(f"可用字段: {list(result.keys())}")
-                                return None
-                        else:
-                            print(f"错误: 响应数据格式不正确")
-                            print(f"响应内容: {response.text[:500]}")
-                            return None
-                            
-                    except json.JSONDecodeError as e:
-                        print(f"错误: 无法解析JSON响应: {e}")
-                        print(f"响应内容: {response.text[:500]}")
-                        return None
-                else:
-                    print(f"API返回错误状态码: {response.status_code}")
-                    print(f"响应内容: {response.text[:500]}")
-                    return None
-                    
-            finally:
-                # 清理临时文件
+                image_bytes.seek(0)
+                timeout = self.timeouts.timeout_for(image_size, attempt)
+                print(f"超时: 连接 {timeout.connect:g} 秒, 写入 {timeout.write:.1f} 秒, 读取 {timeout.read:.1f} 秒")
+                last_server_wait[0] = 0.0
+                start_time = time.time()
                 try:
-                    os.unlink(tmp_file_path)
-                except:
-                    pass
+                    edited_image, raw_bytes, usage = self._edit_once(
+                        backend, files, on_trace, report_phase, start_time, timer, timeout
+                    )
+                    timer.add_bytes('result', len(raw_bytes))
+                    if usage is not None:
+                        info['usage'] = usage
+                        self.usage_ledger.record(usage)
+                    # 成功请求的服务端耗时用于学习读超时
+                    self.timeouts.record_server_wait(last_server_wait[0])
+                    self.backend_pool.release(backend, latency=time.time() - start_time)
+                    self.circuit_breaker.record_success()
+                    if cache_key:
+                        self.result_cache.put(cache_key, raw_bytes)
+                    info['error_kind'] = None
+                    return edited_image, raw_bytes
+                except EditError as e:
+                    error = e
+                except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                    elapsed = time.time() - start_time
+                    print(f"\n✗ 连接错误: {type(e).__name__}: {e}")
+                    print(f"已耗时: {elapsed:.2f} 秒")
+                    self._print_connect_refused_hints(str(e))
+                    error = EditError('connect', f"连接错误: {e}")
+                except httpx.TimeoutException as e:
+                    elapsed = time.time() - start_time
+                    print(f"\n✗ 请求超时: {type(e).__name__}: {e}")
+                    print(f"已耗时: {elapsed:.2f} 秒")
+                    error = EditError('timeout', f"请求超时: {e}")
+                except httpx.RequestError as e:
+                    elapsed = time.time() - start_time
+                    print(f"\n✗ 请求错误: {type(e).__name__}: {e}")
+                    print(f"已耗时: {elapsed:.2f} 秒")
+                    error = EditError('network', f"请求错误: {e}")
+                except Exception as e:
+                    print(f"✗ 编辑图片时出错: {type(e).__name__}: {e}")
+                    import traceback
+                    print("详细错误信息:")
+                    traceback.print_exc()
+                    self._print_error_hints(e)
+                    error = EditError('unknown', str(e))
                 
-        except httpx.ConnectError as e:
-            elapsed = time.time() - start_time
-            error_msg = str(e)
-            print(f"\n✗ 连接错误: {type(e).__name__}: {e}")
-            print(f"已耗时: {elapsed:.2f} 秒")
-            
-            if "10061" in error_msg or "积极拒绝" in error_msg:
-                print("\n" + "=" * 60)
-                print("连接被拒绝 - 诊断信息")
-                print("=" * 60)
-                print(f"API地址: {self.api_base_url}")
-                print(f"端点: /v1/images/generations")
-                print(f"完整URL: {self.api_base_url}/v1/images/generations")
-                print("\n可能的原因：")
-                print("  1. API端点路径不正确")
-                print("  2. API服务器不支持该接口")
-                print("  3. 需要联系API提供商确认正确的端点路径")
-                print("  4. API服务当前不可用或配置有问题")
-                print("\n建议：")
-                print("  1. 联系 API 提供商（qidianai.xyz）确认：")
-                print("     - 是否支持 /v1/images/generations 接口")
-                print("     - 正确的端点路径是什么")
-                print("     - 是否需要不同的 base URL")
-                print("  2. 检查 API 文档：")
-                print("     https://doc.newapi.pro/api/openai-image/")
-                print("  3. 确认 API Key 是否有权限访问该接口")
+                info['error_kind'] = error.kind
+                self.backend_pool.release(backend, error_kind=error.kind, error_message=str(error))
+                # 多后端时单个后端的故障由后端池摘除处理；只有所有后端都不健康时才计入全局熔断
+                if self.backend_pool.size == 1 or self.backend_pool.healthy_count() == 0:
+                    self.circuit_breaker.record_failure(error.kind, str(error))
+            finally:
+                # 半开状态下探测请求没有得出结论（多后端时仍有健康后端、意外异常）：释放探测名额，由下一个请求继续探测
+                self.circuit_breaker.release_probe()
+            if not self.retry_policy.should_retry(error.kind, attempt):
+                if attempt > 1:
+                    print(f"✗ 已重试 {attempt - 1} 次仍失败（{error.kind}），放弃该图片")
+                return None, None
             
-            return None
-        except httpx.RequestError as e:
-            elapsed = time.time() - start_time
-            print(f"\n✗ 请求错误: {type(e).__name__}: {e}")
-            print(f"已耗时: {elapsed:.2f} 秒")
-            return None
-        except Exception as e:
-            print(f"✗ 编辑图片时出错: {type(e).__name__}: {e}")
-            import traceback
-            print("详细错误信息:")
-            traceback.print_exc()
+            delay = self.retry_policy.delay(attempt)
+            print(f"⚠️ 可重试错误（{error.kind}），{delay:.1f} 秒后进行第 {attempt + 1}/"
+                  f"{self.retry_policy.max_attempts} 次尝试（复用已准备的上传数据）")
+            report_phase('retrying')
+            with timer.phase('retry_wait'):
+                time.sleep(delay)
+    
+    def _edit_once(self, backend: Backend, files: dict,
+                   on_trace: Callable[[str, dict], None],
+                   report_phase: Callable[[str], None],
+                   start_time: float,
+                   timer: PhaseTimer,
+                   timeout: httpx.Timeout) -> Tuple[Image.Image, bytes, Optional[dict]]:
+        """
+        发送一次编辑请求并解析结果
+        
+        Returns:
+            (edited_image, raw_bytes, usage) - 编辑后的图片及其原始字节（用于写入缓存），
+            以及响应中的 token 用量（normalize_usage 的结果，响应未带 usage 时为 None）
+        
+        Raises:
+            EditError: 响应状态码错误或结果无法解析（kind 用于决定是否重试）
+            httpx.RequestError: 网络错误
+        """
+        # 发送请求
+        print(f"开始发送API请求... (时间: {time.strftime('%H:%M:%S')})")
+        print(f"请求格式: multipart/form-data (文件上传)")
+        print(f"图片参数名: image[] (文件格式)")
+        
+        response = self._post_edit(backend, files, on_trace, report_phase, timer, timeout)
+        
+        elapsed = time.time() - start_time
+        print(f"API已响应，耗时: {elapsed:.2f} 秒 ({elapsed/60:.1f} 分钟)")
+        print(f"响应状态码: {response.status_code}")
+        
+        # 检查响应
+        if response.status_code != 200:
+            print(f"API返回错误状态码: {response.status_code}")
+            print(f"响应内容: {response.text[:500]}")
+            raise EditError(classify_status(response.status_code),
+                            f"API返回错误状态码: {response.status_code}")
+        
+        report_phase('decoding')
+        # 流式接收响应：边接收边把 b64_json 分块解码到同一个缓冲区，其余 JSON 只保留元数据
+        decoder = B64JsonStreamDecoder()
+        download_started = time.perf_counter()
+        feed_seconds = 0.0
+        try:
+            for chunk in response.iter_bytes():
+                feed_started = time.perf_counter()
+                decoder.feed(chunk)
+                feed_seconds += time.perf_counter() - feed_started
+            decoder.close()
+            data = decoder.metadata()
+        except (ValueError, UnicodeDecodeError) as e:
+            # 响应被截断或 JSON 不完整，可重试
+            print(f"错误: 无法解析JSON响应: {e}")
+            print(f"已接收: {decoder.received_bytes} 字节")
+            raise EditError('decode', f"无法解析JSON响应: {e}")
+        finally:
+            response.close()
+            # 接收与 Base64 解码交替进行，分开统计
+            timer.add('download', time.perf_counter() - download_started - feed_seconds)
+            timer.add('b64_decode', feed_seconds)
+            timer.add_bytes('response', decoder.received_bytes)
+        
+        # 只记录元数据，不序列化整段 Base64
+        print(f"响应数据: 共 {decoder.received_bytes} 字节, b64_json {decoder.b64_chars} 字符, "
+              f"元数据: {json.dumps(data, ensure_ascii=False)[:500]}")
+        
+        # 根据正确的任务日志，响应格式应该是：
+        # {
+        #   "created": 1589478378,
+        #   "data": [
+        #     {
+        #       "url": "https://...",
+        #       "b64_json": "..."
+        #     }
+        #   ],
+        #   "usage": {...}  // 可选
+        # }
+        
+        if not (isinstance(data, dict) and data.get('data')):
+            print(f"错误: 响应数据格式不正确")
+            raise EditError('format', "响应数据格式不正确")
+        
+        result = data['data'][0]
+        image_bytes_decoded = decoder.image_bytes()
+        
+        # token 使用情况（如果有），用于费用统计和预算
+        usage = normalize_usage(data.get('usage'))
+        if usage is not None:
+            print(f"Token使用: 总计={usage['total_tokens']}, 输入={usage['input_tokens']}, "
+                  f"输出={usage['output_tokens']}, 预估费用=${usage['cost']:.4f}")
+        
+        # 检查是否有 base64 编码的图片
+        if image_bytes_decoded is not None:
+            try:
+                with timer.phase('decode'):
+                    edited_image = Image.open(io.BytesIO(image_bytes_decoded))
+                    edited_image.load()
+                print(f"✓ 图片编辑完成，尺寸: {edited_image.size}")
+            except Exception as decode_error:
+                print(f"✗ Base64 解码失败: {decode_error}")
+                print(f"Base64 字符串长度: {decoder.b64_chars}")
+                raise EditError('decode', f"Base64 解码失败: {decode_error}")
             
-            # 提供更友好的错误信息
-            error_str = str(e).lower()
-            error_type = type(e).__name__
+            return edited_image, image_bytes_decoded, usage
+        
+        # 检查是否有 URL：经共享连接池流式下载，边接收边解码，中断时续传
+        elif result.get('url'):
+            print(f"尝试从URL下载图片: {result['url']}")
+            edited_image, raw_bytes = self._download_result(result['url'], timer)
+            print(f"✓ 图片编辑完成（从URL下载），尺寸: {edited_image.size}")
+            return edited_image, raw_bytes, usage
+        
+        else:
+            print(f"错误: 响应中未找到图片数据")
+            print(f"可用字段: {list(result.keys())}")
+            raise EditError('format', "响应中未找到图片数据")
+    
+    def _download_result(self, url: str, timer: PhaseTimer) -> Tuple[Image.Image, bytes]:
+        """
+        下载 url 类型的结果（有界缓冲 + 增量解码 + Range 续传）
+        
+        Returns:
+            (edited_image, raw_bytes)
+        
+        Raises:
+            EditError: 状态码错误或图片无法解码
+            httpx.RequestError: 连接失败或续传次数用完
+        """
+        download = ResultDownload()
+        download_started = time.perf_counter()
+        try:
+            try:
+                download.fetch(
+                    self.http_pool.client, url,
+                    timeout=httpx.Timeout(connect=TIMEOUT_CONNECT, read=DOWNLOAD_READ_TIMEOUT,
+                                          write=DOWNLOAD_READ_TIMEOUT, pool=DOWNLOAD_READ_TIMEOUT),
+                    extensions=self.http_pool.extensions()
+                )
+                edited_image = download.image()
+            except (EditError, httpx.RequestError):
+                raise
+            except Exception as decode_error:
+                print(f"✗ 下载的图片无法解码: {decode_error}")
+                raise EditError('decode', f"下载的图片无法解码: {decode_error}")
+            if download.resumes:
+                print(f"下载完成（续传 {download.resumes} 次）")
+            return edited_image, download.getvalue()
+        finally:
+            # 下载与增量解码交替进行，分开统计
+            timer.add('download', time.perf_counter() - download_started - download.decode_seconds)
+            timer.add('decode', download.decode_seconds)
+            timer.add_bytes('response', download.received_bytes)
+            download.close()
+    
+    def _print_connect_refused_hints(self, error_msg: str):
+        """连接被拒绝时打印诊断信息"""
+        if "10061" in error_msg or "积极拒绝" in error_msg:
+            print("\n" + "=" * 60)
+            print("连接被拒绝 - 诊断信息")
+            print("=" * 60)
+            print(f"API地址: {self.api_base_url}")
+            print(f"端点: /v1/images/generations")
+            print(f"完整URL: {self.api_base_url}/v1/images/generations")
+            print("\n可能的原因：")
+            print("  1. API端点路径不正确")
+            print("  2. API服务器不支持该接口")
+            print("  3. 需要联系API提供商确认正确的端点路径")
+            print("  4. API服务当前不可用或配置有问题")
+            print("\n建议：")
+            print("  1. 联系 API 提供商（qidianai.xyz）确认：")
+            print("     - 是否支持 /v1/images/generations 接口")
+            print("     - 正确的端点路径是什么")
+            print("     - 是否需要不同的 base URL")
+            print("  2. 检查 API 文档：")
+            print("     https://doc.newapi.pro/api/openai-image/")
+            print("  3. 确认 API Key 是否有权限访问该接口")
+    
+    def _print_error_hints(self, e: Exception):
+        """未分类异常时打印更友好的错误提示"""
+        # 提供更友好的错误信息
+        error_str = str(e).lower()
+        error_type = type(e).__name__
+        
+        # 检查是否是连接错误
+        if "connection" in error_str or "connect" in error_str:
+            print("\n" + "=" * 60)
+            print("连接错误诊断")
+            print("=" * 60)
+            print(f"API地址: {self.api_base_url}")
+            print("\n可能的原因：")
+            print("  1. API服务器不可访问或已关闭")
+            print("  2. API端点路径不正确")
+            print("  3. 网络连接被阻止（防火墙/代理）")
+            print("  4. DNS解析失败")
+            print("\n诊断步骤：")
+            print("  1. 测试基础连接:")
+            print("     python test_connection_qidianai.py")
+            print("  2. 检查API端点是否正确")
+            print("  3. 确认API服务器是否支持图片编辑功能")
             
-            # 检查是否是连接错误
-            if "connection" in error_str or "connect" in error_str:
-                print("\n" + "=" * 60)
-                print("连接错误诊断")
-                print("=" * 60)
-                print(f"API地址: {self.api_base_url}")
-                print("\n可能的原因：")
-                print("  1. API服务器不可访问或已关闭")
-                print("  2. API端点路径不正确")
-                print("  3. 网络连接被阻止（防火墙/代理）")
-                print("  4. DNS解析失败")
-                print("\n诊断步骤：")
-                print("  1. 测试基础连接:")
-                print("     python test_connection_qidianai.py")
-                print("  2. 检查API端点是否正确")
-                print("  3. 确认API服务器是否支持图片编辑功能")
+            # 尝试诊断连接问题
+            try:
+                import socket
+                hostname = "api.qidianai.xyz"
+                ip = socket.gethostbyname(hostname)
+                print(f"\n✓ DNS解析成功: {hostname} -> {ip}")
                 
-                # 尝试诊断连接问题
-                try:
-                    import socket
-                    hostname = "api.qidianai.xyz"
-                    ip = socket.gethostbyname(hostname)
-                    print(f"\n✓ DNS解析成功: {hostname} -> {ip}")
-                    
-                    # 测试TCP连接
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(5)
-                    result = sock.connect_ex((ip, 443))
-                    sock.close()
-                    if result == 0:
-                        print(f"✓ TCP连接成功: {ip}:443")
-                    else:
-                        print(f"✗ TCP连接失败: 错误代码 {result}")
-                except Exception as diag_error:
-                    print(f"✗ 连接诊断失败: {diag_error}")
-            
-            elif "api key" in error_str or "authentication" in error_str:
-                print("\n提示: 可能是API Key配置错误，请检查.env文件")
-            elif "rate limit" in error_str or "quota" in error_str:
-                print("\n提示: 可能是API配额或速率限制，请稍后再试")
-            elif "timeout" in error_str:
-                print("\n提示: 网络连接超时，可能的原因：")
-                print("  1. 网络连接不稳定")
-                print("  2. API服务器响应慢（图片处理是同步的，需要较长时间）")
-                print("  3. 防火墙阻止连接")
-                print("  4. DNS解析问题")
-                print("\n当前超时设置:")
-                print("  - 总超时: 5分钟")
-                print("  - 连接超时: 5分钟")
-                print("  - 读取超时: 5分钟")
-                print("\n建议：")
-                print("  - 检查网络连接: python test_connection_qidianai.py")
-                print("  - 确认API服务器是否可访问")
-                print("  - 如果超时时间不够，可以进一步增加")
-            elif "model" in error_str:
-                print("\n提示: 可能是模型名称错误，当前使用: gpt-image-1")
-            
-            return None
+                # 测试TCP连接
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.settimeout(5)
+                result = sock.connect_ex((ip, 443))
+                sock.close()
+                if result == 0:
+                    print(f"✓ TCP连接成功: {ip}:443")
+                else:
+                    print(f"✗ TCP连接失败: 错误代码 {result}")
+            except Exception as diag_error:
+                print(f"✗ 连接诊断失败: {diag_error}")
+        
+        elif "api key" in error_str or "authentication" in error_str:
+            print("\n提示: 可能是API Key配置错误，请检查.env文件")
+        elif "rate limit" in error_str or "quota" in error_str:
+            print("\n提示: 可能是API配额或速率限制，请稍后再试")
+        elif "timeout" in error_str:
+            print("\n提示: 网络连接超时，可能的原因：")
+            print("  1. 网络连接不稳定")
+            print("  2. API服务器响应慢（图片处理是同步的，需要较长时间）")
+            print("  3. 防火墙阻止连接")
+            print("  4. DNS解析问题")
+            timeout_stats = self.timeouts.stats()
+            print("\n当前超时设置:")
+            print(f"  - 连接超时: {timeout_stats['connect']:g} 秒")
+            print(f"  - 读取超时: {timeout_stats['read']:g} 秒（按 {timeout_stats['server_wait_samples']} 个历史样本计算）")
+            print("  - 写入超时: 按上传大小和实测带宽计算")
+            print("\n建议：")
+            print("  - 检查网络连接: python test_connection_qidianai.py")
+            print("  - 确认API服务器是否可访问")
+            print("  - 如果超时时间不够，可以调大 TIMEOUT_READ_FACTOR / TIMEOUT_READ_MIN")
+        elif "model" in error_str:
+            print(f"\n提示: 可能是模型名称错误，当前使用: {self.MODEL}")
     
     def enhance_image_with_ai(
         self,
@@ -403,4 +822,32 @@ class GPTHandler:
         clear_image = self.edit_image(image, target_size, prompt=prompt)
         
         return clear_image
+    
+    def pool_stats(self) -> dict:
+        """连接池统计（新建连接数/复用连接数等），用于对比连接复用的收益"""
+        return self.http_pool.stats.snapshot()
+    
+    def cache_stats(self) -> dict:
+        """结果缓存统计（命中/未命中/淘汰等）"""
+        return self.result_cache.stats()
+    
+    def rate_limit_stats(self) -> dict:
+        """限流统计（所有后端汇总：限流次数、暂停剩余时间、最近事件）"""
+        return self.backend_pool.rate_limit_stats()
+    
+    def backend_stats(self) -> dict:
+        """后端池状态（每个后端的在途请求、延迟、健康状况）"""
+        return self.backend_pool.stats()
+    
+    def usage_stats(self) -> dict:
+        """今天的累计用量和预估费用"""
+        return self.usage_ledger.day()
+    
+    def single_flight_stats(self) -> dict:
+        """单飞合并统计（发起请求数、合并的重复请求数）"""
+        return self.single_flight.stats()
+    
+    def circuit_stats(self) -> dict:
+        """熔断器状态（closed/open/half_open 及熔断原因）"""
+        return self.circuit_breaker.stats()
 
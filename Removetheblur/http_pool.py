@@ -0,0 +1,153 @@
+"""
+共享HTTP连接池
+整个进程共用一个 httpx.Client：keep-alive 长连接、HTTP/2 多路复用（服务端支持时）、
+复用已建立的 TLS 连接，避免每张图片都重新做 DNS/TCP/TLS 握手
+"""
+import atexit
+import importlib.util
+import threading
+from typing import Callable, Optional
+
+import httpx
+
+from config import (
+    HTTP2_ENABLED,
+    HTTP_POOL_MAX_CONNECTIONS,
+    HTTP_POOL_MAX_KEEPALIVE,
+    HTTP_KEEPALIVE_EXPIRY,
+)
+
+
+class PoolStats:
+    """连接池统计（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.connections_opened = 0
+            self.tls_handshakes = 0
+            self.http2_responses = 0
+            self.http1_responses = 0
+
+    def add(self, field: str, n: int = 1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def snapshot(self) -> dict:
+        """返回统计快照；复用数 = 请求数 - 新建连接数"""
+        with self._lock:
+            reused = max(0, self.requests - self.connections_opened)
+            return {
+                'requests': self.requests,
+                'connections_opened': self.connections_opened,
+                'connections_reused': reused,
+                'tls_handshakes': self.tls_handshakes,
+                'http2_responses': self.http2_responses,
+                'http1_responses': self.http1_responses,
+                'reuse_rate': round(reused / self.requests, 3) if self.requests else 0.0,
+            }
+
+
+class HTTPPool:
+    """线程安全的共享连接池（httpx.Client 本身可在多线程间共享）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client: Optional[httpx.Client] = None
+        self.stats = PoolStats()
+        # HTTP/2 需要额外安装 h2（pip install httpx[http2]），未安装时退回 HTTP/1.1 并给出提示
+        self.http2 = HTTP2_ENABLED and importlib.util.find_spec('h2') is not None
+        if HTTP2_ENABLED and not self.http2:
+            print("⚠️  警告: HTTP2_ENABLED=1 但未安装 h2，连接池使用 HTTP/1.1；"
+                  "启用 HTTP/2 请运行: pip install httpx[http2]")
+
+    @property
+    def client(self) -> httpx.Client:
+        """获取（必要时创建）共享客户端"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(
+                        http2=self.http2,
+                        verify=False,
+                        follow_redirects=True,
+                        limits=httpx.Limits(
+                            max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                            max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+                            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                        ),
+                        event_hooks={
+                            'request': [self._on_request],
+                            'response': [self._on_response],
+                        },
+                    )
+        return self._client
+
+    def extensions(self, listener: Optional[Callable[[str, dict], None]] = None) -> dict:
+        """
+        单次请求的 extensions 参数，通过 httpcore trace 统计新建连接和 TLS 握手
+
+        用法: pool.client.post(url, ..., extensions=pool.extensions())
+
+        Args:
+            listener: 可选，接收该请求的每个 trace 事件 (event_name, info)，
+                      例如用 "*.send_request_body.complete" 判断上传已结束
+        """
+        if listener is None:
+            return {'trace': self._trace}
+
+        def trace(event_name: str, info: dict):
+            self._trace(event_name, info)
+            try:
+                listener(event_name, info)
+            except Exception:
+                pass
+
+        return {'trace': trace}
+
+    def _trace(self, event_name: str, info: dict):
+        if event_name == 'connection.connect_tcp.complete':
+            self.stats.add('connections_opened')
+        elif event_name == 'connection.start_tls.complete':
+            self.stats.add('tls_handshakes')
+
+    def _on_request(self, request: httpx.Request):
+        self.stats.add('requests')
+
+    def _on_response(self, response: httpx.Response):
+        if response.http_version == 'HTTP/2':
+            self.stats.add('http2_responses')
+        else:
+            self.stats.add('http1_responses')
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+
+_shared_pool: Optional[HTTPPool] = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_http_pool() -> HTTPPool:
+    """获取进程级共享连接池（跨批次、跨 GPTHandler 实例复用）"""
+    global _shared_pool
+    if _shared_pool is None:
+        with _shared_pool_lock:
+            if _shared_pool is None:
+                _shared_pool = HTTPPool()
+                atexit.register(_shared_pool.close)
+    return _shared_pool
+
+
+def get_pool_stats() -> dict:
+    """连接池统计快照（未创建连接池时返回空统计）"""
+    if _shared_pool is None:
+        return PoolStats().snapshot()
+    return _shared_pool.stats.snapshot()
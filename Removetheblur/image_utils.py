@@ -2,27 +2,231 @@
 图片处理工具函数
 只使用 Pillow + numpy
 """
-from PIL import Image, ImageEnhance, ImageFilter
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
 import numpy as np
 from typing import Tuple, Optional, List
 import io
+import os
+import time
 import base64
+from config import (
+    DECODE_REDUCING_GAP, OUTPUT_QUALITY, OUTPUT_PROFILE, OUTPUT_TARGET_KB, OUTPUT_MIN_QUALITY,
+    OUTPUT_FORMAT, OUTPUT_PROGRESSIVE
+)
 
+# EXIF 方向为旋转 90°/270° 的取值
+_ROTATED_ORIENTATIONS = {5, 6, 7, 8}
 
-def load_image(image_path: str) -> Image.Image:
-    """加载图片"""
-    return Image.open(image_path)
+# 输出编码方案、输出格式对应的扩展名
+OUTPUT_PROFILES = ('fast', 'balanced', 'size')
+OUTPUT_EXTENSIONS = {'jpeg': '.jpg', 'webp': '.webp'}
 
+# Image.reduce() 不支持的模式：降采样前先转换（P 模式另按是否带透明色转 RGBA/RGB）
+_REDUCE_MODES = {'1': 'L', 'I;16': 'I', 'I;16L': 'I', 'I;16B': 'I', 'I;16N': 'I'}
 
-def save_image(image: Image.Image, output_path: str, quality: int = 95):
-    """保存图片"""
-    if image.mode == 'RGBA':
-        # 如果是RGBA模式，转换为RGB
-        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-        rgb_image.paste(image, mask=image.split()[3])
-        rgb_image.save(output_path, quality=quality, optimize=True)
+
+def load_image(image_path: str, target_size: Optional[Tuple[int, int]] = None,
+               reducing_gap: float = DECODE_REDUCING_GAP) -> Image.Image:
+    """
+    加载图片
+    
+    Args:
+        image_path: 图片路径
+        target_size: 可选，调用方最终会缩放到的尺寸 (width, height)。给定时按需降采样解码：
+                     JPEG 用 draft() 让解码器直接输出 1/2、1/4、1/8 尺寸（在 DCT 域缩小，比全尺寸解码快得多），
+                     之后再用 reduce() 做整数倍缩小；解码结果不小于 target_size × reducing_gap
+        reducing_gap: 降采样解码保留的余量倍数（与 Image.thumbnail 的 reducing_gap 含义相同），0 表示不降采样
+    
+    Returns:
+        图片（降采样时 info['original_size'] 为原始尺寸）
+    """
+    image = Image.open(image_path)
+    if target_size is None or not reducing_gap:
+        return image
+    return reduce_for_target(image, target_size, reducing_gap)
+
+
+def reduce_for_target(image: Image.Image, target_size: Tuple[int, int],
+                      reducing_gap: float = DECODE_REDUCING_GAP) -> Image.Image:
+    """
+    对刚打开（尚未解码）的图片按目标尺寸降采样解码，见 load_image
+    （reduce() 不支持的模式先转换：P 转 RGB/RGBA，1 转 L，I;16 转 I）
+    """
+    if not reducing_gap:
+        return image
+    image.info.setdefault('original_size', image.size)
+    need_w = max(1, int(target_size[0] * reducing_gap))
+    need_h = max(1, int(target_size[1] * reducing_gap))
+    try:
+        orientation = image.getexif().get(0x0112, 1)
+    except Exception:
+        orientation = 1
+    if orientation in _ROTATED_ORIENTATIONS:
+        # 调用方可能先按 EXIF 旋转再缩放：两个方向都要留够
+        need_w = need_h = max(need_w, need_h)
+    if image.format == 'JPEG':
+        image.draft(image.mode, (need_w, need_h))
+    factor = min(image.size[0] // need_w, image.size[1] // need_h)
+    if factor >= 2:
+        original_size = image.info['original_size']
+        if image.mode == 'P':
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        elif image.mode in _REDUCE_MODES:
+            image = image.convert(_REDUCE_MODES[image.mode])
+        image = image.reduce(factor)
+        image.info['original_size'] = original_size
+    return image
+
+
+def make_preview(image_path: str, max_side: int, quality: int = 85) -> Tuple[bytes, str]:
+    """
+    生成预览图（降采样解码，不解码全分辨率），按 EXIF 方向旋转
+    
+    Returns:
+        (图片字节, MIME类型) - 带透明通道时为 PNG，否则为 JPEG
+    """
+    with Image.open(image_path) as image:
+        scale = min(1.0, max_side / max(image.size))
+        target = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+        preview = reduce_for_target(image, target)
+        preview = ImageOps.exif_transpose(preview)
+        preview.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    if preview.mode in ('RGBA', 'LA', 'PA') or (preview.mode == 'P' and 'transparency' in preview.info):
+        preview.save(buffer, format='PNG')
+        return buffer.getvalue(), 'image/png'
+    if preview.mode != 'RGB':
+        preview = preview.convert('RGB')
+    preview.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue(), 'image/jpeg'
+
+
+def parse_output_profile(profile: str = None) -> str:
+    """校验输出编码方案，None 返回 OUTPUT_PROFILE"""
+    profile = (profile or OUTPUT_PROFILE).strip().lower()
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(f"OUTPUT_PROFILE 无效: {profile}（可选: {', '.join(OUTPUT_PROFILES)}）")
+    return profile
+
+
+def output_extension(fmt: str = None) -> str:
+    """输出格式（默认 OUTPUT_FORMAT）对应的扩展名"""
+    fmt = (fmt or OUTPUT_FORMAT).strip().lower()
+    if fmt not in OUTPUT_EXTENSIONS:
+        raise ValueError(f"OUTPUT_FORMAT 无效: {fmt}（可选: {', '.join(OUTPUT_EXTENSIONS)}）")
+    return OUTPUT_EXTENSIONS[fmt]
+
+
+def flatten_alpha(image: Image.Image, background: Tuple[int, int, int] = (255, 255, 255)) -> Image.Image:
+    """
+    去掉透明通道：合成到纯色背景上，返回 RGB
+    透明通道全不透明时（接口返回的 PNG 常见）直接丢弃通道，不做合成；
+    合成用图片自身作掩码粘贴（Pillow 的 C 实现逐像素混合，不再 split() 复制透明通道）
+    """
+    if image.mode in ('RGB', 'L'):
+        return image
+    if image.mode == 'P' and 'transparency' in image.info:
+        image = image.convert('RGBA')
+    if image.mode in ('RGBA', 'LA', 'PA'):
+        if image.getchannel('A').getextrema()[0] == 255:
+            return image.convert('RGB')
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        flat = Image.new('RGB', image.size, background)
+        flat.paste(image, mask=image)
+        return flat
+    return image.convert('RGB')
+
+
+def _encode(image: Image.Image, pil_format: str, profile: str, quality: int, progressive: bool) -> bytes:
+    """按编码方案编码一次"""
+    buffer = io.BytesIO()
+    if pil_format == 'JPEG':
+        image.save(buffer, format='JPEG', quality=quality, optimize=profile != 'fast',
+                   progressive=progressive)
+    elif pil_format == 'WEBP':
+        image.save(buffer, format='WEBP', quality=quality, method=0 if profile == 'fast' else 4)
+    elif pil_format == 'PNG':
+        if profile == 'fast':
+            image.save(buffer, format='PNG', compress_level=1)
+        else:
+            image.save(buffer, format='PNG', optimize=True)
     else:
-        image.save(output_path, quality=quality, optimize=True)
+        image.save(buffer, format=pil_format, quality=quality)
+    return buffer.getvalue()
+
+
+def encode_output(image: Image.Image, pil_format: str, quality: int = None, profile: str = None,
+                  target_bytes: int = None, progressive: bool = None) -> Tuple[bytes, dict]:
+    """
+    按输出编码方案编码图片
+
+    Args:
+        image: 图片（JPEG 需为 RGB/L）
+        pil_format: PIL 格式名（JPEG / WEBP / PNG 等）
+        quality: 质量，默认 OUTPUT_QUALITY（size 方案时为质量上限）
+        profile: fast / balanced / size，默认 OUTPUT_PROFILE
+        target_bytes: size 方案的字节预算，默认 OUTPUT_TARGET_KB
+        progressive: JPEG 是否渐进式，默认 OUTPUT_PROGRESSIVE
+
+    size 方案（仅 JPEG/WebP）：先按质量上限编码，超出预算时在 [OUTPUT_MIN_QUALITY, 上限] 内二分查找
+    不超出预算的最高质量；查找时用 fast 方案（不做 optimize），最后按 balanced 方案编码一次
+    （同质量下 optimize 只会更小；WebP 不保证，超出时用查找时的结果）
+
+    Returns:
+        (编码字节, {'format', 'profile', 'quality', 'attempts'})
+    """
+    profile = parse_output_profile(profile)
+    quality = OUTPUT_QUALITY if quality is None else quality
+    progressive = OUTPUT_PROGRESSIVE if progressive is None else progressive
+    progressive = progressive and pil_format == 'JPEG'
+    info = {'format': pil_format, 'profile': profile, 'quality': quality, 'attempts': 1}
+    if profile != 'size' or pil_format not in ('JPEG', 'WEBP'):
+        return _encode(image, pil_format, profile, quality, progressive), info
+
+    budget = (OUTPUT_TARGET_KB * 1024) if target_bytes is None else target_bytes
+    data = _encode(image, pil_format, 'fast', quality, progressive)
+    best = (quality, data)
+    if len(data) > budget:
+        low, high = min(OUTPUT_MIN_QUALITY, quality), quality - 1
+        best = None
+        while low <= high:
+            mid = (low + high) // 2
+            data = _encode(image, pil_format, 'fast', mid, progressive)
+            info['attempts'] += 1
+            if len(data) <= budget:
+                best = (mid, data)
+                low = mid + 1
+            else:
+                high = mid - 1
+        if best is None:
+            # 最低质量也超出预算：使用最低质量
+            best = (min(OUTPUT_MIN_QUALITY, quality), data)
+    info['quality'] = best[0]
+    final = _encode(image, pil_format, 'balanced', best[0], progressive)
+    info['attempts'] += 1
+    return (final if len(final) <= len(best[1]) else best[1]), info
+
+
+def save_image(image: Image.Image, output_path: str, quality: int = None, profile: str = None,
+               target_bytes: int = None, progressive: bool = None) -> dict:
+    """
+    保存图片（格式按扩展名，编码方案见 encode_output；JPEG 等不支持透明的格式先去掉透明通道）
+
+    Returns:
+        {'format', 'profile', 'quality', 'attempts', 'bytes': 输出字节数, 'encode_seconds': 去透明+编码耗时}
+    """
+    start = time.perf_counter()
+    ext = os.path.splitext(output_path)[1].lower()
+    pil_format = Image.registered_extensions().get(ext, 'JPEG')
+    if pil_format in ('JPEG', 'BMP') or (pil_format == 'WEBP' and image.mode not in ('RGB', 'RGBA')):
+        image = flatten_alpha(image)
+    data, info = encode_output(image, pil_format, quality, profile, target_bytes, progressive)
+    info['encode_seconds'] = round(time.perf_counter() - start, 4)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    info['bytes'] = len(data)
+    return info
 
 
 def resize_image_smart(image: Image.Image, target_size: Tuple[int, int], 
@@ -97,72 +301,46 @@ def split_image_vertical(image: Image.Image, target_width: int = 1024) -> List[I
 
 def merge_images_vertical(images: List[Image.Image], target_size: Tuple[int, int]) -> Image.Image:
     """
-    将两张图片无缝拼接成目标尺寸（1024×1536）
-    使用渐变融合实现无缝拼接
+    将上下互相重叠的图片无缝拼接成目标尺寸（如两张 1024×1024 → 1024×1536）
+    各图缩放到目标宽度，第一张贴齐顶部、最后一张贴齐底部，中间的均匀分布，
+    重叠区按 BLEND_METHOD 融合（见 blending）；总高度不足以覆盖目标尺寸时直接拼接后缩放
     
     Args:
-        images: 图片列表（应该有两张 1024×1024 的图片）
+        images: 图片列表（从上到下）
         target_size: 目标尺寸 (width, height)，如 (1024, 1536)
     
     Returns:
         拼接后的图片
     """
+    from blending import blend_tiles
+    
     if len(images) == 1:
         # 如果只有一张图，直接调整尺寸
         return resize_image_smart(images[0], target_size, method='lanczos')
     
-    if len(images) != 2:
-        raise ValueError(f"需要1或2张图片，但提供了{len(images)}张")
-    
-    top_image, bottom_image = images[0], images[1]
-    
-    # 确保两张图片都是1024×1024
-    if top_image.size != (1024, 1024):
-        top_image = resize_image_smart(top_image, (1024, 1024), method='lanczos')
-    if bottom_image.size != (1024, 1024):
-        bottom_image = resize_image_smart(bottom_image, (1024, 1024), method='lanczos')
-    
-    # 转换为numpy数组
-    top_array = np.array(top_image)
-    bottom_array = np.array(bottom_image)
-    
     target_width, target_height = target_size
+    scaled = []
+    for image in images:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        height = max(1, round(image.size[1] * target_width / image.size[0]))
+        if image.size != (target_width, height):
+            image = resize_image_smart(image, (target_width, height), method='lanczos')
+        scaled.append(image)
     
-    # 对于1024×1536：需要1024行 + 512行 = 1536行
-    # 上半部分：使用top_image的全部1024行
-    # 下半部分：使用bottom_image的后512行
-    
-    if target_size == (1024, 1536):
-        # 创建结果数组
-        result_array = np.zeros((target_height, target_width, 3), dtype=np.uint8)
-        
-        # 上半部分：使用top_image的全部1024行
-        result_array[:1024] = top_array[:1024]
-        
-        # 下半部分：使用bottom_image的后512行
-        # 从bottom_image的第512行开始（1024 - 512 = 512）
-        result_array[1024:] = bottom_array[512:]
-        
-        # 在拼接处进行渐变融合（可选，使拼接更自然）
-        # 在1024行附近进行少量融合
-        blend_width = 16  # 融合区域宽度
-        for i in range(blend_width):
-            alpha = i / blend_width  # 0到1的渐变
-            y = 1024 - blend_width + i
-            if 0 <= y < target_height:
-                result_array[y] = (
-                    top_array[y] * (1 - alpha) +
-                    bottom_array[512 + i] * alpha
-                ).astype(np.uint8)
-        
-        # 转换回PIL Image
-        return Image.fromarray(result_array)
-    else:
-        # 其他尺寸：简单拼接
-        result_array = np.vstack([top_array, bottom_array])
-        result_image = Image.fromarray(result_array)
-        # 调整到目标尺寸
+    heights = [image.size[1] for image in scaled]
+    if sum(heights) < target_height:
+        # 没有重叠：简单拼接后调整到目标尺寸
+        result_image = Image.fromarray(np.vstack([np.asarray(image) for image in scaled]))
         return resize_image_smart(result_image, target_size, method='lanczos')
+    
+    last = len(scaled) - 1
+    boxes = []
+    for i, height in enumerate(heights):
+        top = min(round(i * (target_height - height) / last), target_height - height)
+        boxes.append((0, max(0, top), target_width, max(0, top) + min(height, target_height)))
+    return blend_tiles([image.crop((0, 0, target_width, box[3] - box[1])) for image, box in zip(scaled, boxes)],
+                       target_size, boxes)
 
 
 def image_to_base64(image: Image.Image, format: str = 'PNG') -> str:
@@ -5,6 +5,11 @@ import argparse
 import sys
 from pathlib import Path
 from deblur_agent import DeblurAgent
+from batch_runner import process_images_batch, processing_status
+from image_utils import output_extension
+from edit_backend import create_edit_backend
+from tiling import should_tile, plan_tiles, parse_grid
+from config import TILE_GRID
 
 
 def main():
@@ -24,6 +29,13 @@ def main():
   
   # 完整示例
   python main.py photo.jpg -o result.jpg -s 2160x3240
+  
+  # 使用本地后端（不调用API，用于离线测试）
+  python main.py photo.jpg --backend local
+  
+  # 批量处理文件夹（结果写入 photos_clear/，中断后加 --resume 续跑，跳过已完成的图片）
+  python main.py photos/ -o photos_clear
+  python main.py photos/ -o photos_clear --resume
 
 注意: 使用固定提示词"请把这个图变成全景深，整个画面中模糊虚化的地方变清晰，边缘锐利。"
 使用OpenAI Images API (gpt-image-1模型) 直接编辑现有图片，不带mask整图修复。
@@ -32,19 +44,31 @@ def main():
     parser.add_argument(
         "input",
         type=str,
-        help="输入图片路径（必需）"
+        help="输入图片路径，或图片文件夹（批量处理）"
     )
     parser.add_argument(
         "-o", "--output",
         type=str,
         default=None,
-        help="输出图片路径（默认：输入文件名_clear.jpg）"
+        help="输出图片路径（默认：输入文件名_clear.jpg，OUTPUT_FORMAT=webp 时为 .webp）；批量处理时为输出文件夹（默认：输入文件夹名_clear）"
     )
     parser.add_argument(
         "-s", "--size",
         type=str,
         default=None,
-        help="目标尺寸，格式：WIDTHxHEIGHT（例如：1792x1024）。注意：DALL-E 3支持的尺寸为1024x1024, 1792x1024, 1024x1792"
+        help="目标尺寸，格式：WIDTHxHEIGHT（例如：2160x3240）。接口支持的尺寸为1024x1024, 1024x1536, 1536x1024，其他尺寸分块处理后拼接"
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["http", "local"],
+        default=None,
+        help="编辑后端：http（调用API）或 local（本地处理，不需要API密钥），默认使用 EDIT_BACKEND 配置"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="批量处理时续跑：按输出文件夹中的会话日志跳过已完成的图片，只处理未完成或失败的图片"
     )
     
     args = parser.parse_args()
@@ -55,14 +79,8 @@ def main():
         print(f"错误：输入文件不存在: {input_path}")
         sys.exit(1)
     
-    # 确定输出路径
-    if args.output:
-        output_path = Path(args.output)
-    else:
-        output_path = input_path.parent / f"{input_path.stem}_clear.jpg"
-    
     # 解析目标尺寸（默认1024×1536）
-    target_size = (1024, 1536)  # 默认尺寸
+    target_size = None
     if args.size:
         try:
             width, height = map(int, args.size.split('x'))
@@ -70,7 +88,21 @@ def main():
         except ValueError:
             print(f"错误：无效的尺寸格式: {args.size}，应使用 WIDTHxHEIGHT 格式")
             sys.exit(1)
+    
+    if input_path.is_dir():
+        run_folder(input_path, args, target_size)
+        return
+    if args.resume:
+        print("提示：--resume 只用于批量处理文件夹，已忽略")
+    
+    # 确定输出路径
+    if args.output:
+        output_path = Path(args.output)
     else:
+        output_path = input_path.parent / f"{input_path.stem}_clear{output_extension()}"
+    
+    if target_size is None:
+        target_size = (1024, 1536)  # 默认尺寸
         print(f"使用默认目标尺寸: {target_size[0]}x{target_size[1]}")
     
     # 创建Agent并处理
@@ -78,11 +110,12 @@ def main():
     print("AI图片清晰化Agent")
     print("使用OpenAI Images API编辑图片")
     print("固定提示词: 请把这个图变成全景深，整个画面中模糊虚化的地方变清晰，边缘锐利。")
-    if target_size == (1024, 1536):
-        print("将切分成两张1024×1024分别修复，然后无缝拼接")
+    if should_tile(target_size):
+        print(f"目标尺寸不是接口支持的尺寸，{plan_tiles(target_size, parse_grid(TILE_GRID)).describe()}，"
+              f"各分块并发修复后拼接")
     print("=" * 60)
     
-    agent = DeblurAgent()
+    agent = DeblurAgent(create_edit_backend(args.backend))
     result = agent.process_image(
         input_path=args.input,
         output_path=str(output_path),
@@ -95,6 +128,13 @@ def main():
         print("=" * 60)
         print(f"原始尺寸: {result['original_size'][0]}x{result['original_size'][1]}")
         print(f"最终尺寸: {result['final_size'][0]}x{result['final_size'][1]}")
+        if result.get('tiles'):
+            print(f"分块数: {result['tiles']}（发送 {result.get('tiles_sent', result['tiles'])} 个）")
+        if result.get('api_size'):
+            upload_bytes = result.get('bytes', {}).get('upload')
+            print(f"接口尺寸: {result['api_size'][0]}x{result['api_size'][1]}，"
+                  f"上传尺寸: {result['upload_size'][0]}x{result['upload_size'][1]}"
+                  + (f"（{upload_bytes / 1024:.0f} KB）" if upload_bytes else ""))
         print(f"输出文件: {result['output_path']}")
         print("=" * 60)
     else:
@@ -103,6 +143,28 @@ def main():
         sys.exit(1)
 
 
+def run_folder(input_path: Path, args, target_size):
+    """批量处理文件夹（与Web批处理相同的流水线、预筛和预算），每张图片的结果记录在输出文件夹的会话日志中"""
+    output_dir = Path(args.output) if args.output else input_path.parent / f"{input_path.name}_clear"
+    process_images_batch(
+        str(input_path), str(output_dir), session_id=output_dir.name,
+        resume=args.resume, target_size=target_size, backend=args.backend
+    )
+    
+    errors = processing_status.get('errors', [])
+    print("\n" + "=" * 60)
+    print(f"批量处理结束: {processing_status.get('processed_files', 0)}/{processing_status.get('total_files', 0)} 张"
+          + (f"（续跑跳过 {processing_status['resumed_files']} 张已完成）" if processing_status.get('resumed_files') else ""))
+    print(f"输出文件夹: {output_dir}")
+    if errors:
+        print(f"错误 {len(errors)} 个（加 --resume 重新运行只处理未完成或失败的图片）:")
+        for error in errors[:20]:
+            print(f"  {error}")
+        print("=" * 60)
+        sys.exit(1)
+    print("=" * 60)
+
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,128 @@
+"""
+分阶段计时
+记录单张图片各阶段耗时和字节数（加载、缩放、编码、上传、等待服务端、下载、解码、保存），
+并按批次汇总 p50/p95/p99，用于定位慢图片的耗时到底花在哪一步
+"""
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+# 阶段名（按处理顺序，用于展示排序）：
+#   stage_wait   - 批处理流水线中在段间队列等待的时间（含背压阻塞）
+#   load         - 读取输入图片
+#   cache_lookup - 计算缓存键并查询结果缓存
+#   resize       - 转RGB并缩放到目标尺寸
+#   blur_map     - 分块处理时计算局部模糊检测
+#   encode       - 编码上传数据（PNG/WebP/JPEG）
+#   coalesced_wait - 等待正在进行的相同请求（单飞合并）
+#   queue        - 等待熔断恢复/后端名额/限速令牌
+#   connect      - 新建连接（TCP 连接 + TLS 握手，复用连接时为 0）
+#   upload       - 发送请求体
+#   server_wait  - 请求体发送完毕到收到响应头（服务端推理）
+#   download     - 接收响应体（不含 Base64 解码）
+#   b64_decode   - 流式 Base64 解码
+#   decode       - 解码结果图片
+#   process      - 本地编辑后端的图片处理
+#   retry_wait   - 重试前的退避等待
+#   merge        - 分块处理时拼接各分块
+#   restore      - 接口结果缩放回目标尺寸（接口尺寸与目标尺寸不同时）
+#   save         - 保存输出文件
+#   total        - 整张图片的总耗时
+PHASES = ('stage_wait', 'load', 'cache_lookup', 'resize', 'blur_map', 'encode', 'coalesced_wait', 'queue',
+          'connect', 'upload', 'server_wait', 'download', 'b64_decode', 'decode', 'process', 'retry_wait',
+          'merge', 'restore', 'save', 'total')
+
+
+class PhaseTimer:
+    """单张图片的阶段计时器（同一阶段多次出现时累加，例如重试）"""
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self.bytes: Dict[str, int] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """计时一个阶段: with timer.phase('resize'): ..."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        if seconds > 0:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def add_bytes(self, name: str, nbytes: int):
+        self.bytes[name] = self.bytes.get(name, 0) + int(nbytes)
+
+    def merge_parallel(self, timers: Iterable['PhaseTimer']):
+        """并行执行的子任务（如各分块）的计时并入本计时器：耗时取各阶段最大值，字节数累加"""
+        timers = list(timers)
+        for name in {name for timer in timers for name in timer.timings}:
+            self.add(name, max(timer.timings.get(name, 0.0) for timer in timers))
+        for timer in timers:
+            for name, nbytes in timer.bytes.items():
+                self.add_bytes(name, nbytes)
+
+    def as_dict(self) -> dict:
+        """{'timings': {阶段: 秒}, 'bytes': {名称: 字节数}}"""
+        order = {name: idx for idx, name in enumerate(PHASES)}
+        return {
+            'timings': {
+                name: round(self.timings[name], 4)
+                for name in sorted(self.timings, key=lambda n: order.get(n, len(order)))
+            },
+            'bytes': dict(self.bytes),
+        }
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """线性插值百分位数（sorted_values 已升序）"""
+    if not sorted_values:
+        return 0.0
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    pos = (len(sorted_values) - 1) * pct / 100.0
+    lower = int(pos)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (pos - lower)
+
+
+def _distribution(values: List[float], digits: int) -> dict:
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 50), digits),
+        'p95': round(percentile(values, 95), digits),
+        'p99': round(percentile(values, 99), digits),
+        'max': round(values[-1], digits),
+        'sum': round(sum(values), digits),
+    }
+
+
+def summarize_phases(reports: Iterable[dict]) -> dict:
+    """
+    汇总一批图片的阶段计时
+
+    Args:
+        reports: 每张图片的报告（含 'timings' / 'bytes'，来自 PhaseTimer.as_dict()）
+
+    Returns:
+        {'timings': {阶段: {count, p50, p95, p99, max, sum}}, 'bytes': {名称: {...}}}
+    """
+    timings: Dict[str, List[float]] = {}
+    byte_counts: Dict[str, List[float]] = {}
+    for report in reports:
+        for name, seconds in (report.get('timings') or {}).items():
+            timings.setdefault(name, []).append(seconds)
+        for name, nbytes in (report.get('bytes') or {}).items():
+            byte_counts.setdefault(name, []).append(nbytes)
+    order = {name: idx for idx, name in enumerate(PHASES)}
+    return {
+        'timings': {
+            name: _distribution(timings[name], 3)
+            for name in sorted(timings, key=lambda n: order.get(n, len(order)))
+        },
+        'bytes': {name: _distribution(values, 0) for name, values in byte_counts.items()},
+    }
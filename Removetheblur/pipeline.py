@@ -0,0 +1,170 @@
+"""
+批处理三段流水线
+prepare（CPU线程池：加载、缩放、编码上传数据）→ edit（I/O线程池：调用编辑接口）→ save（CPU线程池：编码保存），
+段间用有界队列连接：下游处理不过来时上游阻塞（背压），同时驻留内存的图片数有上限；
+下一张图片的本地CPU工作与当前图片的网络等待重叠，批处理时本地耗时基本被API延迟掩盖
+"""
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, Iterable, List, Optional
+
+from config import PIPELINE_PREPARE_WORKERS, PIPELINE_SAVE_WORKERS, PIPELINE_QUEUE_SIZE
+from deblur_agent import DeblurAgent, ImageJob
+
+# 队列结束标记
+_STOP = object()
+
+
+class DeblurPipeline:
+    """
+    三段流水线（每次 run 处理一批任务）
+
+    - edit_workers: 同时在途的编辑请求数（批处理的并发数）
+    - prepare_workers / save_workers: 准备/保存阶段的线程数
+    - queue_size: 每个段间队列的容量；同时驻留的图片数不超过
+      prepare_workers + edit_workers + save_workers + 2 × queue_size
+    """
+
+    def __init__(self, agent: DeblurAgent, edit_workers: int,
+                 prepare_workers: int = None, save_workers: int = None,
+                 queue_size: int = None, name: str = 'Pipeline'):
+        self.agent = agent
+        self.edit_workers = max(1, int(edit_workers))
+        self.prepare_workers = max(1, int(prepare_workers or PIPELINE_PREPARE_WORKERS))
+        self.save_workers = max(1, int(save_workers or PIPELINE_SAVE_WORKERS))
+        self.queue_size = max(1, int(queue_size or PIPELINE_QUEUE_SIZE or self.edit_workers))
+        self.name = name
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        # 各阶段正在处理的任务数
+        self._active = {'prepare': 0, 'edit': 0, 'save': 0}
+        self._edit_queue: Optional[queue.Queue] = None
+        self._save_queue: Optional[queue.Queue] = None
+
+    def cancel(self):
+        """取消尚未开始编辑的任务（已在编辑/保存的任务照常完成）"""
+        self._cancelled.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            active = dict(self._active)
+        return {
+            'prepare_workers': self.prepare_workers,
+            'edit_workers': self.edit_workers,
+            'save_workers': self.save_workers,
+            'queue_size': self.queue_size,
+            'active': active,
+            'ready_for_edit': self._edit_queue.qsize() if self._edit_queue is not None else 0,
+            'ready_for_save': self._save_queue.qsize() if self._save_queue is not None else 0,
+        }
+
+    def _set_active(self, stage: str, delta: int):
+        with self._lock:
+            self._active[stage] += delta
+
+    @staticmethod
+    def _skip(job: ImageJob):
+        job.finish({'success': False, 'skipped': True, 'error': '已跳过'})
+
+    def _worker(self, stage: str, inq: queue.Queue, outq: Optional[queue.Queue],
+                handle: Callable[[ImageJob], None]):
+        while True:
+            job = inq.get()
+            if job is _STOP:
+                return
+            # 在段间队列中等待（含上游因背压阻塞）的时间
+            enqueued = job.context.pop('_enqueued', None)
+            if enqueued is not None:
+                job.timer.add('stage_wait', time.perf_counter() - enqueued)
+            self._set_active(stage, 1)
+            try:
+                handle(job)
+            except Exception:
+                traceback.print_exc()
+                if job.result is None:
+                    job.finish({'success': False, 'error': f'{stage} 阶段异常'})
+            finally:
+                self._set_active(stage, -1)
+            if outq is not None:
+                job.context['_enqueued'] = time.perf_counter()
+                outq.put(job)
+
+    def run(self, jobs: Iterable[ImageJob],
+            before_edit: Callable[[ImageJob], bool] = None,
+            after_edit: Callable[[ImageJob], None] = None,
+            on_done: Callable[[ImageJob], None] = None):
+        """
+        处理一批任务，全部完成后返回
+
+        Args:
+            jobs: 任务（按顺序进入流水线）
+            before_edit: 编辑前回调（在编辑线程中调用，可阻塞，例如预算暂停）；返回 False 则跳过该任务
+            after_edit: 编辑结束回调（只对 before_edit 放行的任务调用）
+            on_done: 任务结束回调（成功、失败或跳过，在保存线程中调用），结果在 job.result
+        """
+        prepare_queue = queue.Queue(maxsize=self.queue_size)
+        self._edit_queue = edit_queue = queue.Queue(maxsize=self.queue_size)
+        self._save_queue = save_queue = queue.Queue(maxsize=self.queue_size)
+
+        def prepare(job: ImageJob):
+            if self._cancelled.is_set():
+                self._skip(job)
+                return
+            # 总耗时从开始准备算起，不含排队等待进入流水线的时间
+            job.started = time.perf_counter()
+            self.agent.run_stage(self.agent.prepare, job)
+            if job.result is None:
+                job.report_phase('ready')
+
+        def edit(job: ImageJob):
+            if job.result is not None:
+                return
+            if self._cancelled.is_set() or (before_edit is not None and not before_edit(job)):
+                self._skip(job)
+                return
+            try:
+                self.agent.run_stage(self.agent.edit, job)
+            finally:
+                if after_edit is not None:
+                    after_edit(job)
+
+        def save(job: ImageJob):
+            try:
+                self.agent.run_stage(self.agent.save, job)
+            finally:
+                if on_done is not None:
+                    on_done(job)
+
+        def start(stage: str, count: int, inq, outq, handle) -> List[threading.Thread]:
+            threads = [
+                threading.Thread(target=self._worker, args=(stage, inq, outq, handle),
+                                 name=f"{self.name}-{stage}-{i}", daemon=True)
+                for i in range(count)
+            ]
+            for thread in threads:
+                thread.start()
+            return threads
+
+        stages = [
+            (start('prepare', self.prepare_workers, prepare_queue, edit_queue, prepare), edit_queue),
+            (start('edit', self.edit_workers, edit_queue, save_queue, edit), save_queue),
+            (start('save', self.save_workers, save_queue, None, save), None),
+        ]
+        try:
+            for job in jobs:
+                prepare_queue.put(job)
+        finally:
+            # 任务生成器抛出异常时也要通知各段结束（已入队的任务照常完成，之后异常继续向上抛出），
+            # 否则工作线程一直阻塞在 get()，run 不会返回
+            for _ in range(self.prepare_workers):
+                prepare_queue.put(_STOP)
+            # 逐段收尾：上一段全部结束后再通知下一段
+            for threads, next_queue in stages:
+                for thread in threads:
+                    thread.join()
+                if next_queue is not None:
+                    next_count = self.edit_workers if next_queue is edit_queue else self.save_workers
+                    for _ in range(next_count):
+                        next_queue.put(_STOP)
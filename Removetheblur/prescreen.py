@@ -0,0 +1,86 @@
+"""
+批处理预筛
+派发前并行计算文件夹中每张图片的清晰度得分（有纹理的块的清晰度中位数，绝对值，见 blur_map），
+得分达到阈值的图片视为已清晰，按 PRESCREEN_MODE 跳过或直接输出原图，不调用API；
+清晰和模糊图片混在一起的文件夹因此少花请求和费用。阈值需要按自己的图片校准，默认关闭
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+from PIL import Image
+
+from blur_map import sharpness_map, texture_map, textured_blocks
+from config import BLUR_ANALYSIS_SIDE, PRESCREEN_MODE, PRESCREEN_THRESHOLD, PRESCREEN_WORKERS
+from image_utils import reduce_for_target
+
+PRESCREEN_MODES = ('off', 'skip', 'copy')
+# 调色板图片（GIF、8位PNG）的抖动噪声会被当成细节，得分不可信：不判为已清晰
+PALETTE_MODES = ('P', 'PA')
+
+
+def parse_prescreen_mode(mode: Optional[str]) -> str:
+    """校验预筛模式，None 或空字符串返回 PRESCREEN_MODE"""
+    mode = (mode or PRESCREEN_MODE).strip().lower()
+    if mode not in PRESCREEN_MODES:
+        raise ValueError(f"预筛模式无效: {mode}（可选: {', '.join(PRESCREEN_MODES)}）")
+    return mode
+
+
+def score_image(image_path: str) -> dict:
+    """
+    单张图片的清晰度得分（按分析尺寸降采样解码，不做全分辨率解码）
+
+    得分是有纹理的块（平坦块不计，见 blur_map.textured_blocks）的清晰度（BLUR_METRIC）中位数，
+    不与图中其他区域比较：同一张图片越模糊得分越低
+
+    Returns:
+        {'score': 得分（没有纹理块时为 0）, 'textured': 有纹理的块占比, 'palette': 是否调色板图片, 'seconds': 耗时}
+    """
+    start = time.perf_counter()
+    with Image.open(image_path) as source:
+        palette = source.mode in PALETTE_MODES
+        image = reduce_for_target(source, (BLUR_ANALYSIS_SIDE, BLUR_ANALYSIS_SIDE))
+        sharpness = sharpness_map(image)
+        textured = textured_blocks(texture_map(image))
+    return {
+        'score': round(float(np.median(sharpness[textured])), 1) if textured.any() else 0.0,
+        'textured': round(float(textured.mean()), 4),
+        'palette': palette,
+        'seconds': round(time.perf_counter() - start, 4),
+    }
+
+
+def prescreen_images(image_paths: Iterable[str], threshold: float = None,
+                     workers: int = None) -> Dict[str, dict]:
+    """
+    并行为一批图片评分
+
+    Args:
+        image_paths: 图片路径
+        threshold: 得分不低于该值视为已清晰，默认 PRESCREEN_THRESHOLD
+        workers: 线程数，默认 PRESCREEN_WORKERS（0 表示 CPU 核数）
+
+    Returns:
+        {路径: {'score', 'textured', 'palette', 'seconds', 'sharp'}}；调色板图片总是 sharp 为 False；
+        评分失败的图片 sharp 为 False 并带 'error'，交给正常流程处理（报错也在那里记录）
+    """
+    threshold = PRESCREEN_THRESHOLD if threshold is None else threshold
+    image_paths = [str(path) for path in image_paths]
+
+    def screen(image_path: str) -> dict:
+        try:
+            result = score_image(image_path)
+        except Exception as e:
+            return {'score': None, 'textured': None, 'palette': None, 'sharp': False, 'error': str(e)}
+        result['sharp'] = not result['palette'] and result['score'] >= threshold
+        return result
+
+    if not image_paths:
+        return {}
+    workers = max(1, min(len(image_paths), workers or PRESCREEN_WORKERS or os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Prescreen') as executor:
+        return dict(zip(image_paths, executor.map(screen, image_paths)))
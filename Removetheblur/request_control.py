@@ -0,0 +1,447 @@
+"""
+API请求调度控制
+- RateLimiter: 令牌桶限速 + 并发上限；收到 429/503 时按 Retry-After 暂停发往该后端的所有请求
+- RetryPolicy: 按错误类别决定是否重试，指数退避 + 抖动
+- CircuitBreaker: 连续出现系统性错误（密钥无效、连接被拒、DNS失败）时熔断，冷却后半开探测自动恢复
+- SingleFlight: 相同请求同时只发一次，其余调用方等待并共享结果
+"""
+import email.utils
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from config import (
+    RATE_LIMIT_RPM,
+    RATE_LIMIT_MAX_CONCURRENCY,
+    THROTTLE_DEFAULT_WAIT,
+    THROTTLE_MAX_WAIT,
+    RETRY_MAX_ATTEMPTS,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+    RETRY_ON,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_COOLDOWN,
+    CIRCUIT_MAX_PAUSE,
+    CIRCUIT_TRIP_ON,
+)
+
+# 表示服务端限流/过载的状态码
+THROTTLE_STATUS_CODES = {429, 503}
+
+# 错误类别：
+#   connect  - 无法建立连接（连接被拒、DNS解析失败、连接超时）
+#   network  - 连接中断等其他网络错误
+#   timeout  - 连接/读写超时
+#   server   - 5xx 服务端错误
+#   throttle - 429/503 限流（已超过限流重试次数）
+#   decode   - 响应截断、JSON/Base64/图片无法解码
+#   auth     - 401/403 密钥无效或无权限
+#   client   - 其他 4xx 请求错误
+#   format   - 响应中没有图片数据
+#   unknown  - 其他未分类异常
+#   circuit_open - 熔断中，未发送请求
+ERROR_KINDS = ('connect', 'network', 'timeout', 'server', 'throttle', 'decode',
+               'auth', 'client', 'format', 'unknown', 'circuit_open')
+
+
+class EditError(Exception):
+    """编辑请求失败（kind 为错误类别，用于重试/熔断决策）"""
+
+    def __init__(self, kind: str, message: str = ''):
+        super().__init__(message or kind)
+        self.kind = kind
+
+
+def classify_status(status_code: int) -> str:
+    """按HTTP状态码划分错误类别"""
+    if status_code in THROTTLE_STATUS_CODES:
+        return 'throttle'
+    if status_code in (401, 403):
+        return 'auth'
+    if status_code >= 500:
+        return 'server'
+    return 'client'
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析 Retry-After 头（秒数或 HTTP 日期），返回需要等待的秒数
+
+    无法解析时返回 None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RateLimiter:
+    """
+    请求调度器（线程安全，每个API后端/密钥一个，见 backend_pool）
+
+    - 令牌桶：每分钟最多 requests_per_minute 个请求（0 表示不限）
+    - 并发上限：同时最多 max_concurrency 个请求在途（0 表示不限）
+    - 限流暂停：任一请求收到 429/503 后，发往该后端的请求都等到暂停结束再发送
+    """
+
+    # 记录的最近限流事件条数
+    MAX_EVENTS = 50
+
+    def __init__(self, requests_per_minute: float = None, max_concurrency: int = None):
+        self.requests_per_minute = RATE_LIMIT_RPM if requests_per_minute is None else requests_per_minute
+        self.max_concurrency = RATE_LIMIT_MAX_CONCURRENCY if max_concurrency is None else max_concurrency
+        self._cond = threading.Condition()
+        # 令牌桶容量为1：请求均匀分布，不产生突发
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        # 连续限流次数（无 Retry-After 时用于指数退避）
+        self._consecutive_throttles = 0
+        self.throttle_count = 0
+        self.total_wait_seconds = 0.0
+        self.events = []
+
+    def _refill(self, now: float):
+        if self.requests_per_minute <= 0:
+            self._tokens = 1.0
+            return
+        rate = self.requests_per_minute / 60.0
+        self._tokens = min(1.0, self._tokens + (now - self._last_refill) * rate)
+        self._last_refill = now
+
+    def acquire(self) -> float:
+        """阻塞直到允许发送请求，返回等待的秒数"""
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = 0.0
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.max_concurrency > 0 and self._in_flight >= self.max_concurrency:
+                    wait = None  # 等待其他请求 release
+                elif self._tokens < 1.0:
+                    wait = (1.0 - self._tokens) / (self.requests_per_minute / 60.0)
+                else:
+                    self._tokens -= 1.0
+                    self._in_flight += 1
+                    break
+                self._cond.wait(timeout=wait)
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            with self._cond:
+                self.total_wait_seconds += waited
+        return waited
+
+    def release(self, throttled: bool = False):
+        """请求结束（释放并发名额）"""
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            if not throttled:
+                self._consecutive_throttles = 0
+            self._cond.notify_all()
+
+    def on_throttle(self, status_code: int, retry_after: Optional[float] = None) -> float:
+        """
+        记录一次限流响应，并全局暂停请求
+
+        Returns:
+            本次暂停的秒数
+        """
+        with self._cond:
+            self._consecutive_throttles += 1
+            if retry_after is None:
+                # 没有 Retry-After 时指数退避
+                retry_after = THROTTLE_DEFAULT_WAIT * (2 ** (self._consecutive_throttles - 1))
+            wait = min(float(retry_after), THROTTLE_MAX_WAIT)
+            self._paused_until = max(self._paused_until, time.monotonic() + wait)
+            self.throttle_count += 1
+            self.events.append({
+                'time': time.strftime('%H:%M:%S'),
+                'status_code': status_code,
+                'wait_seconds': round(wait, 1),
+            })
+            if len(self.events) > self.MAX_EVENTS:
+                self.events = self.events[-self.MAX_EVENTS:]
+            self._cond.notify_all()
+        return wait
+
+    def pause_remaining(self) -> float:
+        """限流暂停剩余秒数（0 表示未暂停）"""
+        with self._cond:
+            return max(0.0, self._paused_until - time.monotonic())
+
+    def stats(self) -> dict:
+        """限流统计（用于批处理状态展示）"""
+        with self._cond:
+            return {
+                'requests_per_minute': self.requests_per_minute,
+                'max_concurrency': self.max_concurrency,
+                'in_flight': self._in_flight,
+                'paused_seconds_left': round(max(0.0, self._paused_until - time.monotonic()), 1),
+                'throttle_count': self.throttle_count,
+                'total_wait_seconds': round(self.total_wait_seconds, 1),
+                'recent_events': list(self.events[-10:]),
+            }
+
+
+class RetryPolicy:
+    """
+    重试策略
+
+    - max_attempts: 每张图片最多请求次数（含第一次）
+    - 第 n 次重试前等待 random(0, min(max_delay, base_delay * 2^(n-1)))（全抖动，避免多个线程同时重试）
+    - retry_on: 允许重试的错误类别
+    """
+
+    def __init__(self, max_attempts: int = None, base_delay: float = None,
+                 max_delay: float = None, retry_on=None):
+        self.max_attempts = max(1, RETRY_MAX_ATTEMPTS if max_attempts is None else max_attempts)
+        self.base_delay = RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+        self.retry_on = set(RETRY_ON if retry_on is None else retry_on)
+
+    def should_retry(self, kind: str, attempt: int) -> bool:
+        """第 attempt 次请求以 kind 类错误失败后，是否还要重试"""
+        return kind in self.retry_on and attempt < self.max_attempts
+
+    def delay(self, attempt: int) -> float:
+        """第 attempt 次请求失败后、下一次请求前的等待秒数"""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """
+    API熔断器（线程安全）
+
+    - closed: 正常放行
+    - open: 连续 failure_threshold 次系统性错误后熔断，cooldown 秒内不发请求
+    - half_open: 冷却结束后只放行一个探测请求；成功则恢复 closed，系统性错误则重新 open，
+      非系统性错误或没有得出结论（release_probe）则放行下一个探测请求
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = None, cooldown: float = None,
+                 max_pause: float = None, trip_on=None):
+        self.failure_threshold = max(1, CIRCUIT_FAILURE_THRESHOLD if failure_threshold is None else failure_threshold)
+        self.cooldown = CIRCUIT_COOLDOWN if cooldown is None else cooldown
+        self.max_pause = CIRCUIT_MAX_PAUSE if max_pause is None else max_pause
+        self.trip_on = set(CIRCUIT_TRIP_ON if trip_on is None else trip_on)
+        self._cond = threading.Condition()
+        self.state = self.CLOSED
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_owner = None
+        self.cause = ''
+        self.trip_count = 0
+
+    def allow_request(self) -> bool:
+        """是否允许现在发送请求（半开状态下只有一个线程拿到探测名额）"""
+        with self._cond:
+            return self._allow_locked()
+
+    def _allow_locked(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            self._probe_owner = threading.get_ident()
+            print("熔断器半开：发送探测请求检查服务是否恢复")
+            return True
+        return False
+
+    def wait_until_allowed(self, on_pause=None) -> bool:
+        """
+        阻塞直到允许发送请求
+
+        Args:
+            on_pause: 可选，开始等待时调用一次（用于更新图片状态）
+
+        Returns:
+            False 表示熔断持续超过 max_pause 秒，调用方应放弃（中止批处理）
+        """
+        start = time.monotonic()
+        paused = False
+        with self._cond:
+            while not self._allow_locked():
+                if time.monotonic() - start >= self.max_pause:
+                    return False
+                if not paused and on_pause is not None:
+                    paused = True
+                    try:
+                        on_pause()
+                    except Exception:
+                        pass
+                if self.state == self.OPEN:
+                    wait = max(0.05, self.cooldown - (time.monotonic() - self._opened_at))
+                else:
+                    wait = 1.0  # 等待探测结果
+                self._cond.wait(timeout=min(wait, self.max_pause))
+        return True
+
+    def record_success(self):
+        """请求成功：恢复 closed"""
+        with self._cond:
+            if self.state != self.CLOSED:
+                print("✓ 熔断器恢复：服务已可用")
+            self.state = self.CLOSED
+            self._consecutive = 0
+            self._probe_in_flight = False
+            self._cond.notify_all()
+
+    def record_failure(self, kind: str, message: str = ''):
+        """记录一次失败；只有系统性错误计入熔断"""
+        if kind not in self.trip_on:
+            # 非系统性错误不计入也不清零连续失败数、不改变状态（不能因为一次失败就关闭半开的熔断器），
+            # 只释放探测名额
+            self.release_probe()
+            return
+        with self._cond:
+            self._consecutive += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and self._consecutive >= self.failure_threshold):
+                first_trip = self.state == self.CLOSED
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+                self.cause = f"{kind}: {message}" if message else kind
+                if first_trip:
+                    self.trip_count += 1
+                    print(f"✗ 熔断器打开：连续 {self._consecutive} 次系统性错误（{self.cause}），"
+                          f"暂停 {self.cooldown:.0f} 秒后探测")
+            self._cond.notify_all()
+
+    def release_probe(self):
+        """
+        请求结束时调用（无论结果如何）：当前线程持有的探测名额如果还没有被 record_success/record_failure
+        结算（如多后端时探测失败但仍有健康后端、请求中出现意外异常），释放名额让下一个请求探测，
+        避免熔断器一直停在半开状态、其余线程等满 max_pause 后放弃
+        """
+        with self._cond:
+            if (self.state == self.HALF_OPEN and self._probe_in_flight
+                    and self._probe_owner == threading.get_ident()):
+                self._probe_in_flight = False
+                self._probe_owner = None
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """熔断器状态（用于批处理状态展示）"""
+        with self._cond:
+            return {
+                'state': self.state,
+                'consecutive_failures': self._consecutive,
+                'cause': self.cause,
+                'trip_count': self.trip_count,
+                'cooldown': self.cooldown,
+            }
+
+
+class Flight:
+    """一次正在进行的请求（由第一个调用方执行，其余调用方 wait()）"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.result: Optional[bytes] = None
+        self.info: dict = {}
+        self.followers = 0
+
+    def wait(self) -> Tuple[Optional[bytes], dict]:
+        """等待请求完成，返回 (结果字节或None, 执行方的 info)"""
+        self._done.wait()
+        return self.result, self.info
+
+
+class SingleFlight:
+    """
+    单飞合并（线程安全）
+
+    同一个键同时只有一个调用方（leader）真正发请求；其余调用方拿到同一个 Flight 等待，
+    完成后各自解码结果字节（互不共享图片对象）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """加入（或发起）键为 key 的请求，返回 (flight, 是否为 leader)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.coalesced += 1
+                return flight, False
+            flight = Flight()
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def complete(self, key: str, flight: Flight, result: Optional[bytes], info: dict):
+        """leader 完成请求（失败时 result 为 None），唤醒所有等待者"""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result = result
+        flight.info = dict(info)
+        flight._done.set()
+        if flight.followers:
+            print(f"单飞合并: {flight.followers} 个相同请求共享了本次结果")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+            }
+
+
+_shared_breaker: Optional[CircuitBreaker] = None
+_shared_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """获取进程级共享熔断器（同一API端点共用）"""
+    global _shared_breaker
+    if _shared_breaker is None:
+        with _shared_breaker_lock:
+            if _shared_breaker is None:
+                _shared_breaker = CircuitBreaker()
+    return _shared_breaker
+
+
+_shared_single_flight: Optional[SingleFlight] = None
+_shared_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """获取进程级共享的单飞合并器（跨批次、跨 GPTHandler 实例）"""
+    global _shared_single_flight
+    if _shared_single_flight is None:
+        with _shared_single_flight_lock:
+            if _shared_single_flight is None:
+                _shared_single_flight = SingleFlight()
+    return _shared_single_flight
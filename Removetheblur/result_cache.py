@@ -0,0 +1,148 @@
+"""
+AI编辑结果缓存 - 按内容寻址的磁盘缓存
+键 = 上传字节 + 请求参数（提示词、尺寸、模型、质量）的哈希；
+相同输入重复处理时直接返回上次结果，不再调用（付费的）API
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from config import CACHE_DIR, RESULT_CACHE_ENABLED, RESULT_CACHE_MAX_MB
+
+
+def make_cache_key(payload: memoryview, **params) -> str:
+    """计算缓存键：sha256(上传字节 + 排序后的参数JSON)"""
+    digest = hashlib.sha256()
+    digest.update(payload)
+    digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    磁盘结果缓存（线程安全，总大小超限时按 LRU 淘汰）
+
+    每个结果存为 <cache_dir>/<键前2位>/<键>.bin（API返回的原始图片字节）；
+    命中时更新文件 mtime，重启后按 mtime 恢复 LRU 顺序
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None, enabled: bool = None):
+        self.enabled = RESULT_CACHE_ENABLED if enabled is None else enabled
+        self.cache_dir = Path(cache_dir or os.path.join(CACHE_DIR, 'results'))
+        self.max_bytes = max_bytes if max_bytes is not None else RESULT_CACHE_MAX_MB * 1024 * 1024
+        self._lock = threading.Lock()
+        # 键 -> 文件大小，按最近使用排序（最旧的在前）
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        if self.enabled:
+            self._load_index()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.bin"
+
+    def _load_index(self):
+        """扫描缓存目录，按 mtime 恢复 LRU 顺序"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.cache_dir.glob('*/*.bin'):
+            try:
+                st = path.stat()
+                files.append((st.st_mtime, path.stem, st.st_size))
+            except OSError:
+                continue
+        files.sort()
+        for _, key, size in files:
+            self._entries[key] = size
+            self.total_bytes += size
+
+    def get(self, key: str) -> Optional[bytes]:
+        """读取缓存结果，未命中返回 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            known = key in self._entries
+        if known:
+            path = self._path(key)
+            try:
+                data = path.read_bytes()
+                os.utime(path, None)
+            except OSError:
+                data = None
+            with self._lock:
+                if data is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return data
+                # 文件已被外部删除
+                self.total_bytes -= self._entries.pop(key, 0)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, data: bytes):
+        """写入缓存结果（先写临时文件再原子替换），必要时淘汰最久未用的条目"""
+        if not self.enabled or not data or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ 写入结果缓存失败: {e}")
+            return
+        with self._lock:
+            self.total_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self.total_bytes += len(data)
+            self.stores += 1
+            evicted = []
+            while self.total_bytes > self.max_bytes and self._entries:
+                old_key, old_size = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+                self.evictions += 1
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                self._path(old_key).unlink()
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        """命中/未命中等统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+_shared_cache: Optional[ResultCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """获取进程级共享结果缓存"""
+    global _shared_cache
+    if _shared_cache is None:
+        with _shared_cache_lock:
+            if _shared_cache is None:
+                _shared_cache = ResultCache()
+    return _shared_cache
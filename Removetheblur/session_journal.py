@@ -0,0 +1,171 @@
+"""
+批处理会话日志（每个会话一个只追加的 JSON Lines 文件，保存在会话的输出文件夹）
+记录会话参数和每张图片的处理结果（状态、输出文件），每条记录写入后立即落盘；
+进程退出或机器重启后据此续跑：已完成的图片跳过，只重新处理未完成或失败的图片
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+JOURNAL_NAME = 'journal.jsonl'
+# 续跑时视为已完成的图片状态（saved: 已输出；sharp: 预筛判定已清晰并跳过）
+DONE_STATES = ('saved', 'sharp')
+
+
+def _input_signature(image_file: Path) -> dict:
+    """输入文件的大小和修改时间（续跑时用于发现被替换的输入）"""
+    try:
+        st = image_file.stat()
+    except OSError:
+        return {}
+    return {'input_size': st.st_size, 'input_mtime': st.st_mtime_ns}
+
+
+class SessionJournal:
+    """
+    一个批处理会话的日志（线程安全）
+
+    记录类型（event）:
+      start  - 开始新一轮处理（会话参数：输入文件夹、提示词、目标尺寸等），之前的图片记录作废
+      resume - 续跑
+      image  - 一张图片的处理结果（file, state, output, error, 输入文件大小/修改时间）；
+               output 为相对日志文件夹的路径（在文件夹外时为绝对路径），换工作目录续跑也能找到
+    """
+
+    def __init__(self, folder: str):
+        self.path = Path(folder) / JOURNAL_NAME
+        self._lock = threading.Lock()
+
+    @property
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    def _append(self, record: dict):
+        """追加一条记录并落盘（写失败只警告，不影响批处理）"""
+        record = dict(record, time=round(time.time(), 3))
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                print(f"⚠️ 写入会话日志失败: {e}")
+
+    def start(self, **meta):
+        """开始新一轮处理（meta: 会话参数）"""
+        self._append(dict(meta, event='start'))
+
+    def resume(self, pending: int, **meta):
+        """
+        续跑（pending: 待处理的图片数）；日志中还没有 start 记录（日志不存在或为空）时按新一轮处理记录 start，
+        不写出缺少会话参数的 resume 记录（meta: 会话参数，同 start）
+        """
+        started, _ = self.read()
+        if not started:
+            self.start(**meta)
+            return
+        self._append({'event': 'resume', 'pending': pending})
+
+    def _store_path(self, path: str) -> str:
+        """日志中保存的输出路径：相对日志文件夹（在文件夹外时为绝对路径）"""
+        path = os.path.abspath(path)
+        folder = os.path.abspath(self.path.parent)
+        try:
+            if os.path.commonpath([path, folder]) == folder:
+                return Path(os.path.relpath(path, folder)).as_posix()
+        except ValueError:
+            # Windows 下不同盘符
+            pass
+        return path
+
+    def resolve_path(self, path: str) -> str:
+        """日志中的输出路径对应的实际路径（相对路径按日志文件夹解析）"""
+        return path if os.path.isabs(path) else os.path.join(self.path.parent, path)
+
+    def record(self, image_file: Path, state: str, output: Optional[str] = None, error: Optional[str] = None):
+        """记录一张图片的处理结果"""
+        record = {'event': 'image', 'file': image_file.name, 'state': state}
+        if output:
+            record['output'] = self._store_path(str(output))
+        if error:
+            record['error'] = error
+        record.update(_input_signature(image_file))
+        self._append(record)
+
+    def read(self) -> Tuple[dict, Dict[str, dict]]:
+        """
+        读取日志（忽略无法解析的行，如写到一半时进程退出）
+
+        Returns:
+            (最近一次 start 的会话参数, {文件名: 该文件最后一条记录})
+        """
+        meta: dict = {}
+        images: Dict[str, dict] = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return meta, images
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict):
+                continue
+            event = record.get('event')
+            if event == 'start':
+                meta = record
+                images = {}
+            elif event == 'image' and record.get('file'):
+                images[record['file']] = record
+        return meta, images
+
+    def completed(self, image_files: Iterable[Path]) -> Dict[str, dict]:
+        """
+        已完成的图片：最后一条记录的状态为已完成、输出文件仍存在、输入文件没有被替换
+
+        Returns:
+            {文件名: 最后一条记录（output 已解析为实际路径）}
+        """
+        _, images = self.read()
+        done = {}
+        for image_file in image_files:
+            record = images.get(image_file.name)
+            if record is None or record.get('state') not in DONE_STATES:
+                continue
+            if record.get('output'):
+                record = dict(record, output=self.resolve_path(record['output']))
+                if not os.path.isfile(record['output']):
+                    continue
+            signature = _input_signature(image_file)
+            if any(record.get(key) != value for key, value in signature.items()):
+                continue
+            done[image_file.name] = record
+        return done
+
+
+def find_session(root: str, input_folder: str) -> Optional[str]:
+    """
+    root 下处理过 input_folder 的最近一个会话（会话文件夹名）；没有则返回 None
+    """
+    target = os.path.normcase(os.path.abspath(input_folder))
+    sessions: Set[Tuple[float, str]] = set()
+    root_path = Path(root)
+    if not root_path.is_dir():
+        return None
+    for path in root_path.glob(f'*/{JOURNAL_NAME}'):
+        meta, _ = SessionJournal(str(path.parent)).read()
+        folder = meta.get('input_folder')
+        if folder and os.path.normcase(os.path.abspath(folder)) == target:
+            try:
+                sessions.add((path.stat().st_mtime, path.parent.name))
+            except OSError:
+                continue
+    return max(sessions)[1] if sessions else None
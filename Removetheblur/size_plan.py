@@ -0,0 +1,57 @@
+"""
+接口请求尺寸规划
+按每张图片自身的宽高比选择最接近的接口尺寸（横图不再被压进竖版画幅再发送），
+上传时只缩小不放大（小图按原尺寸上传，不为插值出来的像素付出编码和上传开销），
+接口按请求尺寸返回结果后，再在本地缩放回交付尺寸（目标尺寸）
+"""
+from typing import Tuple
+
+from config import SIZE_PLAN
+from tiling import closest_api_size
+
+
+def upload_size(image_size: Tuple[int, int], api_size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    上传尺寸：保持图片宽高比缩小到接口尺寸以内，不放大；SIZE_PLAN=off 时为接口尺寸（直接拉伸）
+    """
+    if SIZE_PLAN == 'off':
+        return tuple(api_size)
+    width, height = image_size
+    scale = min(1.0, api_size[0] / width, api_size[1] / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class SizePlan:
+    """一张图片（不分块）的请求尺寸：接口尺寸、上传尺寸和交付尺寸"""
+
+    def __init__(self, image_size: Tuple[int, int], deliver_size: Tuple[int, int]):
+        self.image_size = tuple(image_size)
+        self.deliver_size = tuple(deliver_size)
+        self.api_size = self.deliver_size if SIZE_PLAN == 'off' else closest_api_size(self.image_size)
+        self.upload_size = upload_size(self.image_size, self.api_size)
+
+    @property
+    def restore(self) -> bool:
+        """接口结果是否需要在本地缩放回交付尺寸"""
+        return self.api_size != self.deliver_size
+
+    def describe(self) -> str:
+        text = f"接口尺寸 {self.api_size[0]}x{self.api_size[1]}，上传 {self.upload_size[0]}x{self.upload_size[1]}"
+        if self.upload_size[0] * self.upload_size[1] < self.api_size[0] * self.api_size[1]:
+            text += "（不放大）"
+        if self.restore:
+            text += f"，结果缩放回 {self.deliver_size[0]}x{self.deliver_size[1]}"
+        return text
+
+
+def plan_request(image_size: Tuple[int, int], deliver_size: Tuple[int, int]) -> SizePlan:
+    """
+    规划一张图片的请求尺寸
+
+    Args:
+        image_size: 加载后的图片尺寸
+        deliver_size: 交付尺寸（目标尺寸）
+
+    SIZE_PLAN=auto 时接口尺寸为宽高比最接近图片的接口尺寸；off 时接口尺寸即交付尺寸，上传前直接缩放到该尺寸
+    """
+    return SizePlan(image_size, deliver_size)
@@ -0,0 +1,174 @@
+"""
+编辑接口响应的流式解码
+边接收边从 JSON 中取出第一个 "b64_json" 字段并分块 Base64 解码到同一个缓冲区，
+其余（很小的）JSON 元数据单独保留用于日志和 usage 统计，
+避免整份响应、JSON 字符串、清洗后的字符串各保留一份完整副本
+"""
+import binascii
+import json
+from typing import Optional
+
+# Base64 字段中需要忽略的空白字符
+_B64_WHITESPACE = b' \t\r\n'
+# data URI 前缀（如 data:image/png;base64,）最长检查的字符数
+_PREFIX_SCAN_LIMIT = 128
+
+
+class B64JsonStreamDecoder:
+    """
+    流式解析 {"data": [{"b64_json": "..."}], ...} 响应
+
+    用法:
+        decoder = B64JsonStreamDecoder()
+        for chunk in response.iter_bytes():
+            decoder.feed(chunk)
+        decoder.close()
+        image_bytes = decoder.image_bytes()   # 解码后的图片字节（未找到时为 None）
+        meta = decoder.metadata()             # 其余 JSON，b64_json 的值被替换为 ""
+    """
+
+    KEY = b'"b64_json"'
+
+    def __init__(self, max_meta_bytes: int = 4 * 1024 * 1024):
+        self.max_meta_bytes = max_meta_bytes
+        # 去掉 b64_json 值之后的 JSON 文本
+        self._meta = bytearray()
+        self._scan_from = 0
+        # 'scan'（找键）/ 'colon'（键后到值的引号之间）/ 'value'（字符串值内）
+        self._state = 'scan'
+        self._escape = False
+        # 是否解码当前值（只解码第一个 b64_json）
+        self._decode_current = False
+        self._found = 0
+        self._prefix_checked = False
+        self._pending = bytearray()
+        self._image = bytearray()
+        self.b64_chars = 0
+        self.received_bytes = 0
+        self._closed = False
+
+    def feed(self, chunk: bytes):
+        """喂入一段响应字节"""
+        self.received_bytes += len(chunk)
+        data = memoryview(chunk)
+        while len(data):
+            if self._state == 'scan':
+                data = self._feed_scan(data)
+            elif self._state == 'colon':
+                data = self._feed_colon(data)
+            else:
+                data = self._feed_value(data)
+
+    def _feed_scan(self, data: memoryview) -> memoryview:
+        self._meta += data
+        if len(self._meta) > self.max_meta_bytes:
+            raise ValueError(f"响应元数据超过 {self.max_meta_bytes} 字节")
+        idx = self._meta.find(self.KEY, self._scan_from)
+        if idx < 0:
+            # 保留可能跨块的键前缀
+            self._scan_from = max(0, len(self._meta) - len(self.KEY) + 1)
+            return memoryview(b'')
+        key_end = idx + len(self.KEY)
+        rest = bytes(self._meta[key_end:])
+        del self._meta[key_end:]
+        self._scan_from = key_end
+        self._state = 'colon'
+        return memoryview(rest)
+
+    def _feed_colon(self, data: memoryview) -> memoryview:
+        raw = data.tobytes() if len(data) < 64 else data[:64].tobytes()
+        quote = raw.find(b'"')
+        if quote < 0:
+            if raw.strip(b' \t\r\n:'):
+                # 键后不是字符串值（例如 null），回到扫描状态
+                self._state = 'scan'
+                return data
+            self._meta += raw
+            return data[len(raw):]
+        between = raw[:quote]
+        if between.strip(b' \t\r\n:'):
+            self._state = 'scan'
+            return data
+        self._meta += between + b'"'
+        self._state = 'value'
+        self._found += 1
+        self._decode_current = self._found == 1
+        return data[quote + 1:]
+
+    def _feed_value(self, data: memoryview) -> memoryview:
+        raw = data.tobytes()
+        # Base64 中不会出现引号，第一个引号即字符串结束
+        quote = raw.find(b'"')
+        segment = raw if quote < 0 else raw[:quote]
+        if self._escape:
+            # 上一块以反斜杠结尾
+            segment = b'\\' + segment
+            self._escape = False
+        if segment.endswith(b'\\') and (len(segment) - len(segment.rstrip(b'\\'))) % 2:
+            segment = segment[:-1]
+            self._escape = True
+        if b'\\' in segment:
+            # JSON 转义：\/ 还原为 /，\n \r \t 等视为空白
+            segment = (segment.replace(b'\\/', b'/').replace(b'\\n', b'')
+                       .replace(b'\\r', b'').replace(b'\\t', b'').replace(b'\\', b''))
+        self._push_b64(segment)
+        if quote < 0:
+            return memoryview(b'')
+        self._finish_value()
+        # 值结束：在元数据中补上右引号
+        self._meta += b'"'
+        self._scan_from = len(self._meta)
+        self._state = 'scan'
+        return data[quote + 1:]
+
+    def _push_b64(self, text: bytes):
+        if not self._decode_current or not text:
+            return
+        text = text.translate(None, _B64_WHITESPACE)
+        self.b64_chars += len(text)
+        self._pending += text
+        if not self._prefix_checked:
+            comma = self._pending.find(b',')
+            if comma >= 0:
+                # 去掉 data URI 前缀
+                del self._pending[:comma + 1]
+                self._prefix_checked = True
+            elif len(self._pending) >= _PREFIX_SCAN_LIMIT:
+                self._prefix_checked = True
+            else:
+                return
+        usable = len(self._pending) - len(self._pending) % 4
+        if usable:
+            self._image += binascii.a2b_base64(self._pending[:usable])
+            del self._pending[:usable]
+
+    def _finish_value(self):
+        if not self._decode_current:
+            return
+        self._prefix_checked = True
+        if self._pending:
+            # 补齐填充后解码剩余部分
+            self._pending += b'=' * (-len(self._pending) % 4)
+            self._image += binascii.a2b_base64(bytes(self._pending))
+            self._pending = bytearray()
+        self._decode_current = False
+
+    def close(self):
+        """响应接收完毕；字符串值未闭合说明响应被截断"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._state != 'scan':
+            raise ValueError(f"响应被截断（已接收 {self.received_bytes} 字节，b64_json 未结束）")
+
+    def image_bytes(self) -> Optional[bytes]:
+        """解码后的图片字节（转换后释放内部缓冲区）；未找到 b64_json 时返回 None"""
+        if not self._found:
+            return None
+        data = bytes(self._image)
+        self._image = bytearray()
+        return data
+
+    def metadata(self) -> dict:
+        """除 b64_json 值以外的 JSON 元数据"""
+        return json.loads(bytes(self._meta).decode('utf-8'))
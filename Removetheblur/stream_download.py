@@ -0,0 +1,126 @@
+"""
+url 类型编辑结果的流式下载
+编辑接口返回 url 而不是 b64_json 时，经共享连接池边接收边：
+- 写入有界缓冲（SpooledTemporaryFile，超过 DOWNLOAD_SPOOL_MAX_MB 后转存临时文件），不整份堆在内存里
+- 喂给 PIL 增量解码器，解码与下载交替进行，下载完即解码完
+中途断开时用 Range 请求从已接收的位置续传；服务端不支持 Range（返回 200）时从头重新下载
+"""
+import tempfile
+import time
+from typing import Optional
+
+import httpx
+from PIL import Image, ImageFile
+
+from config import DOWNLOAD_SPOOL_MAX_MB, DOWNLOAD_MAX_RESUMES
+from request_control import EditError, classify_status
+
+# 可以续传的中断错误
+RESUMABLE_ERRORS = (httpx.ReadError, httpx.ReadTimeout, httpx.RemoteProtocolError)
+
+
+class ResultDownload:
+    """
+    单个结果图片的下载
+
+    用法:
+        download = ResultDownload()
+        try:
+            download.fetch(client, url, timeout=timeout)
+            image = download.image()          # 已解码的图片
+            raw_bytes = download.getvalue()   # 原始（编码后的）图片字节
+        finally:
+            download.close()
+    """
+
+    def __init__(self, spool_max_bytes: int = None, max_resumes: int = None):
+        if spool_max_bytes is None:
+            spool_max_bytes = DOWNLOAD_SPOOL_MAX_MB * 1024 * 1024
+        self.max_resumes = DOWNLOAD_MAX_RESUMES if max_resumes is None else max_resumes
+        self._spool = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+        self._parser: Optional[ImageFile.Parser] = ImageFile.Parser()
+        self.received_bytes = 0
+        self.resumes = 0
+        # 增量解码耗时（与下载交替进行，单独统计）
+        self.decode_seconds = 0.0
+
+    def _reset(self):
+        """从头重新下载：清空缓冲和解码器"""
+        self._spool.seek(0)
+        self._spool.truncate()
+        self._parser = ImageFile.Parser()
+        self.received_bytes = 0
+
+    def _write(self, chunk: bytes):
+        self._spool.write(chunk)
+        self.received_bytes += len(chunk)
+        if self._parser is not None:
+            started = time.perf_counter()
+            try:
+                self._parser.feed(chunk)
+            except Exception:
+                # 该格式不支持增量解码，下载完成后再整体解码
+                self._parser = None
+            self.decode_seconds += time.perf_counter() - started
+
+    def fetch(self, client: httpx.Client, url: str, timeout: httpx.Timeout = None,
+              extensions: Optional[dict] = None):
+        """
+        下载 url 到缓冲区（中断时续传）
+
+        Raises:
+            EditError: 状态码错误（kind 按状态码分类）
+            httpx.RequestError: 连接失败，或续传次数用完仍然中断
+        """
+        while True:
+            # identity: 保证字节偏移与 Range 一致
+            headers = {'Accept-Encoding': 'identity'}
+            offset = self.received_bytes
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+            try:
+                with client.stream('GET', url, headers=headers, timeout=timeout,
+                                   extensions=extensions or {}) as response:
+                    if response.status_code == 200 and offset:
+                        print("⚠️ 下载服务端不支持续传，从头重新下载")
+                        self._reset()
+                        offset = 0
+                    elif response.status_code not in (200, 206):
+                        response.read()
+                        raise EditError(classify_status(response.status_code),
+                                        f"下载结果图片失败，状态码: {response.status_code}")
+                    expected = response.headers.get('Content-Length')
+                    for chunk in response.iter_bytes():
+                        self._write(chunk)
+                    if expected is not None and self.received_bytes < offset + int(expected):
+                        raise httpx.RemoteProtocolError("下载不完整", request=response.request)
+                return
+            except RESUMABLE_ERRORS as e:
+                if self.resumes >= self.max_resumes:
+                    raise
+                self.resumes += 1
+                print(f"⚠️ 下载中断（{type(e).__name__}），已接收 {self.received_bytes} 字节，"
+                      f"第 {self.resumes}/{self.max_resumes} 次续传")
+
+    def image(self) -> Image.Image:
+        """解码后的图片（增量解码不可用时从缓冲区整体解码）"""
+        started = time.perf_counter()
+        try:
+            if self._parser is not None:
+                image = self._parser.close()
+            else:
+                self._spool.seek(0)
+                image = Image.open(self._spool)
+            image.load()
+        finally:
+            self.decode_seconds += time.perf_counter() - started
+        return image
+
+    def getvalue(self) -> bytes:
+        """原始图片字节（写入结果缓存/直接保存）"""
+        self._spool.seek(0)
+        return self._spool.read()
+
+    def close(self):
+        self._spool.close()
+
@@ -0,0 +1,76 @@
+"""
+自适应超时测试（pytest）：样本不足用默认值、按 p99 学习读超时、按带宽算写超时、重试翻倍、持久化
+"""
+from adaptive_timeout import AdaptiveTimeouts
+from config import (
+    TIMEOUT_CONNECT, TIMEOUT_MIN_SAMPLES, TIMEOUT_READ_DEFAULT, TIMEOUT_READ_FACTOR,
+    TIMEOUT_READ_MAX, TIMEOUT_READ_MIN, TIMEOUT_WRITE_FACTOR, TIMEOUT_WRITE_MAX, TIMEOUT_WRITE_MIN,
+)
+
+
+def _timeouts(tmp_path) -> AdaptiveTimeouts:
+    return AdaptiveTimeouts(str(tmp_path / 'timeouts.json'))
+
+
+def test_default_read_timeout_until_enough_samples(tmp_path):
+    timeouts = _timeouts(tmp_path)
+    for _ in range(TIMEOUT_MIN_SAMPLES - 1):
+        timeouts.record_server_wait(40.0)
+    assert timeouts.read_timeout() == TIMEOUT_READ_DEFAULT
+    timeouts.record_server_wait(40.0)
+    assert timeouts.read_timeout() == min(max(40.0 * TIMEOUT_READ_FACTOR, TIMEOUT_READ_MIN), TIMEOUT_READ_MAX)
+
+
+def test_read_timeout_is_clamped(tmp_path):
+    timeouts = _timeouts(tmp_path)
+    for _ in range(TIMEOUT_MIN_SAMPLES):
+        timeouts.record_server_wait(0.5)
+    assert timeouts.read_timeout() == TIMEOUT_READ_MIN
+    for _ in range(TIMEOUT_MIN_SAMPLES):
+        timeouts.record_server_wait(TIMEOUT_READ_MAX * 10)
+    assert timeouts.read_timeout() == TIMEOUT_READ_MAX
+
+
+def test_non_positive_waits_are_ignored(tmp_path):
+    timeouts = _timeouts(tmp_path)
+    timeouts.record_server_wait(0)
+    timeouts.record_server_wait(-1)
+    assert timeouts.stats()['server_wait_samples'] == 0
+    assert not (tmp_path / 'timeouts.json').exists()
+
+
+def test_write_timeout_follows_bandwidth(tmp_path):
+    timeouts = _timeouts(tmp_path)
+    timeouts.bandwidth.record(10_000_000, 1.0)
+    payload = 50_000_000
+    expected = payload / 10_000_000 * TIMEOUT_WRITE_FACTOR
+    assert timeouts.write_timeout(payload) == min(max(expected, TIMEOUT_WRITE_MIN), TIMEOUT_WRITE_MAX)
+    assert timeouts.write_timeout(1) == TIMEOUT_WRITE_MIN
+
+
+def test_retries_double_read_and_write_up_to_max(tmp_path):
+    timeouts = _timeouts(tmp_path)
+    first = timeouts.timeout_for(1000, attempt=1)
+    second = timeouts.timeout_for(1000, attempt=2)
+    assert first.connect == second.connect == TIMEOUT_CONNECT
+    assert second.read == min(first.read * 2, TIMEOUT_READ_MAX)
+    assert second.write == min(first.write * 2, TIMEOUT_WRITE_MAX)
+    many = timeouts.timeout_for(1000, attempt=20)
+    assert many.read == TIMEOUT_READ_MAX
+    assert many.write == TIMEOUT_WRITE_MAX
+
+
+def test_learned_data_survives_restart(tmp_path):
+    timeouts = _timeouts(tmp_path)
+    timeouts.bandwidth.record(2_000_000, 1.0)
+    for _ in range(TIMEOUT_MIN_SAMPLES):
+        timeouts.record_server_wait(45.0)
+    restored = _timeouts(tmp_path)
+    assert restored.read_timeout() == timeouts.read_timeout()
+    assert restored.bandwidth.bandwidth == 2_000_000
+    assert restored.stats()['server_wait_samples'] == TIMEOUT_MIN_SAMPLES
+
+
+def test_corrupt_file_is_ignored(tmp_path):
+    (tmp_path / 'timeouts.json').write_text('{not json', encoding='utf-8')
+    assert _timeouts(tmp_path).read_timeout() == TIMEOUT_READ_DEFAULT
@@ -0,0 +1,121 @@
+"""
+后端池测试（pytest）：路由、连续失败摘除、到期探测恢复、单后端不摘除
+"""
+import time
+
+import pytest
+
+import backend_pool
+from backend_pool import Backend, BackendPool, parse_backends
+
+EJECT_SECONDS = 0.05
+
+
+@pytest.fixture(autouse=True)
+def _fast_ejection(monkeypatch):
+    monkeypatch.setattr(backend_pool, 'BACKEND_EJECT_THRESHOLD', 2)
+    monkeypatch.setattr(backend_pool, 'BACKEND_EJECT_SECONDS', EJECT_SECONDS)
+
+
+def _pool(count: int = 2, **kwargs) -> BackendPool:
+    backends = [Backend(f"https://{name}.example.com", f"sk-{name}-key", name=name)
+                for name in 'abc'[:count]]
+    for backend in backends:
+        backend.eject_seconds = EJECT_SECONDS
+    return BackendPool(backends, **kwargs)
+
+
+def _request(pool: BackendPool, error_kind: str = None, latency: float = None) -> Backend:
+    backend = pool.acquire()
+    pool.release(backend, latency=latency, error_kind=error_kind, error_message='boom' if error_kind else '')
+    return backend
+
+
+def test_least_outstanding_spreads_requests():
+    pool = _pool()
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+    pool.release(first, latency=0.1)
+    pool.release(second, latency=0.1)
+
+
+def test_acquire_avoids_previous_backend():
+    pool = _pool()
+    first = pool.acquire()
+    pool.release(first, error_kind='server')
+    assert pool.acquire(avoid=first) is not first
+
+
+def test_consecutive_failures_eject_backend():
+    pool = _pool()
+    a, b = pool.backends
+    for _ in range(2):
+        backend = pool.acquire(avoid=b)
+        assert backend is a
+        pool.release(backend, error_kind='connect', error_message='refused')
+    assert not a.is_healthy(time.monotonic())
+    assert a.ejections == 1
+    assert pool.healthy_count() == 1
+    assert all(_request(pool, latency=0.1) is b for _ in range(3))
+
+
+def test_non_eject_errors_reset_the_count():
+    pool = _pool()
+    a, b = pool.backends
+    pool.release(pool.acquire(avoid=b), error_kind='connect')
+    pool.release(pool.acquire(avoid=b), error_kind='client')
+    pool.release(pool.acquire(avoid=b), error_kind='connect')
+    assert a.ejections == 0
+    assert pool.healthy_count() == 2
+
+
+def test_probe_after_ejection():
+    pool = _pool()
+    a, b = pool.backends
+    for _ in range(2):
+        pool.release(pool.acquire(avoid=b), error_kind='timeout')
+    time.sleep(EJECT_SECONDS * 1.5)
+
+    # 到期后只放行一个探测请求
+    probe = pool.acquire(avoid=b)
+    assert probe is a and a.probing
+    assert pool.acquire(avoid=b) is b
+    pool.release(b, latency=0.1)
+    # 探测失败：摘除时间翻倍
+    pool.release(probe, error_kind='timeout')
+    assert a.eject_seconds == EJECT_SECONDS * 2
+    assert a.ejections == 2
+    time.sleep(EJECT_SECONDS * 2.5)
+
+    probe = pool.acquire(avoid=b)
+    assert probe is a
+    pool.release(probe, latency=0.2)
+    assert a.is_healthy(time.monotonic())
+    assert a.eject_seconds == EJECT_SECONDS
+
+
+def test_single_backend_is_never_ejected():
+    pool = _pool(count=1)
+    for _ in range(5):
+        _request(pool, error_kind='connect')
+    assert pool.healthy_count() == 1
+    assert pool.backends[0].ejections == 0
+
+
+def test_latency_routing_prefers_faster_backend():
+    pool = _pool(routing='latency')
+    a, b = pool.backends
+    a.latency_ewma, b.latency_ewma = 5.0, 1.0
+    assert pool.acquire() is b
+
+
+def test_parse_backends():
+    backends = parse_backends('[{"base_url": "https://a.example.com/", "api_key": "sk-1", "weight": 2,'
+                              ' "max_concurrency": 4}, {"api_key": "sk-2", "rpm": 30, "name": "b"}]')
+    assert [b.name for b in backends] == ['backend-1', 'b']
+    assert backends[0].base_url == 'https://a.example.com'
+    assert backends[0].weight == 2 and backends[0].max_concurrency == 4
+    assert backends[1].rate_limiter.requests_per_minute == 30
+    with pytest.raises(ValueError):
+        parse_backends('{"base_url": "x"}')
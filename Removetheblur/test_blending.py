@@ -0,0 +1,63 @@
+"""
+分块融合测试（pytest）：未编辑的分块无损还原、接缝条带多频段与整画布多频段一致、接缝条带重叠时回退整画布
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+from blending import TileBlender
+from tiling import plan_tiles
+
+CANVAS = (720, 1080)
+
+
+def _canvas() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, size=(CANVAS[1], CANVAS[0], 3), dtype=np.uint8)
+
+
+def _crops(canvas: np.ndarray, boxes, shift: bool = False):
+    tiles = []
+    for index, (left, top, right, bottom) in enumerate(boxes):
+        tile = canvas[top:bottom, left:right].astype(np.int16)
+        if shift:
+            # 模拟各分块编辑结果的色调差异
+            tile = tile + (index * 13) % 40 - 20
+        tiles.append(np.clip(tile, 0, 255).astype(np.uint8))
+    return tiles
+
+
+@pytest.mark.parametrize('method', ['feather', 'multiband'])
+@pytest.mark.parametrize('grid', [(1, 2), (2, 2), (2, 3)])
+def test_unedited_tiles_reconstruct_losslessly(method, grid):
+    canvas = _canvas()
+    boxes = plan_tiles(CANVAS, grid=grid, overlap=64).boxes
+    merged = TileBlender(CANVAS, boxes, method).blend(_crops(canvas, boxes))
+    assert np.array_equal(np.asarray(merged), canvas)
+
+
+@pytest.mark.parametrize('grid', [(1, 2), (2, 2), (3, 4)])
+def test_seam_strips_match_full_canvas_multiband(grid):
+    canvas = np.asarray(Image.radial_gradient('L').convert('RGB').resize(CANVAS))
+    boxes = plan_tiles(CANVAS, grid=grid, overlap=64).boxes
+    blender = TileBlender(CANVAS, boxes, 'multiband')
+    assert blender._seams is not None
+    tiles = _crops(canvas, boxes, shift=True)
+    full = TileBlender(CANVAS, boxes, 'multiband')
+    full._seams = None
+    full._prepare_multiband()
+    seams = np.asarray(blender.blend(tiles)).astype(np.int16)
+    reference = np.asarray(full.blend(tiles)).astype(np.int16)
+    difference = np.abs(seams - reference)
+    assert np.count_nonzero(difference > 1) < difference.size // 1000
+    # 先融合竖向接缝再融合横向接缝，只在四块交汇处与整画布结果略有差异
+    assert difference.max() <= 3
+
+
+def test_overlapping_seam_strips_fall_back_to_full_canvas():
+    boxes = [(0, 0, 300, 1080), (250, 0, 350, 1080), (300, 0, 720, 1080)]
+    canvas = _canvas()
+    blender = TileBlender(CANVAS, boxes, 'multiband')
+    assert blender._seams is None
+    merged = blender.blend(_crops(canvas, boxes))
+    assert np.array_equal(np.asarray(merged), canvas)
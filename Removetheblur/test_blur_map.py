@@ -0,0 +1,58 @@
+"""
+局部模糊检测测试（pytest）：平坦区域不算模糊，只发送含模糊区域的分块
+"""
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from blur_map import BlurMap
+from tiling import plan_selected_tiles
+
+CANVAS = (2160, 3240)
+
+
+def _sharp_scene(size, seed=0) -> Image.Image:
+    """随机的清晰边缘（矩形和线条），上方四分之一为平坦的天空"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    image = Image.new('RGB', size, (128, 128, 128))
+    draw = ImageDraw.Draw(image)
+    for _ in range(1500):
+        x, y = int(rng.integers(0, width)), int(rng.integers(height // 4, height))
+        w, h = int(rng.integers(10, 120)), int(rng.integers(10, 120))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        draw.rectangle((x, y, x + w, y + h), fill=color)
+        draw.line((x, y, x + w, y + h), fill=(255 - color[0],) * 3, width=3)
+    draw.rectangle((0, 0, width, height // 4), fill=(150, 190, 230))
+    return image
+
+
+def _blur_region(image: Image.Image, box) -> Image.Image:
+    image = image.copy()
+    image.paste(image.crop(box).filter(ImageFilter.GaussianBlur(6)), box[:2])
+    return image
+
+
+def test_sharp_image_with_flat_sky_sends_no_tiles():
+    plan, selected = plan_selected_tiles(CANVAS, BlurMap(_sharp_scene(CANVAS)), grid=(2, 2))
+    assert not any(selected)
+
+
+def test_only_tiles_with_blurry_region_are_sent():
+    width, height = CANVAS
+    image = _blur_region(_sharp_scene(CANVAS), (width // 2 + 200, height // 2 + 200, width, height))
+    plan, selected = plan_selected_tiles(CANVAS, BlurMap(image), grid=(2, 2))
+    # 模糊区域只在右下块
+    assert selected == [False, False, False, True]
+
+
+def test_flat_region_is_not_blurry():
+    image = Image.new('RGB', CANVAS, (150, 190, 230))
+    blur_map = BlurMap(image)
+    assert blur_map.blurry_fraction == 0
+    assert not any(blur_map.select([(0, 0) + CANVAS]))
+
+
+def test_blurred_image_sends_every_tile():
+    image = _sharp_scene(CANVAS).filter(ImageFilter.GaussianBlur(6))
+    plan, selected = plan_selected_tiles(CANVAS, BlurMap(image), grid=(2, 2))
+    assert all(selected)
@@ -0,0 +1,79 @@
+"""
+编辑后端测试（pytest）：本地后端的尺寸、确定性和 info 字段，配置错误，经 DeblurAgent 完整处理一张图片，不分块的图片不按局部模糊检测跳过
+"""
+import io
+
+import pytest
+from PIL import Image
+
+from deblur_agent import DeblurAgent
+from edit_backend import LocalEditBackend, create_edit_backend
+
+
+def _image(size=(600, 900)) -> Image.Image:
+    return Image.radial_gradient('L').convert('RGB').resize(size)
+
+
+def test_local_edit_returns_requested_size():
+    backend = LocalEditBackend(latency=0, filter_name='sharpen')
+    phases = []
+    info = {}
+    result = backend.edit_image(_image(), (1024, 1536), on_phase=phases.append, info=info, quality='low')
+    assert result.size == (1024, 1536)
+    assert phases == ['uploading', 'waiting', 'decoding']
+    assert info['backend'] == 'local'
+    assert info['usage'] is None
+    assert info['quality'] == 'low'
+
+
+def test_local_edit_is_deterministic():
+    backend = LocalEditBackend(latency=0)
+    first = backend.edit_image(_image(), (1024, 1024))
+    second = backend.edit_image(_image(), (1024, 1024))
+    assert first.tobytes() == second.tobytes()
+
+
+def test_passthrough_filter_keeps_pixels():
+    image = _image((1024, 1024))
+    result = LocalEditBackend(latency=0, filter_name='passthrough').edit_image(image, (1024, 1024))
+    assert result.tobytes() == image.tobytes()
+
+
+def test_edit_bytes_round_trip():
+    buffer = io.BytesIO()
+    _image().save(buffer, format='PNG')
+    data = LocalEditBackend(latency=0).edit(buffer.getvalue(), size=(1024, 1024))
+    assert Image.open(io.BytesIO(data)).size == (1024, 1024)
+
+
+def test_invalid_configuration():
+    with pytest.raises(ValueError):
+        LocalEditBackend(filter_name='denoise')
+    with pytest.raises(ValueError):
+        create_edit_backend('grpc')
+
+
+def test_agent_processes_image_with_local_backend(tmp_path):
+    input_path = tmp_path / 'in.png'
+    output_path = tmp_path / 'out.png'
+    _image().save(input_path)
+    agent = DeblurAgent(LocalEditBackend(latency=0))
+    result = agent.process_image(str(input_path), str(output_path), target_size=(1024, 1536), use_cache=False)
+    assert result['success'], result.get('error')
+    assert Image.open(output_path).size == (1024, 1536)
+
+
+def test_blur_select_never_skips_untiled_images(tmp_path, monkeypatch):
+    # 局部模糊检测只选择分块：不分块的图片即使判断为清晰也调用编辑后端
+    monkeypatch.setattr('deblur_agent.BLUR_SELECT', True)
+    input_path = tmp_path / 'in.png'
+    Image.effect_noise((1024, 1024), 80).convert('RGB').save(input_path)
+    calls = []
+    backend = LocalEditBackend(latency=0)
+    edit_prepared = backend.edit_prepared
+    monkeypatch.setattr(backend, 'edit_prepared',
+                        lambda *args, **kwargs: calls.append(args) or edit_prepared(*args, **kwargs))
+    result = DeblurAgent(backend).process_image(str(input_path), str(tmp_path / 'out.png'),
+                                                target_size=(1024, 1024), use_cache=False)
+    assert result['success'], result.get('error')
+    assert len(calls) == 1
@@ -0,0 +1,46 @@
+"""
+图片工具测试（pytest）：降采样解码支持各种图片模式
+"""
+import numpy as np
+from PIL import Image
+
+from image_utils import load_image, make_preview
+
+
+def _save(tmp_path, image, name='large.png'):
+    path = tmp_path / name
+    image.save(path)
+    return str(path)
+
+
+def test_load_image_reduces_large_palette_png(tmp_path):
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (6000, 5000), dtype=np.uint8), 'L').convert('P')
+    path = _save(tmp_path, image)
+
+    with load_image(path, (1024, 1536)) as loaded:
+        assert loaded.info['original_size'] == (5000, 6000)
+        assert loaded.size[0] >= 1024 and loaded.size[1] >= 1536
+        assert loaded.size[0] < 5000
+        assert loaded.mode == 'RGB'
+
+    data, mimetype = make_preview(path, 256)
+    assert mimetype == 'image/jpeg' and data
+
+
+def test_load_image_keeps_palette_transparency(tmp_path):
+    image = Image.new('P', (4000, 4000), 0)
+    image.info['transparency'] = 0
+    path = _save(tmp_path, image)
+
+    with load_image(path, (512, 512)) as loaded:
+        assert loaded.mode == 'RGBA'
+        assert loaded.size == (800, 800)
+
+
+def test_load_image_reduces_bilevel_and_16bit(tmp_path):
+    for mode, expected in (('1', 'L'), ('I;16', 'I')):
+        path = _save(tmp_path, Image.new(mode, (4000, 4000)), f'{mode.replace(";", "")}.png')
+        with load_image(path, (512, 512)) as loaded:
+            assert loaded.mode == expected
+            assert loaded.size == (800, 800)
@@ -0,0 +1,69 @@
+"""
+分阶段计时测试（pytest）：阶段累加、并行分块合并、百分位数和批次汇总
+"""
+import pytest
+
+from phase_timing import PhaseTimer, percentile, summarize_phases
+
+
+def test_phase_accumulates_and_records_on_error():
+    timer = PhaseTimer()
+    timer.add('upload', 0.5)
+    timer.add('upload', 0.25)
+    timer.add('connect', 0)
+    with pytest.raises(RuntimeError):
+        with timer.phase('save'):
+            raise RuntimeError('disk full')
+    assert timer.timings['upload'] == 0.75
+    assert 'connect' not in timer.timings
+    assert timer.timings['save'] > 0
+
+
+def test_as_dict_orders_phases():
+    timer = PhaseTimer()
+    for name in ('save', 'custom', 'load', 'upload'):
+        timer.add(name, 1.0)
+    timer.add_bytes('upload', 100)
+    timer.add_bytes('upload', 50)
+    report = timer.as_dict()
+    assert list(report['timings']) == ['load', 'upload', 'save', 'custom']
+    assert report['bytes'] == {'upload': 150}
+
+
+def test_merge_parallel_takes_slowest_tile_and_sums_bytes():
+    tiles = []
+    for seconds, nbytes in ((1.0, 10), (3.0, 20), (2.0, 30)):
+        tile = PhaseTimer()
+        tile.add('server_wait', seconds)
+        tile.add_bytes('upload', nbytes)
+        tiles.append(tile)
+    tiles[0].add('retry_wait', 0.5)
+    timer = PhaseTimer()
+    timer.add('server_wait', 0.1)
+    timer.merge_parallel(tiles)
+    assert timer.timings['server_wait'] == pytest.approx(3.1)
+    assert timer.timings['retry_wait'] == 0.5
+    assert timer.bytes['upload'] == 60
+
+
+def test_percentile_interpolates():
+    assert percentile([], 50) == 0.0
+    assert percentile([7.0], 99) == 7.0
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == pytest.approx(50.5)
+    assert percentile(values, 99) == pytest.approx(99.01)
+    assert percentile(values, 100) == 100.0
+
+
+def test_summarize_phases():
+    reports = [
+        {'timings': {'upload': 1.0, 'save': 0.2}, 'bytes': {'upload': 1000}},
+        {'timings': {'upload': 3.0}, 'bytes': {'upload': 3000}},
+        {'timings': None},
+    ]
+    summary = summarize_phases(reports)
+    assert list(summary['timings']) == ['upload', 'save']
+    assert summary['timings']['upload']['count'] == 2
+    assert summary['timings']['upload']['p50'] == 2.0
+    assert summary['timings']['upload']['max'] == 3.0
+    assert summary['bytes']['upload']['sum'] == 4000
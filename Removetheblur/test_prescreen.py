@@ -0,0 +1,35 @@
+"""
+批处理预筛测试（pytest）：得分随模糊程度单调下降，调色板图片不判为已清晰
+"""
+from PIL import Image, ImageFilter
+
+from prescreen import prescreen_images, score_image
+from test_blur_map import _sharp_scene
+
+
+def test_blurred_copy_scores_lower(tmp_path):
+    source = _sharp_scene((1024, 1536))
+    scores = []
+    for radius in (0, 0.5, 1, 2, 4):
+        path = tmp_path / f'blur_{radius}.png'
+        (source.filter(ImageFilter.GaussianBlur(radius)) if radius else source).save(path)
+        scores.append(score_image(str(path))['score'])
+    assert all(later < earlier for earlier, later in zip(scores, scores[1:]))
+
+
+def test_flat_areas_do_not_lower_the_score(tmp_path):
+    source = _sharp_scene((1024, 1536))
+    cropped = source.crop((0, 384, 1024, 1536))
+    paths = []
+    for name, image in (('with_sky', source), ('without_sky', cropped)):
+        paths.append(tmp_path / f'{name}.png')
+        image.save(paths[-1])
+    with_sky, without_sky = (score_image(str(path))['score'] for path in paths)
+    assert abs(with_sky - without_sky) <= 0.2 * without_sky
+
+
+def test_palette_image_is_never_sharp(tmp_path):
+    path = tmp_path / 'dithered.png'
+    _sharp_scene((1024, 1536)).quantize(16, dither=Image.Dither.FLOYDSTEINBERG).save(path)
+    screen = prescreen_images([str(path)], threshold=0)[str(path)]
+    assert screen['palette'] and not screen['sharp']
@@ -0,0 +1,282 @@
+"""
+请求调度控制测试（pytest）：Retry-After 解析、限速器、重试退避、熔断器、单飞合并
+"""
+import email.utils
+import threading
+import time
+
+import request_control
+from request_control import CircuitBreaker, RateLimiter, RetryPolicy, SingleFlight, parse_retry_after
+from config import THROTTLE_DEFAULT_WAIT, THROTTLE_MAX_WAIT
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after('120') == 120.0
+    assert parse_retry_after(' 1.5 ') == 1.5
+    assert parse_retry_after('-3') == 0.0
+
+
+def test_parse_retry_after_http_date():
+    future = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 27 <= parse_retry_after(future) <= 30
+    past = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert parse_retry_after(past) == 0.0
+
+
+def test_parse_retry_after_invalid():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('') is None
+    assert parse_retry_after('soon') is None
+
+
+def test_throttle_pauses_all_requests():
+    limiter = RateLimiter(requests_per_minute=0, max_concurrency=0)
+    assert limiter.on_throttle(429, retry_after=0.2) == 0.2
+    assert limiter.pause_remaining() > 0
+    waited = limiter.acquire()
+    limiter.release()
+    assert 0.15 <= waited < 1.0
+    assert limiter.stats()['throttle_count'] == 1
+
+
+def test_throttle_wait_is_capped_and_backs_off_without_retry_after():
+    limiter = RateLimiter(requests_per_minute=0, max_concurrency=0)
+    assert limiter.on_throttle(503, retry_after=THROTTLE_MAX_WAIT * 10) == THROTTLE_MAX_WAIT
+    # 没有 Retry-After 时按连续限流次数指数退避
+    assert limiter.on_throttle(429) == min(THROTTLE_DEFAULT_WAIT * 2, THROTTLE_MAX_WAIT)
+    assert limiter.on_throttle(429) == min(THROTTLE_DEFAULT_WAIT * 4, THROTTLE_MAX_WAIT)
+    limiter.release()
+    assert limiter.on_throttle(429) == min(THROTTLE_DEFAULT_WAIT, THROTTLE_MAX_WAIT)
+
+
+def test_concurrency_limit_blocks_until_release():
+    limiter = RateLimiter(requests_per_minute=0, max_concurrency=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def second():
+        limiter.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release()
+    assert acquired.wait(1.0)
+    thread.join()
+    limiter.release()
+    assert limiter.stats()['in_flight'] == 0
+
+
+def test_should_retry_by_kind_and_attempt():
+    policy = RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=8.0, retry_on={'timeout', 'server'})
+    assert policy.should_retry('timeout', 1)
+    assert policy.should_retry('server', 2)
+    assert not policy.should_retry('server', 3)
+    assert not policy.should_retry('auth', 1)
+
+
+def test_backoff_ceiling_doubles_up_to_max_delay(monkeypatch):
+    policy = RetryPolicy(max_attempts=10, base_delay=1.5, max_delay=10.0)
+    monkeypatch.setattr(request_control.random, 'uniform', lambda low, high: (low, high))
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == [
+        (0, 1.5), (0, 3.0), (0, 6.0), (0, 10.0), (0, 10.0)]
+
+
+def test_backoff_is_jittered_within_bounds():
+    policy = RetryPolicy(max_attempts=10, base_delay=2.0, max_delay=5.0)
+    for attempt in (1, 2, 3, 8):
+        ceiling = min(5.0, 2.0 * 2 ** (attempt - 1))
+        delays = [policy.delay(attempt) for _ in range(200)]
+        assert all(0 <= delay <= ceiling for delay in delays)
+        # 全抖动：不是固定值
+        assert len(set(delays)) > 1
+
+
+COOLDOWN = 0.05
+
+
+def _breaker(**kwargs) -> CircuitBreaker:
+    options = dict(failure_threshold=2, cooldown=COOLDOWN, max_pause=1.0, trip_on={'auth', 'connect'})
+    options.update(kwargs)
+    return CircuitBreaker(**options)
+
+
+def _half_open(breaker: CircuitBreaker):
+    """打开熔断器并等过冷却期（下一次 allow_request 进入半开）"""
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure('connect')
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(COOLDOWN * 1.5)
+
+
+def _in_thread(func):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_trips_after_consecutive_systemic_failures():
+    breaker = _breaker()
+    breaker.record_failure('connect')
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+    breaker.record_failure('auth', '401')
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.trip_count == 1
+    assert breaker.cause == 'auth: 401'
+    assert not breaker.allow_request()
+
+
+def test_success_resets_consecutive_failures():
+    breaker = _breaker()
+    breaker.record_failure('connect')
+    breaker.record_success()
+    breaker.record_failure('connect')
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = _breaker()
+    _half_open(breaker)
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow_request()
+    assert not _in_thread(breaker.allow_request)
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert _in_thread(breaker.allow_request)
+
+
+def test_failed_probe_reopens():
+    breaker = _breaker()
+    _half_open(breaker)
+    assert breaker.allow_request()
+    breaker.record_failure('connect')
+    assert breaker.state == CircuitBreaker.OPEN
+    # 重新打开不算新的熔断次数
+    assert breaker.trip_count == 1
+    assert not breaker.allow_request()
+
+
+def test_release_probe_lets_the_next_request_probe():
+    breaker = _breaker()
+    _half_open(breaker)
+    assert breaker.allow_request()
+    # 其他线程不能释放不属于它的探测名额
+    _in_thread(breaker.release_probe)
+    assert not _in_thread(breaker.allow_request)
+
+    breaker.release_probe()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert _in_thread(breaker.allow_request)
+
+
+def test_release_probe_after_verdict_is_a_no_op():
+    breaker = _breaker()
+    _half_open(breaker)
+    assert breaker.allow_request()
+    breaker.record_success()
+    breaker.release_probe()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_non_trip_failure_keeps_count_when_closed():
+    breaker = _breaker()
+    breaker.record_failure('connect')
+    breaker.record_failure('server')
+    breaker.record_failure('connect')
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_non_trip_failure_does_not_close_half_open_breaker():
+    breaker = _breaker()
+    _half_open(breaker)
+    assert breaker.allow_request()
+    breaker.record_failure('server', '502')
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.stats()['consecutive_failures'] == 2
+    # 探测名额已释放，下一个请求继续探测
+    assert _in_thread(breaker.allow_request)
+
+
+def test_wait_until_allowed_gives_up_after_max_pause():
+    breaker = _breaker(cooldown=10.0, max_pause=0.1)
+    breaker.record_failure('connect')
+    breaker.record_failure('connect')
+    paused = []
+    started = time.monotonic()
+    assert not breaker.wait_until_allowed(on_pause=lambda: paused.append(True))
+    assert paused == [True]
+    assert time.monotonic() - started < 1.0
+
+
+def _followers(single_flight: SingleFlight, key: str, count: int):
+    """count 个线程加入同一个请求并等待结果"""
+    joined = threading.Barrier(count + 1)
+    results = []
+    lock = threading.Lock()
+
+    def follow():
+        flight, is_leader = single_flight.join(key)
+        joined.wait()
+        assert not is_leader
+        outcome = flight.wait()
+        with lock:
+            results.append(outcome)
+
+    threads = [threading.Thread(target=follow) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    joined.wait()
+    return threads, results
+
+
+def test_single_flight_coalesces_identical_requests():
+    single_flight = SingleFlight()
+    flight, is_leader = single_flight.join('key')
+    assert is_leader
+    threads, results = _followers(single_flight, 'key', 4)
+    assert flight.followers == 4
+    # 其他键不受影响
+    assert single_flight.join('other')[1]
+
+    single_flight.complete('key', flight, b'image', {'backend': 'a', 'error_kind': None})
+    for thread in threads:
+        thread.join(timeout=1.0)
+    assert results == [(b'image', {'backend': 'a', 'error_kind': None})] * 4
+    assert single_flight.stats() == {'in_flight': 1, 'leaders': 2, 'coalesced': 4}
+
+    # 完成后相同的键重新发起请求
+    assert single_flight.join('key')[1]
+
+
+def test_single_flight_propagates_leader_failure():
+    single_flight = SingleFlight()
+    flight, _ = single_flight.join('key')
+    threads, results = _followers(single_flight, 'key', 2)
+    info = {}
+    try:
+        try:
+            info['error_kind'] = 'timeout'
+            raise TimeoutError('read timed out')
+        finally:
+            single_flight.complete('key', flight, None, info)
+    except TimeoutError:
+        pass
+    for thread in threads:
+        thread.join(timeout=1.0)
+    assert results == [(None, {'error_kind': 'timeout'})] * 2
+    assert single_flight.stats()['in_flight'] == 0
+
+
+def test_single_flight_followers_get_a_copy_of_leader_info():
+    single_flight = SingleFlight()
+    flight, _ = single_flight.join('key')
+    follower, _ = single_flight.join('key')
+    info = {'error_kind': None}
+    single_flight.complete('key', flight, b'image', info)
+    info['error_kind'] = 'later change'
+    assert follower.wait() == (b'image', {'error_kind': None})
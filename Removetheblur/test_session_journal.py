@@ -0,0 +1,64 @@
+"""
+会话日志测试（pytest）：换工作目录续跑、没有日志时续跑
+"""
+import json
+import os
+
+from session_journal import SessionJournal
+
+
+def _make_batch(tmp_path):
+    inputs = tmp_path / 'in'
+    inputs.mkdir()
+    image_file = inputs / 'a.jpg'
+    image_file.write_bytes(b'input')
+    return image_file
+
+
+def test_completed_after_changing_working_directory(tmp_path, monkeypatch):
+    image_file = _make_batch(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('out')
+    with open('out/a_clear.jpg', 'wb') as f:
+        f.write(b'output')
+    journal = SessionJournal('out')
+    journal.start(input_folder=str(image_file.parent))
+    journal.record(image_file, 'saved', output='out/a_clear.jpg')
+
+    elsewhere = tmp_path / 'elsewhere'
+    elsewhere.mkdir()
+    monkeypatch.chdir(elsewhere)
+    done = SessionJournal(str(tmp_path / 'out')).completed([image_file])
+    assert list(done) == ['a.jpg']
+    assert os.path.samefile(done['a.jpg']['output'], tmp_path / 'out' / 'a_clear.jpg')
+
+
+def test_output_outside_journal_folder_is_stored_absolute(tmp_path):
+    image_file = _make_batch(tmp_path)
+    output = tmp_path / 'other' / 'a_clear.jpg'
+    output.parent.mkdir()
+    output.write_bytes(b'output')
+    journal = SessionJournal(str(tmp_path / 'out'))
+    journal.start()
+    journal.record(image_file, 'saved', output=str(output))
+    _, images = journal.read()
+    assert os.path.isabs(images['a.jpg']['output'])
+    assert list(journal.completed([image_file])) == ['a.jpg']
+
+
+def test_resume_without_journal_starts_a_session(tmp_path):
+    image_file = _make_batch(tmp_path)
+    journal = SessionJournal(str(tmp_path / 'out'))
+    journal.resume(1, input_folder=str(image_file.parent), prompt='')
+    journal.record(image_file, 'failed', error='boom')
+
+    with open(journal.path, encoding='utf-8') as f:
+        events = [json.loads(line)['event'] for line in f]
+    assert events == ['start', 'image']
+    meta, images = journal.read()
+    assert meta['input_folder'] == str(image_file.parent)
+    assert images['a.jpg']['state'] == 'failed'
+
+    journal.resume(1)
+    meta, images = journal.read()
+    assert meta['input_folder'] == str(image_file.parent) and 'a.jpg' in images
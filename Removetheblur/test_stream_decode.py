@@ -0,0 +1,74 @@
+"""
+b64_json 流式解码测试（pytest）：任意分块边界、JSON 转义、data URI 前缀、截断
+"""
+import base64
+import json
+import os
+
+import pytest
+
+from stream_decode import B64JsonStreamDecoder
+
+IMAGE = os.urandom(3001)
+
+
+def _response(b64: str, extra_image: str = None) -> bytes:
+    data = [{'b64_json': b64}]
+    if extra_image is not None:
+        data.append({'b64_json': extra_image})
+    body = {'created': 1, 'data': data, 'usage': {'input_tokens': 10, 'output_tokens': 20}}
+    return json.dumps(body).encode('utf-8')
+
+
+def _decode(payload: bytes, chunk_size: int) -> B64JsonStreamDecoder:
+    decoder = B64JsonStreamDecoder()
+    for start in range(0, len(payload), chunk_size):
+        decoder.feed(payload[start:start + chunk_size])
+    decoder.close()
+    return decoder
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 10, 64, 1000, 1 << 20])
+def test_chunk_boundaries(chunk_size):
+    decoder = _decode(_response(base64.b64encode(IMAGE).decode('ascii')), chunk_size)
+    assert decoder.image_bytes() == IMAGE
+    meta = decoder.metadata()
+    assert meta['data'][0]['b64_json'] == ''
+    assert meta['usage'] == {'input_tokens': 10, 'output_tokens': 20}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 9, 77])
+def test_escaped_slashes_and_line_breaks(chunk_size):
+    b64 = base64.encodebytes(IMAGE).decode('ascii')
+    # json.dumps 把换行写成 \n；斜杠另外按 \/ 转义
+    payload = _response(b64).replace(b'/', b'\\/')
+    decoder = _decode(payload, chunk_size)
+    assert decoder.image_bytes() == IMAGE
+
+
+@pytest.mark.parametrize('chunk_size', [1, 6, 50])
+def test_data_uri_prefix_and_missing_padding(chunk_size):
+    b64 = 'data:image/png;base64,' + base64.b64encode(IMAGE[:3000] + b'x').decode('ascii').rstrip('=')
+    decoder = _decode(_response(b64), chunk_size)
+    assert decoder.image_bytes() == IMAGE[:3000] + b'x'
+
+
+def test_only_first_image_is_decoded():
+    first = base64.b64encode(IMAGE).decode('ascii')
+    second = base64.b64encode(b'second image').decode('ascii')
+    decoder = _decode(_response(first, second), 13)
+    assert decoder.image_bytes() == IMAGE
+    assert [item['b64_json'] for item in decoder.metadata()['data']] == ['', '']
+
+
+def test_missing_b64_json():
+    decoder = _decode(json.dumps({'data': [{'url': 'https://example.com/a.png'}]}).encode(), 8)
+    assert decoder.image_bytes() is None
+
+
+def test_truncated_response_raises():
+    payload = _response(base64.b64encode(IMAGE).decode('ascii'))
+    decoder = B64JsonStreamDecoder()
+    decoder.feed(payload[:len(payload) // 2])
+    with pytest.raises(ValueError):
+        decoder.close()
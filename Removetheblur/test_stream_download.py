@@ -0,0 +1,110 @@
+"""
+url 结果流式下载测试（pytest）：中断后按 Range 续传、不支持 Range 时从头下载、状态码错误
+"""
+import io
+
+import httpx
+import pytest
+from PIL import Image
+
+from request_control import EditError
+from stream_download import ResultDownload
+
+
+def _png() -> bytes:
+    buffer = io.BytesIO()
+    Image.radial_gradient('L').convert('RGB').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+PNG = _png()
+
+
+class _BrokenStream(httpx.SyncByteStream):
+    """发送 data 后连接中断"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __iter__(self):
+        yield self.data
+        raise httpx.ReadError('connection reset')
+
+
+def _client(handler) -> httpx.Client:
+    return httpx.Client(transport=httpx.MockTransport(handler))
+
+
+def _download(handler, **kwargs) -> ResultDownload:
+    download = ResultDownload(**kwargs)
+    with _client(handler) as client:
+        download.fetch(client, 'https://files.example.com/result.png')
+    return download
+
+
+def test_resumes_with_range_after_interruption():
+    ranges = []
+    cut = len(PNG) // 3
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        ranges.append(request.headers.get('Range'))
+        if len(ranges) == 1:
+            return httpx.Response(200, headers={'Content-Length': str(len(PNG))}, stream=_BrokenStream(PNG[:cut]))
+        offset = int(request.headers['Range'][len('bytes='):-1])
+        return httpx.Response(206, content=PNG[offset:])
+
+    download = _download(handler, max_resumes=2)
+    try:
+        assert ranges == [None, f'bytes={cut}-']
+        assert download.resumes == 1
+        assert download.getvalue() == PNG
+        assert download.image().size == (256, 256)
+    finally:
+        download.close()
+
+
+def test_restarts_when_range_is_not_supported():
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.headers.get('Range'))
+        if len(calls) == 1:
+            return httpx.Response(200, stream=_BrokenStream(PNG[:100]))
+        return httpx.Response(200, content=PNG)
+
+    download = _download(handler, max_resumes=1)
+    try:
+        assert calls == [None, 'bytes=100-']
+        assert download.getvalue() == PNG
+        assert download.image().size == (256, 256)
+    finally:
+        download.close()
+
+
+def test_gives_up_after_max_resumes():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, stream=_BrokenStream(b''))
+
+    with pytest.raises(httpx.ReadError):
+        _download(handler, max_resumes=2)
+
+
+def test_status_error_is_classified():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(403, content=b'forbidden')
+
+    with pytest.raises(EditError) as excinfo:
+        _download(handler)
+    assert excinfo.value.kind == 'auth'
+
+
+def test_spools_large_results_to_disk():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=PNG)
+
+    download = _download(handler, spool_max_bytes=1024)
+    try:
+        assert download.getvalue() == PNG
+        assert download.image().size == (256, 256)
+    finally:
+        download.close()
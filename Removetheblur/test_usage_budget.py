@@ -0,0 +1,121 @@
+"""
+用量与预算测试（pytest）：按每次调用的尺寸预估、降级/暂停/停止阈值、结算后学习实测用量
+"""
+import threading
+import time
+
+import pytest
+
+from usage_budget import (
+    BatchBudget, DEFAULT_INPUT_TOKENS, DEFAULT_OUTPUT_TOKENS, UsageLedger, estimate_cost, normalize_usage,
+)
+
+SQUARE = (1024, 1024)
+PORTRAIT = (1024, 1536)
+
+
+def _tokens(quality: str, size) -> int:
+    return DEFAULT_INPUT_TOKENS + DEFAULT_OUTPUT_TOKENS[quality][0 if size[0] == size[1] else 1]
+
+
+def _usage(total_tokens: int) -> dict:
+    return normalize_usage({'input_tokens': DEFAULT_INPUT_TOKENS, 'output_tokens': total_tokens - DEFAULT_INPUT_TOKENS})
+
+
+def _budget(tmp_path, **kwargs) -> BatchBudget:
+    options = dict(base_quality='high', action='stop', batch_tokens=0, batch_cost=0,
+                   daily_tokens=0, daily_cost=0, max_pause=0.2)
+    options.update(kwargs)
+    return BatchBudget(UsageLedger(str(tmp_path / 'usage.json')), **options)
+
+
+def test_normalize_usage():
+    assert normalize_usage({'prompt_tokens': 10, 'completion_tokens': 5}) == {
+        'input_tokens': 10, 'output_tokens': 5, 'total_tokens': 15, 'cost': round(estimate_cost(10, 5), 6)}
+    assert normalize_usage({'input_tokens': 0}) is None
+    assert normalize_usage('n/a') is None
+
+
+def test_admit_prices_each_request_size(tmp_path):
+    budget = _budget(tmp_path)
+    reservation = budget.admit([SQUARE, PORTRAIT, PORTRAIT])
+    assert reservation['tokens'] == _tokens('high', SQUARE) + 2 * _tokens('high', PORTRAIT)
+    assert reservation['requests'] == 3
+    assert reservation['square'] is None
+    assert budget.admit([PORTRAIT, PORTRAIT])['square'] is False
+
+
+def test_degrades_quality_before_the_batch_limit(tmp_path):
+    limit = _tokens('high', PORTRAIT) + _tokens('medium', PORTRAIT)
+    budget = _budget(tmp_path, action='degrade', batch_tokens=limit)
+    assert budget.admit([PORTRAIT])['quality'] == 'high'
+    assert budget.state == 'ok'
+    assert budget.admit([PORTRAIT])['quality'] == 'medium'
+    assert budget.state == 'degraded'
+
+
+def test_stop_when_batch_limit_reached(tmp_path):
+    budget = _budget(tmp_path, action='stop', batch_tokens=_tokens('high', PORTRAIT) * 2)
+    first = budget.admit([PORTRAIT])
+    budget.settle(first, _usage(_tokens('high', PORTRAIT)))
+    second = budget.admit([PORTRAIT])
+    budget.settle(second, _usage(_tokens('high', PORTRAIT)))
+    assert budget.admit([PORTRAIT]) is None
+    assert budget.state == 'exhausted'
+    assert budget.reason == '批次预算已用完'
+    # 用完后不再派发
+    assert budget.admit([SQUARE]) is None
+
+
+def test_waits_for_in_flight_images_before_stopping(tmp_path):
+    budget = _budget(tmp_path, action='stop', batch_tokens=_tokens('high', PORTRAIT) + 1000)
+    first = budget.admit([PORTRAIT])
+    admitted = []
+    thread = threading.Thread(target=lambda: admitted.append(budget.admit([PORTRAIT])))
+    thread.start()
+    time.sleep(0.1)
+    assert not admitted
+    # 实际用量远低于预估：第二张可以派发
+    budget.settle(first, _usage(800))
+    thread.join(timeout=2.0)
+    assert admitted and admitted[0] is not None
+    assert admitted[0]['tokens'] == 800
+    assert budget.state == 'ok'
+
+
+def test_pause_on_daily_limit_gives_up_after_max_pause(tmp_path):
+    budget = _budget(tmp_path, action='pause', daily_tokens=5000, max_pause=0.2)
+    budget.ledger.record(_usage(4900))
+    paused = []
+    started = time.monotonic()
+    assert budget.admit([PORTRAIT], on_pause=lambda: paused.append(budget.state)) is None
+    assert paused == ['paused']
+    assert 0.15 <= time.monotonic() - started < 2.0
+    assert budget.state == 'exhausted'
+    assert budget.reason == '每日预算已用完'
+    assert budget.stats()['paused_seconds'] >= 0.1
+
+
+def test_pause_does_not_wait_on_the_batch_limit(tmp_path):
+    budget = _budget(tmp_path, action='pause', batch_tokens=100, max_pause=10.0)
+    started = time.monotonic()
+    assert budget.admit([PORTRAIT]) is None
+    assert time.monotonic() - started < 1.0
+    assert budget.reason == '批次预算已用完'
+
+
+def test_settle_learns_per_call_estimate(tmp_path):
+    budget = _budget(tmp_path)
+    budget.settle(budget.admit([PORTRAIT, PORTRAIT]), _usage(3000))
+    assert budget.admit([PORTRAIT])['tokens'] == 1500
+    # 方形和非方形混合的调用不学习
+    budget.settle(budget.admit([SQUARE, PORTRAIT]), _usage(100000))
+    assert budget.admit([SQUARE])['tokens'] == _tokens('high', SQUARE)
+    stats = budget.stats()
+    assert stats['batch']['total_tokens'] == 103000
+    assert stats['quality_counts'] == {'high': 2}
+
+
+def test_invalid_action(tmp_path):
+    with pytest.raises(ValueError):
+        _budget(tmp_path, action='ignore')
@@ -0,0 +1,171 @@
+"""
+大尺寸目标的分块处理
+目标尺寸不是接口支持的尺寸（如 2160×3240）时，把目标尺寸的画布切成 N×M 个互相重叠的分块，
+每块缩放到最接近其宽高比的接口尺寸单独编辑（各分块并发发送，总耗时接近单块的延迟），
+结果缩放回分块大小后在重叠区融合拼接（blending），输出保留原生细节而不是整张小图放大；
+按局部模糊检测（blur_map）只发送含模糊区域的分块，清晰的分块直接使用原图
+"""
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from blending import Box, blend_tiles
+from blur_map import BlurMap
+from config import TILE_MODE, TILE_OVERLAP, TILE_MAX_UPSCALE, TILE_MAX_GRID, TILE_MAX_WORKERS
+
+# 编辑接口支持的尺寸
+API_SIZES = ((1024, 1024), (1024, 1536), (1536, 1024))
+
+
+def closest_api_size(size: Tuple[int, int]) -> Tuple[int, int]:
+    """宽高比最接近的接口尺寸"""
+    aspect = size[0] / max(1, size[1])
+    return min(API_SIZES, key=lambda api: abs(math.log(aspect * api[1] / api[0])))
+
+
+def _spans(length: int, count: int, overlap: int) -> List[Tuple[int, int]]:
+    """把 [0, length) 均匀分成 count 段，相邻段重叠约 overlap 像素"""
+    if count <= 1:
+        return [(0, length)]
+    span = min(length, math.ceil((length + (count - 1) * overlap) / count))
+    step = (length - span) / (count - 1)
+    return [(round(i * step), round(i * step) + span) for i in range(count)]
+
+
+class TilePlan:
+    """分块方案：画布尺寸、网格、每块的区域和发送给接口的尺寸"""
+
+    def __init__(self, canvas_size: Tuple[int, int], grid: Tuple[int, int], overlap: int):
+        self.canvas_size = canvas_size
+        self.grid = grid
+        self.overlap = overlap
+        cols, rows = grid
+        xs = _spans(canvas_size[0], cols, overlap)
+        ys = _spans(canvas_size[1], rows, overlap)
+        self.boxes: List[Box] = [(left, top, right, bottom) for top, bottom in ys for left, right in xs]
+        self.api_sizes: List[Tuple[int, int]] = [
+            closest_api_size((right - left, bottom - top)) for left, top, right, bottom in self.boxes
+        ]
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def max_upscale(self) -> float:
+        """接口结果缩放回分块大小时的最大放大倍数（<= 1 表示原生细节）"""
+        return max(
+            max((right - left) / api[0], (bottom - top) / api[1])
+            for (left, top, right, bottom), api in zip(self.boxes, self.api_sizes)
+        )
+
+    def describe(self) -> str:
+        left, top, right, bottom = self.boxes[0]
+        return (f"{self.grid[0]}×{self.grid[1]} 分块（每块约 {right - left}×{bottom - top}，"
+                f"重叠 {self.overlap}px，最大放大 {self.max_upscale():.2f}x）")
+
+
+def is_api_size(size: Tuple[int, int]) -> bool:
+    return tuple(size) in API_SIZES
+
+
+def should_tile(target_size: Tuple[int, int]) -> bool:
+    """目标尺寸是否走分块处理（TILE_MODE=auto 且不是接口支持的尺寸）"""
+    return TILE_MODE == 'auto' and not is_api_size(target_size)
+
+
+def parse_grid(text: str) -> Optional[Tuple[int, int]]:
+    """'3x2' -> (3, 2)（列×行），空字符串或 auto 返回 None"""
+    text = (text or '').strip().lower()
+    if not text or text == 'auto':
+        return None
+    cols, rows = text.replace('×', 'x').split('x')
+    return max(1, int(cols)), max(1, int(rows))
+
+
+def _candidate_plans(canvas_size: Tuple[int, int], overlap: int, max_upscale: float) -> List[TilePlan]:
+    """接口结果放大不超过 max_upscale 倍的所有网格方案（按块数、放大倍数排序）"""
+    plans = []
+    for cols in range(1, TILE_MAX_GRID + 1):
+        for rows in range(1, TILE_MAX_GRID + 1):
+            plan = TilePlan(canvas_size, (cols, rows), overlap)
+            if plan.max_upscale() <= max_upscale:
+                plans.append(plan)
+    plans.sort(key=lambda plan: (len(plan), plan.max_upscale()))
+    if not plans:
+        # 画布太大：用最大网格（结果会被放大）
+        plans.append(TilePlan(canvas_size, (TILE_MAX_GRID, TILE_MAX_GRID), overlap))
+    return plans
+
+
+def plan_tiles(canvas_size: Tuple[int, int], grid: Optional[Tuple[int, int]] = None,
+               overlap: int = None, max_upscale: float = None) -> TilePlan:
+    """
+    规划分块
+
+    Args:
+        canvas_size: 输出画布尺寸 (width, height)
+        grid: 指定网格 (列, 行)；None 则自动选择：
+              接口结果放大不超过 max_upscale 倍的方案中块数最少的（块数相同时放大倍数小的优先）
+        overlap: 相邻分块的重叠像素（画布坐标），默认 TILE_OVERLAP
+        max_upscale: 自动选择时允许的最大放大倍数，默认 TILE_MAX_UPSCALE
+    """
+    overlap = TILE_OVERLAP if overlap is None else max(0, int(overlap))
+    if grid is not None:
+        return TilePlan(canvas_size, grid, overlap)
+    max_upscale = TILE_MAX_UPSCALE if max_upscale is None else max_upscale
+    return _candidate_plans(canvas_size, overlap, max_upscale)[0]
+
+
+def plan_selected_tiles(canvas_size: Tuple[int, int], blur_map: BlurMap,
+                        grid: Optional[Tuple[int, int]] = None, overlap: int = None,
+                        max_upscale: float = None) -> Tuple[TilePlan, List[bool]]:
+    """
+    按模糊块掩码规划分块：在候选网格中选择需要发送的分块最少的方案（相同时块数少、放大倍数小的优先）
+
+    Returns:
+        (分块方案, 每块是否发送)
+    """
+    overlap = TILE_OVERLAP if overlap is None else max(0, int(overlap))
+    if grid is not None:
+        plans = [TilePlan(canvas_size, grid, overlap)]
+    else:
+        plans = _candidate_plans(canvas_size, overlap, TILE_MAX_UPSCALE if max_upscale is None else max_upscale)
+    best = None
+    for plan in plans:
+        selected = blur_map.select(plan.boxes)
+        key = (sum(selected), len(plan), plan.max_upscale())
+        if best is None or key < best[0]:
+            best = (key, plan, selected)
+    return best[1], best[2]
+
+
+def split_tiles(canvas: Image.Image, plan: TilePlan) -> List[Image.Image]:
+    """按分块方案裁剪画布"""
+    return [canvas.crop(box) for box in plan.boxes]
+
+
+def merge_tiles(tiles: List[Image.Image], plan: TilePlan) -> Image.Image:
+    """
+    拼接编辑后的分块（每块先缩放回分块大小），重叠区按 BLEND_METHOD 融合（见 blending）
+
+    Returns:
+        画布尺寸的 RGB 图片
+    """
+    return blend_tiles(tiles, plan.canvas_size, plan.boxes)
+
+
+_tile_executor: Optional[ThreadPoolExecutor] = None
+_tile_executor_lock = threading.Lock()
+
+
+def get_tile_executor() -> ThreadPoolExecutor:
+    """获取进程级共享的分块请求线程池（所有图片的分块共用 TILE_MAX_WORKERS 个名额）"""
+    global _tile_executor
+    if _tile_executor is None:
+        with _tile_executor_lock:
+            if _tile_executor is None:
+                _tile_executor = ThreadPoolExecutor(max_workers=TILE_MAX_WORKERS,
+                                                    thread_name_prefix='TileWorker')
+    return _tile_executor
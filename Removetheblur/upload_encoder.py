@@ -0,0 +1,211 @@
+"""
+上传编码器 - 选择编辑接口请求体的图片编码
+支持 PNG（可调 compress_level）、无损 WebP，以及接口允许时的高质量 JPEG/WebP；
+auto 模式根据实测的编码耗时和上传带宽，选择“编码时间 + 预计上传时间”最小的编码
+"""
+import io
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from PIL import Image
+
+from config import (
+    UPLOAD_FORMAT,
+    UPLOAD_PNG_COMPRESS_LEVEL,
+    UPLOAD_QUALITY,
+    UPLOAD_ALLOW_LOSSY,
+    UPLOAD_BANDWIDTH_DEFAULT,
+)
+
+# 编码名 -> (PIL格式, MIME类型, 扩展名)
+UPLOAD_FORMATS = {
+    'png': ('PNG', 'image/png', 'png'),
+    'webp_lossless': ('WEBP', 'image/webp', 'webp'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+}
+
+# 编码方案: (编码名, PNG压缩级别)；非PNG时压缩级别忽略
+EncodingChoice = Tuple[str, int]
+
+
+class BandwidthEstimator:
+    """上传带宽估计（字节/秒，实测上传的指数滑动平均，线程安全）"""
+
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, initial: float = None):
+        self._lock = threading.Lock()
+        self.bandwidth = float(UPLOAD_BANDWIDTH_DEFAULT if initial is None else initial)
+        self.samples = 0
+
+    def record(self, nbytes: int, seconds: float):
+        """记录一次实测上传（请求体发送耗时）"""
+        if nbytes <= 0 or seconds <= 0:
+            return
+        sample = nbytes / seconds
+        with self._lock:
+            if self.samples == 0:
+                self.bandwidth = sample
+            else:
+                self.bandwidth += self.EWMA_ALPHA * (sample - self.bandwidth)
+            self.samples += 1
+
+    def restore(self, bandwidth: float, samples: int):
+        """恢复持久化的估计值"""
+        if bandwidth > 0 and samples > 0:
+            with self._lock:
+                self.bandwidth = float(bandwidth)
+                self.samples = int(samples)
+
+
+def encode_for_upload(image: Image.Image, fmt: str = 'png',
+                      compress_level: int = 6, quality: int = 95) -> io.BytesIO:
+    """
+    按指定编码把图片写入BytesIO
+
+    Args:
+        image: RGB图片
+        fmt: 编码名（png / webp_lossless / jpeg / webp）
+        compress_level: PNG压缩级别（0-9，越小越快、体积越大）
+        quality: 有损编码质量（jpeg/webp）
+
+    Returns:
+        已 seek(0) 的 BytesIO
+    """
+    if fmt not in UPLOAD_FORMATS:
+        raise ValueError(f"不支持的上传编码: {fmt}（可选: {', '.join(UPLOAD_FORMATS)}）")
+    pil_format = UPLOAD_FORMATS[fmt][0]
+    buffer = io.BytesIO()
+    if fmt == 'png':
+        image.save(buffer, format=pil_format, compress_level=compress_level)
+    elif fmt == 'webp_lossless':
+        image.save(buffer, format=pil_format, lossless=True, method=3)
+    elif fmt == 'jpeg':
+        # 4:4:4 不做色度抽样，保留边缘细节
+        image.save(buffer, format=pil_format, quality=quality, subsampling=0)
+    else:
+        image.save(buffer, format=pil_format, quality=quality, method=4)
+    buffer.seek(0)
+    return buffer
+
+
+class UploadEncoder:
+    """
+    上传编码选择器（线程安全）
+
+    auto 模式下第一张图片会把所有候选编码各试一次做校准，之后按每种编码的
+    “编码耗时/像素”和“字节/像素”估计值，加上实测上传带宽，选总耗时最小的编码
+    """
+
+    # 指数滑动平均的权重
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, mode: str = None, compress_level: int = None,
+                 quality: int = None, allow_lossy: bool = None,
+                 bandwidth: BandwidthEstimator = None):
+        self.mode = (mode or UPLOAD_FORMAT).strip().lower()
+        if self.mode != 'auto' and self.mode not in UPLOAD_FORMATS:
+            raise ValueError(f"UPLOAD_FORMAT 无效: {self.mode}（可选: auto, {', '.join(UPLOAD_FORMATS)}）")
+        self.compress_level = UPLOAD_PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+        self.quality = UPLOAD_QUALITY if quality is None else quality
+        self.allow_lossy = UPLOAD_ALLOW_LOSSY if allow_lossy is None else allow_lossy
+        self._lock = threading.Lock()
+        # 上传带宽估计（可与超时控制共用同一个估计器）
+        self.bandwidth_estimator = bandwidth if bandwidth is not None else BandwidthEstimator()
+        # 每种编码的估计: {'sec_per_px': ..., 'bytes_per_px': ...}
+        self._estimates: Dict[EncodingChoice, Dict[str, float]] = {}
+
+    def candidates(self) -> List[EncodingChoice]:
+        """auto 模式的候选编码"""
+        choices = [('png', 1), ('png', self.compress_level), ('webp_lossless', 0)]
+        if self.allow_lossy:
+            choices += [('jpeg', 0), ('webp', 0)]
+        # 去重（compress_level 配置为1时）
+        return list(dict.fromkeys(choices))
+
+    @property
+    def bandwidth(self) -> float:
+        """当前上传带宽估计（字节/秒）"""
+        return self.bandwidth_estimator.bandwidth
+
+    def record_upload(self, nbytes: int, seconds: float):
+        """记录一次实测上传（请求体发送耗时），更新带宽估计"""
+        self.bandwidth_estimator.record(nbytes, seconds)
+
+    def _update_estimate(self, choice: EncodingChoice, pixels: int, seconds: float, nbytes: int):
+        sec_per_px = seconds / pixels
+        bytes_per_px = nbytes / pixels
+        with self._lock:
+            est = self._estimates.get(choice)
+            if est is None:
+                self._estimates[choice] = {'sec_per_px': sec_per_px, 'bytes_per_px': bytes_per_px}
+            else:
+                est['sec_per_px'] += self.EWMA_ALPHA * (sec_per_px - est['sec_per_px'])
+                est['bytes_per_px'] += self.EWMA_ALPHA * (bytes_per_px - est['bytes_per_px'])
+
+    def _predicted_cost(self, choice: EncodingChoice, pixels: int) -> float:
+        est = self._estimates[choice]
+        return pixels * (est['sec_per_px'] + est['bytes_per_px'] / max(1.0, self.bandwidth))
+
+    def _encode_timed(self, image: Image.Image, choice: EncodingChoice) -> Tuple[io.BytesIO, float]:
+        fmt, level = choice
+        start = time.perf_counter()
+        buffer = encode_for_upload(image, fmt, compress_level=level, quality=self.quality)
+        elapsed = time.perf_counter() - start
+        self._update_estimate(choice, image.width * image.height, elapsed, buffer.getbuffer().nbytes)
+        return buffer, elapsed
+
+    def encode(self, image: Image.Image) -> Tuple[io.BytesIO, str, str]:
+        """
+        编码图片用于上传
+
+        Returns:
+            (image_bytes, mime_type, filename)
+        """
+        if self.mode != 'auto':
+            choice = (self.mode, self.compress_level)
+            buffer, _ = self._encode_timed(image, choice)
+        else:
+            choice, buffer = self._encode_auto(image)
+        fmt = choice[0]
+        _, mime_type, ext = UPLOAD_FORMATS[fmt]
+        return buffer, mime_type, f"image.{ext}"
+
+    def _encode_auto(self, image: Image.Image) -> Tuple[EncodingChoice, io.BytesIO]:
+        pixels = image.width * image.height
+        candidates = self.candidates()
+        with self._lock:
+            uncalibrated = [c for c in candidates if c not in self._estimates]
+
+        if uncalibrated:
+            # 校准：把未测过的候选各编码一次，直接选实际总耗时最小的
+            best = None
+            for choice in candidates:
+                buffer, elapsed = self._encode_timed(image, choice)
+                cost = elapsed + buffer.getbuffer().nbytes / max(1.0, self.bandwidth)
+                if best is None or cost < best[0]:
+                    best = (cost, choice, buffer)
+            return best[1], best[2]
+
+        with self._lock:
+            choice = min(candidates, key=lambda c: self._predicted_cost(c, pixels))
+        buffer, _ = self._encode_timed(image, choice)
+        return choice, buffer
+
+    def stats(self) -> dict:
+        """当前编码估计与带宽（用于日志/状态展示）"""
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'bandwidth_bytes_per_sec': round(self.bandwidth, 1),
+                'bandwidth_samples': self.bandwidth_estimator.samples,
+                'estimates': {
+                    f"{fmt}:{level}" if fmt == 'png' else fmt: {
+                        'ms_per_mp': round(est['sec_per_px'] * 1e6 * 1000, 2),
+                        'bytes_per_px': round(est['bytes_per_px'], 3),
+                    }
+                    for (fmt, level), est in self._estimates.items()
+                },
+            }
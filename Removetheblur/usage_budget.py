@@ -0,0 +1,366 @@
+"""
+用量与预算
+- 从接口返回的 usage 记录每张图片的 token 数，按单价估算费用
+- UsageLedger: 按天累计用量，保存在 CACHE_DIR/usage.json，每日预算跨批次、跨重启累计
+- BatchBudget: 批处理派发每张图片前先预留其预估用量，预计超出预算时按 BUDGET_ACTION
+  降低质量（high → medium → low）、暂停到次日或停止派发剩余图片，而不是超出后才发现
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+from config import (
+    CACHE_DIR,
+    COST_INPUT_PER_1M,
+    COST_OUTPUT_PER_1M,
+    BUDGET_BATCH_TOKENS,
+    BUDGET_BATCH_COST,
+    BUDGET_DAILY_TOKENS,
+    BUDGET_DAILY_COST,
+    BUDGET_ACTION,
+    BUDGET_MAX_PAUSE,
+)
+
+# 质量从高到低（降级顺序）
+QUALITY_LEVELS = ('high', 'medium', 'low')
+BUDGET_ACTIONS = ('degrade', 'pause', 'stop')
+# 尚无实测数据时的预估：每张输出图片的 token 数（正方形, 非正方形），按 gpt-image-1 的计费表
+DEFAULT_OUTPUT_TOKENS = {'high': (4160, 6240), 'medium': (1056, 1584), 'low': (272, 408)}
+# 预估的输入 token 数（输入图片 + 提示词）
+DEFAULT_INPUT_TOKENS = 500
+
+
+def estimate_cost(input_tokens: int, output_tokens: int) -> float:
+    """按单价估算费用（美元）"""
+    return (input_tokens * COST_INPUT_PER_1M + output_tokens * COST_OUTPUT_PER_1M) / 1_000_000
+
+
+def normalize_usage(raw) -> Optional[dict]:
+    """
+    把接口返回的 usage 统一为 {input_tokens, output_tokens, total_tokens, cost}
+
+    兼容 input/output_tokens 与 prompt/completion_tokens 两种字段名；无法识别时返回 None
+    """
+    if not isinstance(raw, dict):
+        return None
+    try:
+        input_tokens = int(raw.get('input_tokens') or raw.get('prompt_tokens') or 0)
+        output_tokens = int(raw.get('output_tokens') or raw.get('completion_tokens') or 0)
+        total_tokens = int(raw.get('total_tokens') or input_tokens + output_tokens)
+    except (TypeError, ValueError):
+        return None
+    if total_tokens <= 0:
+        return None
+    return {
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'total_tokens': total_tokens,
+        'cost': round(estimate_cost(input_tokens, output_tokens), 6),
+    }
+
+
+def _empty_totals() -> dict:
+    return {'images': 0, 'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0, 'cost': 0.0}
+
+
+def _add_usage(totals: dict, usage: dict):
+    totals['images'] += 1
+    for key in ('input_tokens', 'output_tokens', 'total_tokens'):
+        totals[key] += usage.get(key, 0)
+    totals['cost'] = round(totals['cost'] + usage.get('cost', 0.0), 6)
+
+
+def sum_usage(usages) -> Optional[dict]:
+    """合并多次调用的用量（分块处理时每块调用一次），都没有用量时返回 None"""
+    usages = [usage for usage in usages if usage]
+    if not usages:
+        return None
+    return {
+        'input_tokens': sum(usage.get('input_tokens', 0) for usage in usages),
+        'output_tokens': sum(usage.get('output_tokens', 0) for usage in usages),
+        'total_tokens': sum(usage.get('total_tokens', 0) for usage in usages),
+        'cost': round(sum(usage.get('cost', 0.0) for usage in usages), 6),
+    }
+
+
+def _seconds_until_tomorrow() -> float:
+    now = time.localtime()
+    return float(86400 - (now.tm_hour * 3600 + now.tm_min * 60 + now.tm_sec))
+
+
+class UsageLedger:
+    """按天累计的用量账本（线程安全，只保留最近 KEEP_DAYS 天）"""
+
+    KEEP_DAYS = 31
+
+    def __init__(self, path: str = None):
+        self.path = Path(path or os.path.join(CACHE_DIR, 'usage.json'))
+        self._lock = threading.Lock()
+        self._days: Dict[str, dict] = {}
+        self._load()
+
+    @staticmethod
+    def today() -> str:
+        return time.strftime('%Y-%m-%d')
+
+    def _load(self):
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict):
+            for date, totals in data.items():
+                if isinstance(totals, dict):
+                    self._days[date] = dict(_empty_totals(), **totals)
+
+    def save(self):
+        """保存账本（先写临时文件再原子替换）"""
+        with self._lock:
+            days = sorted(self._days)[-self.KEEP_DAYS:]
+            self._days = {date: self._days[date] for date in days}
+            data = json.dumps(self._days)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(f"{self.path.name}.{threading.get_ident()}.tmp")
+            tmp_path.write_text(data, encoding='utf-8')
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ 保存用量账本失败: {e}")
+
+    def record(self, usage: dict):
+        """记录一次计费请求的用量（normalize_usage 的结果），并保存"""
+        with self._lock:
+            _add_usage(self._days.setdefault(self.today(), _empty_totals()), usage)
+        self.save()
+
+    def day(self, date: str = None) -> dict:
+        """某天（默认今天）的累计用量"""
+        with self._lock:
+            return dict(self._days.get(date or self.today(), _empty_totals()))
+
+
+class BatchBudget:
+    """
+    单个批次的预算调度（线程安全）
+
+    每张图片派发前调用 admit() 预留预估用量，处理完调用 settle() 换成实际用量；
+    预估值优先用本批次同质量的实测平均值，没有时用 DEFAULT_OUTPUT_TOKENS
+    """
+
+    # 实测用量指数滑动平均的权重
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, ledger: 'UsageLedger', base_quality: str = 'high', action: str = None,
+                 batch_tokens: int = None, batch_cost: float = None,
+                 daily_tokens: int = None, daily_cost: float = None,
+                 max_pause: float = None):
+        self.ledger = ledger
+        self.base_quality = base_quality if base_quality in QUALITY_LEVELS else QUALITY_LEVELS[0]
+        self.action = (action or BUDGET_ACTION).strip().lower()
+        if self.action not in BUDGET_ACTIONS:
+            raise ValueError(f"BUDGET_ACTION 无效: {self.action}（可选: {', '.join(BUDGET_ACTIONS)}）")
+        self.batch_tokens = BUDGET_BATCH_TOKENS if batch_tokens is None else batch_tokens
+        self.batch_cost = BUDGET_BATCH_COST if batch_cost is None else batch_cost
+        self.daily_tokens = BUDGET_DAILY_TOKENS if daily_tokens is None else daily_tokens
+        self.daily_cost = BUDGET_DAILY_COST if daily_cost is None else daily_cost
+        self.max_pause = BUDGET_MAX_PAUSE if max_pause is None else max_pause
+        self._cond = threading.Condition()
+        self._started = time.time()
+        self._totals = _empty_totals()
+        self._settled = 0
+        self._reserved_tokens = 0
+        self._reserved_cost = 0.0
+        self._in_flight = 0
+        # (质量, 是否正方形) -> [平均token数, 平均费用]
+        self._estimates: Dict[Tuple[str, bool], list] = {}
+        self._quality_counts: Dict[str, int] = {}
+        self.state = 'ok'  # ok / degraded / paused / exhausted
+        self.reason = ''
+        self.paused_seconds = 0.0
+        self._pause_started: Optional[float] = None
+
+    @property
+    def limited(self) -> bool:
+        return any(limit > 0 for limit in
+                   (self.batch_tokens, self.batch_cost, self.daily_tokens, self.daily_cost))
+
+    def _estimate(self, quality: str, size: Tuple[int, int]) -> Tuple[int, float]:
+        square = size[0] == size[1]
+        observed = self._estimates.get((quality, square))
+        if observed is not None:
+            return int(observed[0]), observed[1]
+        output_tokens = DEFAULT_OUTPUT_TOKENS[quality][0 if square else 1]
+        return DEFAULT_INPUT_TOKENS + output_tokens, estimate_cost(DEFAULT_INPUT_TOKENS, output_tokens)
+
+    def _blocker(self, tokens: int, cost: float) -> Optional[str]:
+        """预留 tokens/cost 后会超出的预算（'batch' / 'daily'），都不超出返回 None"""
+        batch_tokens = self._totals['total_tokens'] + self._reserved_tokens + tokens
+        batch_cost = self._totals['cost'] + self._reserved_cost + cost
+        if (self.batch_tokens > 0 and batch_tokens > self.batch_tokens) or \
+                (self.batch_cost > 0 and batch_cost > self.batch_cost):
+            return 'batch'
+        if self.daily_tokens > 0 or self.daily_cost > 0:
+            today = self.ledger.day()
+            daily_tokens = today['total_tokens'] + self._reserved_tokens + tokens
+            daily_cost = today['cost'] + self._reserved_cost + cost
+            if (self.daily_tokens > 0 and daily_tokens > self.daily_tokens) or \
+                    (self.daily_cost > 0 and daily_cost > self.daily_cost):
+                return 'daily'
+        return None
+
+    def admit(self, sizes: Sequence[Tuple[int, int]], on_pause=None) -> Optional[dict]:
+        """
+        为一张图片预留预算
+
+        Args:
+            sizes: 这张图片每次接口调用的接口尺寸（分块处理时每块一个，尺寸可以各不相同；用于预估输出 token 数）
+            on_pause: 可选，进入暂停时回调一次
+
+        Returns:
+            预留记录 {'quality', 'tokens', 'cost', 'square', 'requests'}（之后传给 settle；
+            各次调用形状不一致时 square 为 None）；预算用完返回 None
+        """
+        sizes = [tuple(size) for size in sizes]
+        shapes = {size[0] == size[1] for size in sizes}
+        square = shapes.pop() if len(shapes) == 1 else None
+        with self._cond:
+            levels = QUALITY_LEVELS[QUALITY_LEVELS.index(self.base_quality):]
+            if self.action != 'degrade':
+                levels = levels[:1]
+            while True:
+                if self.state == 'exhausted':
+                    return None
+                blocker = None
+                for quality in levels:
+                    estimates = [self._estimate(quality, size) for size in sizes]
+                    tokens = sum(estimate[0] for estimate in estimates)
+                    cost = sum(estimate[1] for estimate in estimates)
+                    blocker = self._blocker(tokens, cost)
+                    if blocker is None:
+                        break
+                if blocker is None:
+                    if self._pause_started is not None:
+                        self.paused_seconds += time.monotonic() - self._pause_started
+                        self._pause_started = None
+                        print("✓ 预算已恢复，继续处理")
+                    if quality != self.base_quality and self.state != 'degraded':
+                        print(f"⚠️ 预算即将用完，图片质量降为 {quality}")
+                    self.state = 'degraded' if quality != self.base_quality else 'ok'
+                    self._reserved_tokens += tokens
+                    self._reserved_cost += cost
+                    self._in_flight += 1
+                    return {'quality': quality, 'tokens': tokens, 'cost': cost,
+                            'square': square, 'requests': len(sizes)}
+                # 还有在途图片时先等它们结算：实际用量可能低于预估
+                if self._in_flight > 0:
+                    self._cond.wait(timeout=1.0)
+                    continue
+                # 每日预算用完时可以暂停到次日；批次预算用完只能停止
+                if self.action == 'pause' and blocker == 'daily':
+                    now = time.monotonic()
+                    if self._pause_started is None:
+                        self._pause_started = now
+                        self.state = 'paused'
+                        self.reason = '每日预算已用完，暂停到次日'
+                        print(f"⚠️ {self.reason}（约 {_seconds_until_tomorrow() / 3600:.1f} 小时）")
+                    if on_pause is not None:
+                        try:
+                            on_pause()
+                        except Exception:
+                            pass
+                        on_pause = None
+                    paused = now - self._pause_started
+                    if paused < self.max_pause:
+                        self._cond.wait(timeout=min(60.0, self.max_pause - paused,
+                                                    _seconds_until_tomorrow() + 1))
+                        continue
+                    self.paused_seconds += paused
+                    self._pause_started = None
+                self.state = 'exhausted'
+                self.reason = '批次预算已用完' if blocker == 'batch' else '每日预算已用完'
+                print(f"✗ {self.reason}，停止派发剩余图片")
+                self._cond.notify_all()
+                return None
+
+    def settle(self, reservation: dict, usage: Optional[dict]):
+        """
+        释放预留并计入实际用量
+
+        Args:
+            reservation: admit() 的返回值
+            usage: 实际用量（normalize_usage 的结果）；命中缓存、合并请求或失败时为 None
+        """
+        with self._cond:
+            self._reserved_tokens -= reservation['tokens']
+            self._reserved_cost -= reservation['cost']
+            self._in_flight = max(0, self._in_flight - 1)
+            self._settled += 1
+            quality = reservation['quality']
+            self._quality_counts[quality] = self._quality_counts.get(quality, 0) + 1
+            if usage:
+                _add_usage(self._totals, usage)
+            # 方形和非方形调用混在一起时无法分摊到各自的预估，只计入用量
+            if usage and reservation.get('square', True) is not None:
+                key = (quality, reservation.get('square', True))
+                # 预估按单次调用记录
+                requests = max(1, reservation.get('requests', 1))
+                tokens, cost = usage['total_tokens'] / requests, usage['cost'] / requests
+                observed = self._estimates.get(key)
+                if observed is None:
+                    self._estimates[key] = [tokens, cost]
+                else:
+                    observed[0] += self.EWMA_ALPHA * (tokens - observed[0])
+                    observed[1] += self.EWMA_ALPHA * (cost - observed[1])
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """运行中的用量/费用/吞吐统计"""
+        with self._cond:
+            totals = dict(self._totals)
+            settled = self._settled
+            elapsed = max(1e-6, time.time() - self._started)
+            stats = {
+                'state': self.state,
+                'reason': self.reason,
+                'action': self.action,
+                'base_quality': self.base_quality,
+                'quality_counts': dict(self._quality_counts),
+                'in_flight': self._in_flight,
+                'reserved_tokens': self._reserved_tokens,
+                'reserved_cost': round(self._reserved_cost, 4),
+                'paused_seconds': round(self.paused_seconds, 1),
+            }
+        minutes = elapsed / 60
+        stats.update({
+            'batch': totals,
+            'elapsed_seconds': round(elapsed, 1),
+            'images_per_minute': round(settled / minutes, 2),
+            'tokens_per_minute': round(totals['total_tokens'] / minutes, 1),
+            'cost_per_image': round(totals['cost'] / totals['images'], 4) if totals['images'] else 0.0,
+            'cost_per_hour': round(totals['cost'] / minutes * 60, 4),
+            'daily': self.ledger.day(),
+            'limits': {
+                'batch_tokens': self.batch_tokens,
+                'batch_cost': self.batch_cost,
+                'daily_tokens': self.daily_tokens,
+                'daily_cost': self.daily_cost,
+            },
+        })
+        return stats
+
+
+_shared_ledger: Optional[UsageLedger] = None
+_shared_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger() -> UsageLedger:
+    """获取进程级共享的用量账本"""
+    global _shared_ledger
+    if _shared_ledger is None:
+        with _shared_ledger_lock:
+            if _shared_ledger is None:
+                _shared_ledger = UsageLedger()
+    return _shared_ledger
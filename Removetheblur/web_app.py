@@ -1,19 +1,30 @@
 """
 Web应用 - 批量图片背景修复
 """
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response
 from werkzeug.utils import secure_filename
 import os
 import json
 from pathlib import Path
-from deblur_agent import DeblurAgent
 from PIL import Image
 from PIL import ImageOps
 from PIL import ImageFilter
 import threading
 import time
 from gpt_handler import GPTHandler
-from image_utils import resize_image_smart
+from http_pool import get_pool_stats
+from result_cache import get_result_cache
+from request_control import get_circuit_breaker, get_single_flight
+from backend_pool import get_backend_pool
+from phase_timing import summarize_phases
+from adaptive_timeout import get_adaptive_timeouts
+from image_utils import resize_image_smart, load_image, make_preview
+from prescreen import parse_prescreen_mode
+from session_journal import SessionJournal, find_session
+from config import AI_MAX_WORKERS, PREVIEW_MAX_SIDE
+from batch_runner import (
+    processing_status, processing_lock, process_images_batch, usage_stats, pipeline_stats
+)
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -26,20 +37,6 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 os.makedirs(app.config['TEMP_FOLDER'], exist_ok=True)
 
-# 处理状态
-processing_status = {
-    'is_processing': False,
-    'current_file': '',
-    'total_files': 0,
-    'processed_files': 0,
-    'errors': [],
-    'session_id': '',
-    'input_folder': '',
-    'temp_folder': '',
-    'prompt': '',
-    'latest_processed': []  # 最新处理的图片列表，用于实时更新
-}
-
 # 尺寸通道处理状态（压缩问题/原图问题）
 resize_status = {
     'is_processing': False,
@@ -144,7 +141,8 @@ def process_resize_batch(
                 # 统一输出 PNG（无损）
                 output_file = output_path / f"{image_file.stem}.png"
 
-                with Image.open(image_file) as im:
+                # 缩小时按目标尺寸降采样解码（放大时 load_image 不会缩小）
+                with load_image(image_file, target_size) as im:
                     # 处理 EXIF 方向，避免横竖颠倒
                     try:
                         im = ImageOps.exif_transpose(im)
@@ -246,140 +244,6 @@ def process_resize_batch(
             resize_status['total_files'] = 1
 
 
-def process_images_batch(input_folder, output_folder, session_id=None, prompt: str = None):
-    """批量处理图片"""
-    global processing_status
-    
-    try:
-        print(f"\n{'='*60}")
-        print(f"[线程启动] 开始批量处理图片")
-        print(f"输入文件夹: {input_folder}")
-        print(f"输出文件夹: {output_folder}")
-        print(f"会话ID: {session_id}")
-        if prompt:
-            print(f"提示词: {prompt}")
-        print(f"{'='*60}\n")
-        
-        processing_status['is_processing'] = True
-        processing_status['errors'] = []
-        processing_status['processed_files'] = 0
-        processing_status['latest_processed'] = []
-        if session_id:
-            processing_status['session_id'] = session_id
-            processing_status['input_folder'] = input_folder
-            processing_status['temp_folder'] = output_folder
-            processing_status['prompt'] = prompt or ''
-        
-        # 支持的图片格式
-        image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
-        
-        # 获取所有图片文件
-        input_path = Path(input_folder)
-        image_files = [
-            f for f in input_path.iterdir()
-            if f.suffix.lower() in image_extensions and f.is_file()
-        ]
-        
-        if not image_files:
-            error_msg = f'在文件夹 {input_folder} 中未找到图片文件（支持格式: .jpg, .jpeg, .png, .bmp, .tiff, .webp）'
-            print(f"✗ 错误: {error_msg}")
-            print(f"请检查文件夹路径是否正确，以及文件夹中是否包含支持的图片格式")
-            processing_status['errors'].append(error_msg)
-            processing_status['is_processing'] = False
-            processing_status['total_files'] = 0
-            return
-        
-        print(f"✓ 找到 {len(image_files)} 张图片文件")
-        processing_status['total_files'] = len(image_files)
-        processing_status['current_file'] = ''
-        
-        # 创建输出文件夹
-        output_path = Path(output_folder)
-        output_path.mkdir(parents=True, exist_ok=True)
-        
-        # 初始化agent，捕获初始化错误
-        try:
-            print("=" * 60)
-            print("正在初始化AI处理器...")
-            print("=" * 60)
-            agent = DeblurAgent()
-            print("✓ AI处理器初始化成功")
-            print("=" * 60)
-        except Exception as e:
-            error_msg = f"初始化AI处理器失败: {str(e)}"
-            print(f"✗ 错误: {error_msg}")
-            import traceback
-            traceback.print_exc()
-            processing_status['errors'].append(error_msg)
-            processing_status['is_processing'] = False
-            processing_status['total_files'] = len(image_files) if image_files else 0
-            return
-        
-        # 处理每张图片
-        processing_status['latest_processed'] = []  # 清空之前的数据
-        for idx, image_file in enumerate(image_files, 1):
-            try:
-                processing_status['current_file'] = image_file.name
-                processing_status['processed_files'] = idx - 1
-                
-                # 输出文件路径
-                output_file = output_path / f"{image_file.stem}_clear.jpg"
-                
-                # 处理图片
-                print(f"\n{'='*60}")
-                print(f"开始处理第 {idx}/{len(image_files)} 张图片: {image_file.name}")
-                print(f"{'='*60}")
-                result = agent.process_image(
-                    input_path=str(image_file),
-                    output_path=str(output_file),
-                    target_size=(1024, 1536),
-                    prompt=prompt
-                )
-                
-                if result['success']:
-                    # 处理成功，添加到最新处理列表（只包含当前处理的这一张）
-                    processing_status['processed_files'] = idx
-                    processing_status['latest_processed'] = [{
-                        'original': str(image_file),
-                        'fixed': str(output_file),
-                        'name': output_file.name,
-                        'original_name': image_file.name
-                    }]
-                    print(f"✓ 成功处理: {image_file.name}")
-                    # 短暂延迟，确保前端能获取到更新
-                    time.sleep(0.1)
-                else:
-                    error_msg = f"{image_file.name}: {result.get('error', '处理失败')}"
-                    print(f"✗ 处理失败: {error_msg}")
-                    processing_status['errors'].append(error_msg)
-                    # 即使失败也更新处理计数，避免卡在"处理中"
-                    processing_status['processed_files'] = idx
-                
-            except Exception as e:
-                error_msg = f"{image_file.name}: {str(e)}"
-                print(f"✗ 处理异常: {error_msg}")
-                import traceback
-                traceback.print_exc()
-                processing_status['errors'].append(error_msg)
-        
-        # 最终更新处理文件数
-        if processing_status['processed_files'] < len(image_files):
-            processing_status['processed_files'] = len(image_files)
-        
-    except Exception as e:
-        import traceback
-        error_msg = f"批量处理错误: {str(e)}"
-        print(f"严重错误: {error_msg}")
-        traceback.print_exc()
-        processing_status['errors'].append(error_msg)
-    finally:
-        processing_status['is_processing'] = False
-        processing_status['current_file'] = ''
-        # 确保total_files被设置
-        if processing_status.get('total_files', 0) == 0 and processing_status.get('errors'):
-            processing_status['total_files'] = 1  # 至少显示有错误
-
-
 @app.route('/')
 def index():
     """主页"""
@@ -436,6 +300,23 @@ def api_process():
     else:
         prompt = None
     print(f"提示词: {prompt or '(使用默认提示词)'}")
+    try:
+        max_workers = max(1, int(data.get('max_workers') or AI_MAX_WORKERS))
+    except (TypeError, ValueError):
+        max_workers = AI_MAX_WORKERS
+    # bypass_cache=true 时跳过结果缓存，强制重新调用API
+    bypass_cache = data.get('bypass_cache', False)
+    if isinstance(bypass_cache, str):
+        bypass_cache = bypass_cache.strip().lower() in {'1', 'true', 'yes', 'y', 'on'}
+    use_cache = not bool(bypass_cache)
+    # prescreen: 清晰度预筛模式 off / skip / copy，不传则使用 PRESCREEN_MODE
+    try:
+        prescreen = parse_prescreen_mode(data.get('prescreen'))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
     
     if not input_folder:
         return jsonify({
@@ -455,11 +336,27 @@ def api_process():
             'message': '路径不是文件夹'
         }), 400
     
-    # 使用临时文件夹存储处理后的图片
-    import uuid
-    session_id = str(uuid.uuid4())[:8]
-    temp_folder = os.path.join(app.config['TEMP_FOLDER'], session_id)
-    os.makedirs(temp_folder, exist_ok=True)
+    # resume=true 时续跑会话（session_id 不传则使用处理过该文件夹的最近一个会话），
+    # 跳过会话日志中已完成的图片，结果继续写入原来的临时文件夹
+    resume = data.get('resume', False)
+    if isinstance(resume, str):
+        resume = resume.strip().lower() in {'1', 'true', 'yes', 'y', 'on'}
+    resume = bool(resume)
+    if resume:
+        session_id = secure_filename(str(data.get('session_id') or '').strip()) \
+            or find_session(app.config['TEMP_FOLDER'], input_folder)
+        temp_folder = os.path.join(app.config['TEMP_FOLDER'], session_id) if session_id else ''
+        if not session_id or not SessionJournal(temp_folder).exists:
+            return jsonify({
+                'success': False,
+                'message': '没有可续跑的会话（未找到该文件夹的会话日志）'
+            }), 400
+    else:
+        # 使用临时文件夹存储处理后的图片
+        import uuid
+        session_id = str(uuid.uuid4())[:8]
+        temp_folder = os.path.join(app.config['TEMP_FOLDER'], session_id)
+        os.makedirs(temp_folder, exist_ok=True)
     
     # 保存会话信息
     processing_status['session_id'] = session_id
@@ -473,19 +370,28 @@ def api_process():
     processing_status['errors'] = []
     processing_status['processed_files'] = 0
     processing_status['latest_processed'] = []
+    processing_status['max_workers'] = max_workers
+    processing_status['in_flight'] = 0
+    processing_status['file_states'] = {}
+    processing_status['file_reports'] = {}
+    processing_status['prescreen'] = {}
+    processing_status['resumed'] = resume
+    processing_status['resumed_files'] = 0
+    processing_status['aborted'] = False
+    processing_status['abort_reason'] = ''
     
     # 在后台线程中处理
     print(f"\n{'='*60}")
     print(f"[API] 收到处理请求")
     print(f"输入文件夹: {input_folder}")
     print(f"临时文件夹: {temp_folder}")
-    print(f"会话ID: {session_id}")
+    print(f"会话ID: {session_id}" + ("（续跑）" if resume else ""))
     print(f"处理状态已设置为: is_processing=True")
     print(f"{'='*60}\n")
     
     thread = threading.Thread(
         target=process_images_batch,
-        args=(input_folder, temp_folder, session_id, prompt),
+        args=(input_folder, temp_folder, session_id, prompt, max_workers, use_cache, prescreen, resume),
         name=f"ProcessThread-{session_id}"
     )
     thread.daemon = True
@@ -501,16 +407,33 @@ def api_process():
     
     return jsonify({
         'success': True,
-        'message': '开始处理',
+        'message': '继续处理' if resume else '开始处理',
         'session_id': session_id,
-        'temp_folder': temp_folder
+        'temp_folder': temp_folder,
+        'resumed': resume
     })
 
 
 @app.route('/api/status', methods=['GET'])
 def api_status():
     """获取处理状态"""
-    return jsonify(processing_status)
+    with processing_lock:
+        status = dict(processing_status)
+        status['file_states'] = dict(processing_status.get('file_states', {}))
+        status['file_reports'] = dict(processing_status.get('file_reports', {}))
+        status['latest_processed'] = list(processing_status.get('latest_processed', []))
+        status['errors'] = list(processing_status.get('errors', []))
+    status['phase_stats'] = summarize_phases(status['file_reports'].values())
+    status['http_pool'] = get_pool_stats()
+    status['result_cache'] = get_result_cache().stats()
+    status['rate_limit'] = get_backend_pool().rate_limit_stats()
+    status['circuit'] = get_circuit_breaker().stats()
+    status['backends'] = get_backend_pool().stats()
+    status['timeouts'] = get_adaptive_timeouts().stats()
+    status['single_flight'] = get_single_flight().stats()
+    status['usage'] = usage_stats()
+    status['pipeline'] = pipeline_stats()
+    return jsonify(status)
 
 @app.route('/api/resize', methods=['POST'])
 def api_resize():
@@ -652,19 +575,49 @@ def api_resize_images():
 @app.route('/api/task_report', methods=['GET'])
 def api_task_report():
     """获取详细的任务报告"""
-    global processing_status
+    with processing_lock:
+        status = dict(processing_status)
+        file_states = dict(processing_status.get('file_states', {}))
+        file_reports = dict(processing_status.get('file_reports', {}))
+        errors = list(processing_status.get('errors', []))
+        prescreen = dict(processing_status.get('prescreen', {}))
     
     report = {
-        'is_processing': processing_status.get('is_processing', False),
-        'current_file': processing_status.get('current_file', ''),
-        'total_files': processing_status.get('total_files', 0),
-        'processed_files': processing_status.get('processed_files', 0),
-        'errors': processing_status.get('errors', []),
-        'session_id': processing_status.get('session_id', ''),
-        'input_folder': processing_status.get('input_folder', ''),
-        'temp_folder': processing_status.get('temp_folder', ''),
+        'is_processing': status.get('is_processing', False),
+        'current_file': status.get('current_file', ''),
+        'total_files': status.get('total_files', 0),
+        'processed_files': status.get('processed_files', 0),
+        'errors': errors,
+        'session_id': status.get('session_id', ''),
+        'input_folder': status.get('input_folder', ''),
+        'temp_folder': status.get('temp_folder', ''),
         'progress_percent': 0,
-        'status_summary': ''
+        'status_summary': '',
+        'max_workers': status.get('max_workers', AI_MAX_WORKERS),
+        'in_flight': status.get('in_flight', 0),
+        'file_states': file_states,
+        'file_reports': file_reports,
+        'total_retries': sum(
+            r.get('retries', 0) for r in file_reports.values()
+        ),
+        'coalesced_requests': sum(
+            1 for r in file_reports.values() if r.get('coalesced')
+        ),
+        'phase_stats': summarize_phases(file_reports.values()),
+        'http_pool': get_pool_stats(),
+        'result_cache': get_result_cache().stats(),
+        'rate_limit': get_backend_pool().rate_limit_stats(),
+        'circuit': get_circuit_breaker().stats(),
+        'backends': get_backend_pool().stats(),
+        'timeouts': get_adaptive_timeouts().stats(),
+        'single_flight': get_single_flight().stats(),
+        'usage': usage_stats(),
+        'pipeline': pipeline_stats(),
+        'prescreen': prescreen,
+        'resumed': status.get('resumed', False),
+        'resumed_files': status.get('resumed_files', 0),
+        'aborted': status.get('aborted', False),
+        'abort_reason': status.get('abort_reason', '')
     }
     
     # 计算进度百分比
@@ -672,7 +625,9 @@ def api_task_report():
         report['progress_percent'] = int((report['processed_files'] / report['total_files']) * 100)
     
     # 生成状态摘要
-    if report['is_processing']:
+    if report['aborted'] and not report['is_processing']:
+        report['status_summary'] = f"批处理已中止: {report['abort_reason']}"
+    elif report['is_processing']:
         report['status_summary'] = f"正在处理中... ({report['processed_files']}/{report['total_files']})"
     elif report['processed_files'] > 0:
         if report['errors']:
@@ -736,8 +691,13 @@ def api_images():
 
 @app.route('/api/image')
 def serve_image():
-    """提供图片访问"""
+    """
+    提供图片访问
+    可选参数 max：返回最长边不超过该值的预览图（降采样解码，不解码全分辨率）；
+    max=1 表示使用 PREVIEW_MAX_SIDE
+    """
     filepath = request.args.get('path', '')
+    max_side = request.args.get('max', type=int)
     
     if not filepath:
         return 'No file path provided', 400
@@ -752,6 +712,14 @@ def serve_image():
         if not file_path.is_file():
             return 'Not a file', 400
         
+        if max_side:
+            if max_side == 1:
+                max_side = PREVIEW_MAX_SIDE
+            data, mimetype = make_preview(str(file_path), max_side)
+            response = Response(data, mimetype=mimetype)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        
         # 返回文件
         folder = str(file_path.parent)
         filename = file_path.name
@@ -819,7 +787,7 @@ def api_save():
     else:
         # 如果没有选择，保存所有图片
         for file in Path(temp_folder).iterdir():
-            if file.is_file() and file.suffix.lower() in {'.jpg', '.jpeg', '.png'}:
+            if file.is_file() and file.suffix.lower() in {'.jpg', '.jpeg', '.png', '.webp'}:
                 try:
                     dst_file = output_path / file.name
                     import shutil